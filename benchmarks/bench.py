@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Time and peak memory of the pipeline stages on synthetic movies of several
+    sizes, to follow how they scale and to catch regressions between commits.
+
+    $ python benchmarks/bench.py --sizes small medium large
+
+Every stage runs --repeat times on each size; the best time is reported
+    (seconds, wall clock), and the peak memory allocated during one more run
+    (MiB, traced with tracemalloc, numpy arrays included). Results are
+    printed as a table and appended as one json line per run (commit, machine,
+    sizes, stages) to --out, default benchmarks/results.jsonl.
+
+The synthetic data (see synthetic.py) is made once per size in --data,
+    default a temporary folder.
+
+Stages:
+    translate       utils.translate of the movie in memory
+    register        utils.register, tiff in and out
+    findCroppedDim  crop borders measured in the pixels (no sidecar)
+    parse           the TrackMate xml parsed (TrackMateModel.load(cache=False))
+    parse_cached    the xml model read back from its npz sidecar
+    findNeighbors   TrackPairer.findNeighbors, candidate pairs and features
+    pred2SpotCSV    spots csv of the pairs, every candidate labelled a pair
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import subprocess
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', 'src'))
+from utils import (TrackMateModel, TrackPairer, translate, register, findCroppedDim, combine,
+                   registrationSidecar, getFramerate, findPairs)
+from synthetic import makeMovieFolder
+
+
+# tracks: n_pairs centrosome pairs and n_noise other tracks over n_frames;
+# movie: n_frames x nz x height x width, n_channels for a 5D movie
+SIZES = {
+    'tiny': {'n_pairs': 5, 'n_noise': 10, 'n_frames': 30, 'nz': 5, 'height': 128, 'width': 128},
+    'small': {'n_pairs': 20, 'n_noise': 40, 'n_frames': 60, 'nz': 10, 'height': 256, 'width': 256},
+    'medium': {'n_pairs': 80, 'n_noise': 160, 'n_frames': 100, 'nz': 15, 'height': 512, 'width': 512},
+    'large': {'n_pairs': 250, 'n_noise': 500, 'n_frames': 150, 'nz': 20, 'height': 512, 'width': 512},
+    'medium5d': {'n_pairs': 80, 'n_noise': 160, 'n_frames': 60, 'nz': 15, 'height': 512, 'width': 512,
+                 'n_channels': 2},
+}
+STAGES = ('translate', 'register', 'findCroppedDim', 'parse', 'parse_cached', 'findNeighbors', 'pred2SpotCSV')
+
+
+def moviePaths(root, size):
+    folder = os.path.join(root, size)
+    return {'folder': folder,
+            'tiff': os.path.join(folder, size + '.tif'),
+            'r_tiff': os.path.join(folder, 'r_' + size + '.tif'),
+            'xml': os.path.join(folder, 'r_' + size + '.xml'),
+            'roi': os.path.join(folder, 'roi', ''),
+            'out_csv': os.path.join(folder, 'r_' + size + '.txt')}
+
+
+def prepare(root, size):
+    '''
+    Makes the synthetic movie folder of a size, unless it exists, and the
+        inputs of the later stages (registered movie, features, predictions)
+    '''
+    paths = moviePaths(root, size)
+    if not os.path.exists(paths['xml']):
+        makeMovieFolder(root, size, seed=0, **SIZES[size])
+    with contextlib.redirect_stdout(io.StringIO()):
+        if not os.path.exists(paths['r_tiff']):
+            register(paths['tiff'], combine(paths['roi'], n_csv=1), paths['r_tiff'], pad=True)
+        predictions = os.path.join(paths['folder'], 'predictions.csv')
+        if not os.path.exists(predictions):
+            findPairs(paths['xml'], paths['r_tiff'], paths['folder'])
+            df = pd.read_csv(os.path.join(paths['folder'], 'features.csv'))
+            df['Predicted_Label'] = 1
+            df.loc[df['centID_j'] > df['centID_i']].to_csv(predictions, index=False)
+    return paths
+
+
+def stageRunner(stage, paths):
+    '''
+    Returns (setup, run) for a stage: setup prepares one run and is not
+        timed, run is the timed part
+    '''
+    state = {}
+    if stage == 'translate':
+        def setup():
+            if 'movie' not in state:
+                import tifffile
+                state['movie'] = tifffile.imread(paths['tiff'])
+                state['translation'] = combine(paths['roi'], n_csv=1)
+        return setup, lambda: translate(state['movie'], state['translation'], hi_res=False)
+    if stage == 'register':
+        out = paths['r_tiff'] + '.bench.tif'
+        def run():
+            register(paths['tiff'], combine(paths['roi'], n_csv=1), out, pad=True)
+            os.remove(out)
+            os.remove(registrationSidecar(out))
+        return (lambda: None), run
+    if stage == 'findCroppedDim':
+        copy = paths['r_tiff'] + '.nosidecar.tif'
+        def setup():
+            if not os.path.exists(copy):
+                shutil.copyfile(paths['r_tiff'], copy)
+        return setup, lambda: findCroppedDim(copy)
+    if stage == 'parse':
+        return (lambda: None), lambda: TrackMateModel.load(paths['xml'], cache=False)
+    if stage == 'parse_cached':
+        def setup():
+            TrackMateModel.load(paths['xml'])
+            TrackMateModel._memo.clear()
+        return setup, lambda: TrackMateModel.load(paths['xml'])
+    if stage == 'findNeighbors':
+        def setup():
+            TrackMateModel.load(paths['xml'])
+        def run():
+            pairer = TrackPairer(paths['xml'])
+            with open(os.devnull, 'w') as f:
+                pairer.findNeighbors(f, paths['r_tiff'], float(getFramerate(paths['xml'])))
+            return pairer
+        return setup, run
+    if stage == 'pred2SpotCSV':
+        def setup():
+            TrackMateModel.load(paths['xml'])
+        return setup, lambda: TrackPairer(paths['xml']).pred2SpotCSV(paths['xml'], paths['folder'], paths['out_csv'])
+    raise ValueError('unknown stage ' + stage)
+
+
+def timeStage(stage, paths, repeat=3):
+    '''
+    Best wall time of repeat runs, and peak traced memory of one more run
+    '''
+    setup, run = stageRunner(stage, paths)
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            setup()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        setup()
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return min(times), peak / 2**20
+
+
+def dataSize(paths):
+    # what a stage scales with: tracks, spots and movie voxels
+    model = TrackMateModel.load(paths['xml'])
+    with open(registrationSidecar(paths['r_tiff'])) as f:
+        shape = json.load(f)['shape']
+    return {'spots': len(model.spots), 'tracks': len(model.tracks),
+            'pairs': int(len(pd.read_csv(os.path.join(paths['folder'], 'predictions.csv')))),
+            'voxels': int(np.prod(shape))}
+
+
+def machine():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__}
+
+
+def run_bench(sizes=('tiny', 'small'), stages=STAGES, repeat=3, data=None, out_path=None):
+    '''
+    Runs the benchmark, returns the results as a dataframe (one row per size
+        and stage) and appends them to out_path (default benchmarks/results.jsonl)
+    '''
+    if out_path is None:
+        out_path = os.path.join(HERE, 'results.jsonl')
+    tmp = None
+    if data is None:
+        data = tmp = tempfile.mkdtemp(prefix='centtracker_bench_')
+    rows = []
+    try:
+        for size in sizes:
+            paths = prepare(data, size)
+            counts = dataSize(paths)
+            for stage in stages:
+                seconds, peak = timeStage(stage, paths, repeat=repeat)
+                rows.append(dict({'size': size, 'stage': stage, 'seconds': seconds, 'peak_mib': peak}, **counts))
+                print('{:<10} {:<15} {:9.4f} s {:9.1f} MiB'.format(size, stage, seconds, peak))
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+    with open(out_path, 'a') as f:
+        f.write(json.dumps(dict(machine(), repeat=repeat, results=rows)) + '\n')
+    print('Results appended to ' + out_path)
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic movies.')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['tiny', 'small'])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best is kept')
+    parser.add_argument('--data', default=None, help='folder for the synthetic movies, kept between runs')
+    parser.add_argument('--out', default=None, help='json lines file the results are appended to')
+    args = parser.parse_args(argv)
+    run_bench(sizes=args.sizes, stages=args.stages, repeat=args.repeat, data=args.data, out_path=args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Size and read/write time of the registered movie in each output format, on
+    the padded registered movies of the synthetic sizes of bench.py.
+
+    $ python benchmarks/formats.py --sizes small medium
+
+Formats (see utils.register):
+    raw         uncompressed tiff, the default
+    zlib        zlib compressed tiff, one strip set per plane
+    zlib_tiled  zlib compressed tiff in 128 x 128 tiles
+    lzma        lzma compressed tiff
+    store       chunked plane store (.zarr directory), one zlib chunk per plane
+
+For each: write time (register, tiff in, format out), size on disk, time to
+    read the full movie, the first plane of every timepoint (what
+    findCroppedDim and estimateDrift read) and 100 random planes. Best of
+    --repeat runs. Printed as a table and appended as one json line to --out,
+    default benchmarks/formats.jsonl.
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', 'src'))
+from utils import register, combine, PlaneStore, _iterTiffFrames, _iterFirstPlanes, _tiffFrames
+from bench import SIZES, prepare, machine
+import tifffile
+
+FORMATS = {'raw': ('.tif', {}),
+           'zlib': ('.tif', {'codec': 'zlib'}),
+           'zlib_tiled': ('.tif', {'codec': 'zlib', 'tile': 128}),
+           'lzma': ('.tif', {'codec': 'lzma'}),
+           'store': ('.zarr', {})}
+
+
+def diskSize(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def readPlanes(path, indices):
+    # the (y, x) planes at (t, z[, c]) indices, reading nothing else
+    if os.path.isdir(path):
+        store = PlaneStore.open(path)
+        return [store.readPlane(index) for index in indices]
+    shape, _, frames = _tiffFrames(path)
+    if frames is not None:
+        return [np.array(frames[index]) for index in indices]
+    with tifffile.TiffFile(path) as tif:
+        return [tif.pages[int(np.ravel_multi_index(index, shape[:-2]))].asarray() for index in indices]
+
+
+def best(run, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_formats(sizes=('tiny', 'small'), formats=tuple(FORMATS), repeat=3, data=None, out_path=None):
+    '''
+    Compares the formats, returns a dataframe (one row per size and format)
+        and appends it to out_path (default benchmarks/formats.jsonl)
+    '''
+    if out_path is None:
+        out_path = os.path.join(HERE, 'formats.jsonl')
+    tmp = None
+    if data is None:
+        data = tmp = tempfile.mkdtemp(prefix='centtracker_formats_')
+    rows = []
+    try:
+        for size in sizes:
+            paths = prepare(data, size)
+            trans_mat = combine(paths['roi'], n_csv=1)
+            shape = _tiffFrames(paths['r_tiff'])[0]
+            rng = np.random.RandomState(0)
+            indices = [tuple(int(rng.randint(n)) for n in shape[:-2]) for _ in range(100)]
+            for name in formats:
+                ext, kwargs = FORMATS[name]
+                out = os.path.join(paths['folder'], 'format_' + name + ext)
+                def write():
+                    remove(out)
+                    register(paths['tiff'], trans_mat, out, pad=True, **kwargs)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    row = {'size': size, 'format': name,
+                           'write_s': best(write, repeat),
+                           'mib': diskSize(out) / 2**20,
+                           'read_s': best(lambda: sum(1 for _ in _iterTiffFrames(out)), repeat),
+                           'first_planes_s': best(lambda: sum(1 for _ in _iterFirstPlanes(out)), repeat),
+                           'random_planes_s': best(lambda: readPlanes(out, indices), repeat)}
+                rows.append(row)
+                remove(out)
+                remove(out + '.json')
+                print('{size:<10} {format:<11} write {write_s:8.3f} s {mib:9.1f} MiB  read {read_s:8.3f} s  '
+                      'first planes {first_planes_s:8.4f} s  random planes {random_planes_s:8.4f} s'.format(**row))
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+    with open(out_path, 'a') as f:
+        f.write(json.dumps(dict(machine(), repeat=repeat, results=rows)) + '\n')
+    print('Results appended to ' + out_path)
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the output formats of the registered movie.')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['tiny', 'small'])
+    parser.add_argument('--formats', nargs='+', choices=list(FORMATS), default=list(FORMATS))
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs, the best is kept')
+    parser.add_argument('--data', default=None, help='folder for the synthetic movies, kept between runs')
+    parser.add_argument('--out', default=None, help='json lines file the results are appended to')
+    args = parser.parse_args(argv)
+    run_formats(sizes=args.sizes, formats=args.formats, repeat=args.repeat, data=args.data, out_path=args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Synthetic inputs at any scale: TrackMate xmls with centrosome pairs and
+    noise tracks, and drifting 4D/5D movies with the roi files of their
+    translation matrix.
+
+    $ python benchmarks/synthetic.py /tmp/synth movie0 --pairs 200 --frames 120
+
+makes a movie folder laid out as in the batch notebook:
+    root/<movie>/<movie>.tif, root/<movie>/roi/1.csv, root/<movie>/r_<movie>.xml
+'''
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+import tifffile
+
+
+# features of the TrackMate 3 xml, (name, isint)
+SPOT_FEATURES = [('QUALITY', False), ('POSITION_X', False), ('POSITION_Y', False), ('POSITION_Z', False),
+                 ('POSITION_T', False), ('FRAME', True), ('RADIUS', False), ('VISIBILITY', True),
+                 ('MANUAL_COLOR', True), ('MEAN_INTENSITY', False), ('MEDIAN_INTENSITY', False),
+                 ('MIN_INTENSITY', False), ('MAX_INTENSITY', False), ('TOTAL_INTENSITY', False),
+                 ('STANDARD_DEVIATION', False), ('ESTIMATED_DIAMETER', False), ('CONTRAST', False),
+                 ('SNR', False)]
+EDGE_FEATURES = [('SPOT_SOURCE_ID', True), ('SPOT_TARGET_ID', True), ('LINK_COST', False), ('EDGE_TIME', False),
+                 ('EDGE_X_LOCATION', False), ('EDGE_Y_LOCATION', False), ('EDGE_Z_LOCATION', False),
+                 ('VELOCITY', False), ('DISPLACEMENT', False)]
+TRACK_FEATURES = [('TRACK_ID', True), ('NUMBER_SPOTS', True), ('NUMBER_GAPS', True), ('TRACK_DURATION', False),
+                  ('TRACK_START', False), ('TRACK_STOP', False), ('TRACK_X_LOCATION', False),
+                  ('TRACK_Y_LOCATION', False), ('TRACK_Z_LOCATION', False)]
+
+
+def centrosomeTracks(n_pairs, n_noise, n_frames, size, rng):
+    '''
+    Track positions (microns): n_pairs centrosome pairs whose spindle
+        elongates from ~3 to ~9 microns over the pair's lifetime around a
+        slowly drifting midpoint (with a few gaps), and n_noise random walks.
+
+    - size: (x, y, z) extent of the volume in microns
+
+    Returns a list of tracks, each a list of (frame, x, y, z), pairs first
+        (tracks 2k and 2k+1).
+    '''
+    size = np.asarray(size, dtype=float)
+    margin = np.minimum(size / 4, [5, 5, 2])
+    tracks = []
+    for _ in range(n_pairs):
+        t_i = int(rng.integers(0, max(1, n_frames // 2)))
+        t_f = int(rng.integers(min(t_i + 12, n_frames), n_frames + 1))
+        center = rng.uniform(margin, size - margin)
+        axis = rng.normal(size=3)
+        axis /= np.linalg.norm(axis)
+        a, b = [], []
+        for frame in range(t_i, t_f):
+            length = 3 + 6 * (frame - t_i) / max(1, t_f - t_i) + rng.normal(0, 0.3)
+            center = center + rng.normal(0, 0.1, 3)
+            if rng.random() < 0.05 and frame not in (t_i, t_f - 1): # missed detection, a gap
+                continue
+            a.append((frame,) + tuple(center + axis * length / 2))
+            b.append((frame,) + tuple(center - axis * length / 2))
+        tracks += [a, b]
+    for _ in range(n_noise):
+        t_i = int(rng.integers(0, max(1, n_frames - 3)))
+        t_f = int(rng.integers(min(t_i + 2, n_frames), n_frames + 1))
+        position = rng.uniform(0, size)
+        points = []
+        for frame in range(t_i, t_f):
+            position = position + rng.normal(0, 0.3, 3)
+            points.append((frame,) + tuple(position))
+        tracks.append(points)
+    return [t for t in tracks if len(t) > 1]
+
+
+def _attr(value):
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return repr(float(value))
+
+
+def makeTrackMateXML(xml_path, n_pairs=20, n_noise=30, n_frames=60, n_free=None, dt=30.0, dx=0.2,
+                     width=512, height=512, nz=20, seed=0):
+    '''
+    Writes a TrackMate (v3) xml with the tracks of centrosomeTracks and
+        n_free untracked spots (default one per frame), with the geometry
+        log and image settings the parser reads.
+
+    - dt: frame interval in seconds, dx: pixel size in microns (z step 1 micron)
+    - width, height, nz: image size in pixels/slices
+
+    Returns the number of spots, tracks and edges.
+    '''
+    rng = np.random.default_rng(seed)
+    tracks = centrosomeTracks(n_pairs, n_noise, n_frames, (width * dx, height * dx, nz), rng)
+    spots = [] # (id, frame, x, y, z, track)
+    spot_id = 1000
+    for track_id, points in enumerate(tracks):
+        for point in points:
+            spots.append((spot_id,) + point + (track_id,))
+            spot_id += 1
+    for frame in np.arange(n_frames if n_free is None else n_free) % n_frames:
+        spots.append((spot_id, int(frame)) + tuple(rng.uniform(0, [width * dx, height * dx, nz])) + (-1,))
+        spot_id += 1
+
+    out = []
+    w = out.append
+    w('<?xml version="1.0" encoding="UTF-8"?>\n<TrackMate version="3.8.0">\n')
+    w('  <Log>Starting detection process using 4 threads.\nGeometry:\n')
+    w('  X =    0 - %4d, dx = %.5f\n  Y =    0 - %4d, dy = %.5f\n  Z =    0 - %4d, dz = 1.00000\n'
+      '  T =    0 - %4d, dt = %.2f\n' % (width - 1, dx, height - 1, dx, nz - 1, n_frames - 1, dt))
+    w('</Log>\n  <Model spatialunits="micron" timeunits="sec">\n    <FeatureDeclarations>\n')
+    for section, features in (('SpotFeatures', SPOT_FEATURES), ('EdgeFeatures', EDGE_FEATURES),
+                              ('TrackFeatures', TRACK_FEATURES)):
+        w('      <%s>\n' % section)
+        for name, isint in features:
+            w('        <Feature feature="%s" name="%s" shortname="%s" dimension="NONE" isint="%s" />\n'
+              % (name, name.title(), name.title(), 'true' if isint else 'false'))
+        w('      </%s>\n' % section)
+    w('    </FeatureDeclarations>\n    <AllSpots nspots="%d">\n' % len(spots))
+    by_frame = {}
+    for s in spots:
+        by_frame.setdefault(s[1], []).append(s)
+    for frame in sorted(by_frame):
+        w('      <SpotsInFrame frame="%d">\n' % frame)
+        for (spot_id, _, x, y, z, _) in by_frame[frame]:
+            values = {'QUALITY': rng.uniform(5, 30), 'POSITION_X': x, 'POSITION_Y': y, 'POSITION_Z': z,
+                      'POSITION_T': frame * dt, 'FRAME': frame, 'RADIUS': 1.25, 'VISIBILITY': 1,
+                      'MANUAL_COLOR': -10921639, 'MEAN_INTENSITY': rng.uniform(50, 80),
+                      'MEDIAN_INTENSITY': float(rng.integers(50, 80)), 'MIN_INTENSITY': float(rng.integers(0, 30)),
+                      'MAX_INTENSITY': float(rng.integers(100, 400)),
+                      'TOTAL_INTENSITY': float(rng.integers(1e4, 1e5)), 'STANDARD_DEVIATION': rng.uniform(5, 20),
+                      'ESTIMATED_DIAMETER': rng.uniform(2, 30), 'CONTRAST': rng.uniform(-0.1, 0.3),
+                      'SNR': rng.uniform(0, 1)}
+            w('        <Spot ID="%d" name="ID%d" %s />\n' % (spot_id, spot_id, ' '.join(
+                '%s="%s"' % (name, _attr(values[name])) for name, _ in SPOT_FEATURES)))
+        w('      </SpotsInFrame>\n')
+    w('    </AllSpots>\n    <AllTracks>\n')
+    by_track = {}
+    for (spot_id, frame, x, y, z, track_id) in spots:
+        if track_id >= 0:
+            by_track.setdefault(track_id, []).append((frame, spot_id, x, y, z))
+    n_edges = 0
+    for track_id in range(len(tracks)):
+        points = sorted(by_track[track_id])
+        frames = [p[0] for p in points]
+        n_gaps = sum(1 for a, b in zip(frames, frames[1:]) if b - a > 1)
+        mean = np.mean([p[2:] for p in points], axis=0)
+        w('      <Track name="Track_%d" TRACK_ID="%d" NUMBER_SPOTS="%d" NUMBER_GAPS="%d" TRACK_DURATION="%s" '
+          'TRACK_START="%s" TRACK_STOP="%s" TRACK_X_LOCATION="%s" TRACK_Y_LOCATION="%s" TRACK_Z_LOCATION="%s">\n'
+          % (track_id, track_id, len(points), n_gaps, _attr((frames[-1] - frames[0]) * dt),
+             _attr(frames[0] * dt), _attr(frames[-1] * dt), _attr(mean[0]), _attr(mean[1]), _attr(mean[2])))
+        for a, b in zip(points, points[1:]):
+            step = np.subtract(b[2:], a[2:])
+            w('        <Edge SPOT_SOURCE_ID="%d" SPOT_TARGET_ID="%d" LINK_COST="%s" EDGE_TIME="%s" '
+              'EDGE_X_LOCATION="%s" EDGE_Y_LOCATION="%s" EDGE_Z_LOCATION="%s" VELOCITY="%s" DISPLACEMENT="%s" />\n'
+              % (a[1], b[1], _attr(rng.uniform(0, 5)), _attr((a[0] + b[0]) / 2 * dt),
+                 _attr((a[2] + b[2]) / 2), _attr((a[3] + b[3]) / 2), _attr((a[4] + b[4]) / 2),
+                 _attr(np.linalg.norm(step) / ((b[0] - a[0]) * dt)), _attr(np.linalg.norm(step))))
+            n_edges += 1
+        w('      </Track>\n')
+    w('    </AllTracks>\n    <FilteredTracks>\n')
+    for track_id in range(len(tracks)):
+        w('      <TrackID TRACK_ID="%d" />\n' % track_id)
+    w('    </FilteredTracks>\n  </Model>\n  <Settings>\n')
+    w('    <ImageData filename="%s" folder="" width="%d" height="%d" nslices="%d" nframes="%d" pixelwidth="%s" '
+      'pixelheight="%s" voxeldepth="1.0" timeinterval="%s" />\n'
+      % (os.path.basename(xml_path)[:-len('.xml')] + '.tif', width, height, nz, n_frames, _attr(dx), _attr(dx),
+         _attr(dt)))
+    w('  </Settings>\n</TrackMate>\n')
+    with open(xml_path, 'w') as f:
+        f.write(''.join(out))
+    return len(spots), len(tracks), n_edges
+
+
+def driftMatrix(n_frames, max_step=3, seed=0):
+    '''
+    Integer (x, y) translation of every frame relative to the first, a
+        random walk of at most max_step pixels per frame, as roi2mat returns
+    '''
+    rng = np.random.default_rng(seed)
+    steps = rng.integers(-max_step, max_step + 1, size=(n_frames, 2))
+    steps[0] = 0
+    return [tuple(int(v) for v in row) for row in np.cumsum(steps, axis=0)]
+
+
+def makeMovie(n_frames=20, nz=10, height=256, width=256, n_channels=None, translation=None, n_blobs=50, seed=0):
+    '''
+    A uint16 movie, (t, z, y, x) or with n_channels (t, z, c, y, x): noise
+        and bright blobs, the content of frame t moved by translation[t] (as
+        the roi lines follow it), so registering it with translation
+        realigns the frames.
+    '''
+    rng = np.random.default_rng(seed)
+    shape = (nz,) + ((n_channels,) if n_channels else ()) + (height, width)
+    frame = rng.integers(90, 110, size=shape, dtype=np.uint16)
+    for z, y, x in zip(rng.integers(0, nz, n_blobs), rng.integers(2, height - 2, n_blobs),
+                       rng.integers(2, width - 2, n_blobs)):
+        frame[z, ..., y - 2:y + 3, x - 2:x + 3] += np.uint16(1000)
+    if translation is None:
+        translation = [(0, 0)] * n_frames
+    movie = np.empty((n_frames,) + shape, dtype=np.uint16)
+    for t in range(n_frames):
+        trans_x, trans_y = translation[t]
+        movie[t] = np.roll(frame, (trans_y, trans_x), axis=(-2, -1))
+    return movie
+
+
+def writeRoi(csv_path, translation, x0=300, y0=200):
+    '''
+    Writes a translation matrix as the roi csv of the Fiji registration tool,
+        one line roi per frame (see roi2mat)
+    '''
+    n = len(translation)
+    x = [x0 + tx for tx, _ in translation]
+    y = [y0 + ty for _, ty in translation]
+    pd.DataFrame({'Name': ['{:04d}-{:04d}-{:04d}'.format(t + 1, y[t], x[t]) for t in range(n)],
+                  'Type': 'Straight Line', 'Group': 'none', 'X': x, 'Y': y, 'Width': 4, 'Height': 31,
+                  'Points': 2, 'Color': 'none', 'Fill': 'none', 'LWidth': 0, 'Pos': np.arange(1, n + 1),
+                  'C': 0, 'Z': np.arange(1, n + 1), 'T': 0}).rename_axis('Index').to_csv(csv_path)
+
+
+def makeMovieFolder(root, movie_name, n_pairs=20, n_noise=30, n_frames=60, nz=10, height=256, width=256,
+                    n_channels=None, dt=30.0, dx=1.0, seed=0, movie=True):
+    '''
+    Makes root/<movie_name>/ with the movie, its roi and the TrackMate xml of
+        the registered movie. movie=False skips the tiff (pairing only needs
+        the xml and a registered tiff or its sidecar). The pixel size dx is 1
+        by default, the border filter of TrackPairer compares spot positions
+        with the crop borders in pixels.
+
+    Returns the translation matrix.
+    '''
+    folder = os.path.join(root, movie_name)
+    os.makedirs(os.path.join(folder, 'roi'), exist_ok=True)
+    translation = driftMatrix(n_frames, seed=seed)
+    writeRoi(os.path.join(folder, 'roi', '1.csv'), translation)
+    if movie:
+        data = makeMovie(n_frames, nz, height, width, n_channels, translation, seed=seed)
+        tifffile.imwrite(os.path.join(folder, movie_name + '.tif'), data, imagej=True,
+                         metadata={'axes': 'TZCYX' if n_channels else 'TZYX'})
+    makeTrackMateXML(os.path.join(folder, 'r_' + movie_name + '.xml'), n_pairs=n_pairs, n_noise=n_noise,
+                     n_frames=n_frames, dt=dt, dx=dx, width=width, height=height, nz=nz, seed=seed)
+    return translation
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Make a synthetic movie folder.')
+    parser.add_argument('root')
+    parser.add_argument('movie')
+    parser.add_argument('--pairs', type=int, default=20)
+    parser.add_argument('--noise', type=int, default=30, help='number of unpaired tracks')
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--slices', type=int, default=10)
+    parser.add_argument('--size', type=int, nargs=2, default=(256, 256), metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--channels', type=int, default=None, help='5D movie with this many channels')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    makeMovieFolder(args.root, args.movie, n_pairs=args.pairs, n_noise=args.noise, n_frames=args.frames,
+                    nz=args.slices, height=args.size[0], width=args.size[1], n_channels=args.channels,
+                    seed=args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Batch mode without the notebook: registers and/or pairs every movie folder
+    under root, on a pool of worker processes.
+
+    $ python src/batch.py ../data/ --stages register pair --workers 8
+
+The compare stage scores the pairs of every movie with several models, from
+    a single feature computation:
+
+    $ python src/batch.py ../data/ --stages compare --models src/model_archive/*.sav
+
+Movies go through the incremental pipeline of pipeline.py, so a rerun only
+    redoes the stages whose inputs or parameters changed, and an interrupted
+    batch picks up where it stopped (--force reruns everything).
+
+The folder layout is the one of notebooks/batchmode.ipynb, i.e.
+    root/<movie>/<movie>.tif, root/<movie>/roi/ (not needed with --drift
+    auto) and, for pairing, root/<movie>/r_<movie>.xml from TrackMate.
+'''
+
+import os
+import sys
+import time
+import argparse
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import pipeline
+
+
+STAGES = ('register', 'pair', 'compare')
+# stages of pipeline.py making up each batch stage
+PIPELINE_STAGES = {'register': ('register',),
+                   'pair': ('parse', 'features', 'classify', 'spots', 'coords'),
+                   'compare': ('parse', 'features', 'compare')}
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myModel.sav')
+
+
+def moviePaths(root, movie_name):
+    '''
+    Input and output paths of one movie, named as in the batch notebook
+    '''
+    folder = os.path.join(root, movie_name)
+    return {'tiff': os.path.join(folder, movie_name + '.tif'),
+            'xml': os.path.join(folder, 'r_' + movie_name + '.xml'),
+            'out_folder': folder,
+            'out_csv': os.path.join(folder, 'r_' + movie_name + '.txt'),
+            'out_coords': os.path.join(folder, 'r_' + movie_name + '_coords.txt'),
+            'out_cellid': os.path.join(folder, 'r_' + movie_name + '_cellIDs.txt'),
+            'out_spindle': os.path.join(folder, 'r_' + movie_name + '_spindle.txt'),
+            'log': os.path.join(folder, 'batch_log.txt')}
+
+
+def findMovies(root):
+    '''
+    All movie folders directly under root
+    '''
+    (_, movie_names, _) = next(os.walk(root))
+    return sorted(movie_names)
+
+
+def pipelineStages(stages):
+    # the pipeline.py stages of the batch stages, in order, each once
+    return [s for s in pipeline.STAGES if any(s in PIPELINE_STAGES[stage] for stage in stages)]
+
+
+def modelNames(model_paths):
+    '''
+    Model name (file name without extension) -> path, for the compare stage
+    '''
+    models = {}
+    for path in model_paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in models:
+            raise ValueError('two models named {}: {} and {}'.format(name, models[name], path))
+        models[name] = path
+    return models
+
+
+def jobSize(root, movie_name, stages):
+    # bytes read by the job, to schedule the largest movies first
+    paths = moviePaths(root, movie_name)
+    size = 0
+    if 'register' in stages and os.path.isfile(paths['tiff']):
+        size += os.path.getsize(paths['tiff'])
+    if ('pair' in stages or 'compare' in stages) and os.path.isfile(paths['xml']):
+        size += os.path.getsize(paths['xml'])
+    return size
+
+
+def _initWorker(model_path, worker=True):
+    # runs once per worker process: the classifier is unpickled once, not per movie
+    if worker:
+        # nobody can answer an input() prompt in a worker, fail instead of hanging
+        sys.stdin = open(os.devnull)
+    if model_path is not None:
+        pipeline.loadModel(model_path)
+
+
+def runMovie(root, movie_name, stages, params, model_path, force=False):
+    '''
+    Runs the stages of one movie that are out of date (see pipeline.runMovie).
+        Output of the stages goes to <movie>/batch_log.txt. An error in a
+        stage is recorded and the later stages of the movie are skipped, the
+        other movies are not affected.
+
+    Returns one report row (dict) per pipeline stage.
+    '''
+    paths = moviePaths(root, movie_name)
+    stages = pipelineStages(stages)
+    with open(paths['log'], 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            return pipeline.runMovie(root, movie_name, model_path, params, stages=stages, force=force)
+        except Exception as e: # e.g. the manifest could not be written
+            traceback.print_exc(file=log)
+            return _failedRows(movie_name, stages, e)
+
+
+def _failedRows(movie_name, stages, e):
+    return [{'movie': movie_name, 'stage': stage, 'status': 'failed', 'seconds': 0.0,
+             'error': '{}: {}'.format(type(e).__name__, e)} for stage in stages]
+
+
+def run_batch(root, stages=('register', 'pair'), workers=None, model_path=MODEL_PATH, movie_names=None,
+              pad=True, stream=False, maxdist=11, mindist=4, maxcongdist=4, minoverlap=10,
+              force=False, report_path=None, models=None, profile=False, debug_sample=0,
+              drift='roi', channel=None, codec=None, tile=None):
+    '''
+    Registers and/or pairs all movies under root on a pool of processes.
+        Stages that are up to date are not rerun, see pipeline.py.
+
+    - stages: any of 'register', 'pair' and 'compare', run in that order per movie
+    - workers: number of processes, default all cores. With workers=1 the
+        movies are processed in this process.
+    - model_path: pickled classifier for the pair stage, loaded once per worker
+    - movie_names: movies to process, default all folders under root
+    - pad, stream: see register
+    - drift, channel: 'roi' registers with the roi lines, 'auto' with the drift
+        estimated from the movie (on the given channel), see utils.estimateDrift
+    - codec, tile: lossless compression ('zlib' or 'lzma') and tile size of
+        the registered movies, default uncompressed strips
+    - maxdist, mindist, maxcongdist, minoverlap: see pair
+    - force: rerun the stages even if they are up to date
+    - report_path: csv with one row per movie and pipeline stage (status,
+        seconds, error), default root/batch_report.csv
+    - models: model paths for the compare stage, every movie's pairs are
+        scored by each of them (see utils.classifyModels)
+    - profile: save the time and memory of the stages that ran and the
+        number of track pairs each filter rejected in <movie>/profile.json
+    - debug_sample: fraction of the rejected track pairs listed in
+        <movie>/rejected_pairs.txt
+
+    Returns the report as a dataframe.
+    '''
+    if isinstance(stages, str):
+        stages = [stages]
+    if not stages or set(stages) - set(STAGES):
+        raise ValueError('stages must be any of {}, got {}'.format(STAGES, stages))
+    stages = [s for s in STAGES if s in stages]
+    if 'pair' in stages and not os.path.isfile(model_path):
+        raise FileNotFoundError(model_path)
+    models = modelNames(models or [])
+    if 'compare' in stages and not models:
+        raise ValueError('the compare stage needs models')
+    for path in models.values():
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+    if movie_names is None:
+        movie_names = findMovies(root)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if report_path is None:
+        report_path = os.path.join(root, 'batch_report.csv')
+    params = {'pad': pad, 'stream': stream, 'maxdist': maxdist, 'mindist': mindist,
+              'maxcongdist': maxcongdist, 'minoverlap': minoverlap, 'dim': None,
+              'models': models if 'compare' in stages else {},
+              'profile': profile, 'debug_sample': debug_sample, 'drift': drift, 'channel': channel,
+              'codec': codec, 'tile': tile}
+    model_path = model_path if 'pair' in stages else None
+    # largest movies first, so a big one does not start last and hold up the batch
+    jobs = sorted(movie_names, key=lambda m: jobSize(root, m, stages), reverse=True)
+    print('{} movies, stages: {}, workers: {}'.format(len(jobs), ', '.join(stages), workers))
+
+    results = {}
+    def done(movie_name, rows):
+        results[movie_name] = rows
+        statuses = [r['status'] for r in rows]
+        status = 'failed' if 'failed' in statuses else 'waiting' if 'waiting' in statuses else 'ok'
+        print('[{}/{}] {}: {}, {} of {} stages up to date ({:.1f} s)'.format(
+            len(results), len(jobs), movie_name, status, statuses.count('cached'), len(rows),
+            sum(r['seconds'] for r in rows)))
+
+    start = time.perf_counter()
+    if workers == 1:
+        _initWorker(model_path, worker=False)
+        for movie_name in jobs:
+            done(movie_name, runMovie(root, movie_name, stages, params, model_path, force))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(model_path,)) as pool:
+            futures = {pool.submit(runMovie, root, m, stages, params, model_path, force): m for m in jobs}
+            for future in as_completed(futures):
+                movie_name = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as e: # the worker itself died, e.g. out of memory
+                    rows = _failedRows(movie_name, pipelineStages(stages), e)
+                done(movie_name, rows)
+
+    report = pd.DataFrame([row for m in movie_names for row in results[m]],
+                          columns=['movie', 'stage', 'status', 'seconds', 'error'])
+    report.to_csv(report_path, index=False)
+    n_failed = report.loc[report['status'] == 'failed', 'movie'].nunique()
+    n_waiting = report.loc[report['status'] == 'waiting', 'movie'].nunique()
+    print('Done in {:.1f} s, {} of {} movies failed, {} waiting for input. Report saved in {}'.format(
+        time.perf_counter() - start, n_failed, len(movie_names), n_waiting, report_path))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Register and pair all movies under a folder.')
+    parser.add_argument('root', help='folder with one subfolder per movie')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=['register', 'pair'])
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, default all cores')
+    parser.add_argument('--model', default=MODEL_PATH, help='pickled classifier for the pair stage')
+    parser.add_argument('--movies', nargs='+', default=None, help='movies to process, default all')
+    parser.add_argument('--no-pad', dest='pad', action='store_false', help='crop instead of padding when registering')
+    parser.add_argument('--stream', action='store_true', help='register frame by frame, for movies larger than RAM')
+    parser.add_argument('--drift', choices=['roi', 'auto'], default='roi',
+                        help='register with the roi lines, or with the drift estimated from the movie')
+    parser.add_argument('--channel', type=int, default=None, help='channel the drift is estimated on, default all')
+    parser.add_argument('--codec', choices=['zlib', 'lzma'], default=None,
+                        help='compress the registered movies, default uncompressed')
+    parser.add_argument('--tile', type=int, default=None, help='write the registered movies in square tiles of this size')
+    parser.add_argument('--maxdist', type=float, default=11)
+    parser.add_argument('--mindist', type=float, default=4)
+    parser.add_argument('--maxcongdist', type=float, default=4)
+    parser.add_argument('--minoverlap', type=float, default=10)
+    parser.add_argument('--force', action='store_true', help='rerun stages even if they are up to date')
+    parser.add_argument('--report', default=None, help='report csv, default <root>/batch_report.csv')
+    parser.add_argument('--models', nargs='+', default=None, help='pickled classifiers for the compare stage')
+    parser.add_argument('--profile', action='store_true', help='save stage times, memory and filter counts in <movie>/profile.json')
+    parser.add_argument('--debug-sample', type=float, default=0,
+                        help='fraction of the rejected track pairs listed in <movie>/rejected_pairs.txt')
+    args = parser.parse_args(argv)
+    report = run_batch(args.root, stages=args.stages, workers=args.workers, model_path=args.model,
+                       movie_names=args.movies, pad=args.pad, stream=args.stream,
+                       maxdist=args.maxdist, mindist=args.mindist, maxcongdist=args.maxcongdist,
+                       minoverlap=args.minoverlap, force=args.force, report_path=args.report,
+                       models=args.models, profile=args.profile, debug_sample=args.debug_sample,
+                       drift=args.drift, channel=args.channel, codec=args.codec, tile=args.tile)
+    return int((report['status'] == 'failed').any())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
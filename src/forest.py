@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Random forest pair classifiers (myModel.sav, model_archive/*.sav) as flat
+    node arrays, predicting without sklearn.
+
+    $ python src/forest.py src/myModel.sav src/model_archive/*.sav
+
+writes <model>.sav.npz next to every pickle. loadForest(<model>.sav) uses
+    that file (or writes it on first use), memory-mapped, so a worker starts
+    in milliseconds whatever the installed sklearn version is.
+
+All nodes of all trees are stored in one set of arrays (feature, threshold,
+    left, right, proba), trees one after the other, leaves pointing to
+    themselves. Predictions are those of RandomForestClassifier.predict:
+    X as float32, per tree leaf class probabilities, averaged over trees in
+    tree order, first class of highest probability.
+'''
+
+import os
+import sys
+import json
+import pickle
+import zipfile
+import numpy as np
+from utils import fileHash
+
+
+ARRAYS = ('feature', 'threshold', 'left', 'right', 'proba', 'roots', 'classes')
+
+
+class _Pickled(object):
+    '''
+    Stand-in for the sklearn classes of a pickle, keeps the constructor
+        arguments and the state, so a forest can be read without sklearn
+    '''
+    args = ()
+    state = None
+
+    def __init__(self, *args):
+        self.args = args
+
+    def __setstate__(self, state):
+        self.state = state
+
+
+class _ForestUnpickler(pickle.Unpickler):
+    def __init__(self, f):
+        super().__init__(f)
+        self._stubs = {}
+
+    def find_class(self, module, name):
+        if module.split('.')[0] == 'sklearn':
+            key = (module, name)
+            if key not in self._stubs:
+                self._stubs[key] = type(name, (_Pickled,), {'module': module})
+            return self._stubs[key]
+        if module.startswith('numpy.core') and hasattr(np, '_core'): # pickled with numpy < 2
+            module = 'numpy._core' + module[len('numpy.core'):]
+        return super().find_class(module, name)
+
+
+def readForestPickle(model_path):
+    '''
+    Reads a pickled RandomForestClassifier without importing sklearn, the
+        estimator and its trees come back as _Pickled objects
+    '''
+    with open(model_path, 'rb') as f:
+        return _ForestUnpickler(f).load()
+
+
+def _treeArrays(tree):
+    # (nodes, values, max_depth) of a fitted sklearn Tree or a pickled one
+    if isinstance(tree, _Pickled):
+        return tree.state['nodes'], tree.state['values'], tree.state['max_depth']
+    return ({'left_child': tree.children_left, 'right_child': tree.children_right,
+             'feature': tree.feature, 'threshold': tree.threshold}, tree.value, tree.max_depth)
+
+
+class Forest(object):
+    '''
+    A random forest classifier as flat node arrays.
+
+    - feature, threshold, left, right: per node, the test X[feature] <= threshold
+        sends a sample to node left, else to node right. Leaves point to themselves.
+    - proba: per node, the class probabilities of a leaf
+    - roots: the root node of every tree
+    - classes: class labels, as classes_ of the sklearn model
+    '''
+    def __init__(self, feature, threshold, left, right, proba, roots, classes, max_depth, n_features):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.proba = proba
+        self.roots = roots
+        self.classes = classes
+        self.classes_ = classes
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+        self.source = None # file state of the pickle, see exportForest
+
+    @classmethod
+    def fromModel(cls, model):
+        '''
+        Converts a fitted RandomForestClassifier, or one read with
+            readForestPickle, with a single output
+        '''
+        state = model.state if isinstance(model, _Pickled) else model.__dict__
+        if (type(model).__name__ not in ('RandomForestClassifier', 'ExtraTreesClassifier')
+                or 'estimators_' not in state or state.get('n_outputs_', 1) != 1):
+            raise ValueError('not a fitted single output random forest classifier')
+        classes = np.asarray(state['classes_'])
+        n_classes = len(classes)
+        feature, threshold, left, right, proba, roots = [], [], [], [], [], []
+        max_depth = 0
+        n_nodes = 0
+        for estimator in state['estimators_']:
+            tree = (estimator.state if isinstance(estimator, _Pickled) else estimator.__dict__)['tree_']
+            nodes, values, depth = _treeArrays(tree)
+            n = len(nodes['feature'])
+            leaf = np.asarray(nodes['left_child']) < 0
+            own = np.arange(n_nodes, n_nodes + n, dtype=np.int32)
+            feature.append(np.where(leaf, 0, nodes['feature']).astype(np.int32))
+            threshold.append(np.asarray(nodes['threshold'], dtype=np.float64))
+            left.append(np.where(leaf, own, np.asarray(nodes['left_child']) + n_nodes).astype(np.int32))
+            right.append(np.where(leaf, own, np.asarray(nodes['right_child']) + n_nodes).astype(np.int32))
+            # as DecisionTreeClassifier.predict_proba
+            p = np.array(values, dtype=np.float64).reshape(n, -1)[:, :n_classes]
+            normalizer = p.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            proba.append(p / normalizer)
+            roots.append(n_nodes)
+            max_depth = max(max_depth, int(depth))
+            n_nodes += n
+        return cls(np.concatenate(feature), np.concatenate(threshold), np.concatenate(left),
+                   np.concatenate(right), np.concatenate(proba), np.array(roots, dtype=np.int32),
+                   classes, max_depth, state['n_features_in_'] if 'n_features_in_' in state else state['n_features_'])
+
+    def predict_proba(self, X, chunk_size=1 << 14):
+        '''
+        Mean class probabilities over the trees, all trees evaluated on a
+            chunk of samples at once
+        '''
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError('X has shape {}, the model expects {} features'.format(X.shape, self.n_features))
+        if not np.isfinite(X).all():
+            raise ValueError('X contains NaN or infinity')
+        out = np.zeros((len(X), len(self.classes)))
+        for start in range(0, len(X), chunk_size):
+            chunk = X[start:start + chunk_size]
+            samples = np.arange(len(chunk))
+            node = np.repeat(self.roots[:, np.newaxis], len(chunk), axis=1)
+            for _ in range(self.max_depth):
+                go_left = chunk[samples, self.feature[node]] <= self.threshold[node]
+                node = np.where(go_left, self.left[node], self.right[node])
+            # sum in tree order, as the forest does
+            total = out[start:start + len(chunk)]
+            for leaves in node:
+                total += self.proba[leaves]
+        out /= len(self.roots)
+        return out
+
+    def predict(self, X):
+        return self.classes.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+    def save(self, path, source=None):
+        '''
+        Saves the arrays as an uncompressed npz, so load can memory-map them
+        '''
+        meta = {'max_depth': self.max_depth, 'n_features': self.n_features, 'source': source}
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **{name: getattr(self, name) for name in ARRAYS})
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Loads a forest saved by save, the arrays memory-mapped with mmap=True
+        '''
+        with np.load(path) as npz:
+            meta = json.loads(str(npz['meta'][()]))
+            arrays = _mmapNpz(path) if mmap else {name: npz[name] for name in ARRAYS}
+        forest = cls(*[arrays[name] for name in ARRAYS], meta['max_depth'], meta['n_features'])
+        forest.source = meta['source']
+        return forest
+
+
+def _mmapNpz(path):
+    # memory-maps the members of an uncompressed npz, np.load would read them
+    arrays = {}
+    with zipfile.ZipFile(path) as z, open(path, 'rb') as f:
+        for info in z.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED or name == 'meta':
+                continue
+            # local file header: 30 bytes, then name and extra field
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                     order='F' if fortran else 'C')
+    return arrays
+
+
+def forestSidecar(model_path):
+    return model_path + '.npz'
+
+
+def exportForest(model_path, out_path=None):
+    '''
+    Converts a pickled random forest to the Forest format, saved in out_path
+        (default <model>.sav.npz). Returns the forest.
+    '''
+    st = os.stat(model_path)
+    forest = Forest.fromModel(readForestPickle(model_path))
+    forest.source = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': fileHash(model_path)}
+    forest.save(out_path or forestSidecar(model_path), source=forest.source)
+    return forest
+
+
+def loadForest(model_path):
+    '''
+    Returns the Forest of a pickled random forest, from its sidecar when it
+        matches the pickle (size and mtime, or sha1), else exported first.
+        A .npz model_path is a forest saved without its pickle.
+    '''
+    if model_path.endswith('.npz'):
+        return Forest.load(model_path)
+    sidecar = forestSidecar(model_path)
+    st = os.stat(model_path)
+    try:
+        forest = Forest.load(sidecar)
+        source = forest.source or {}
+        if source.get('size') == st.st_size and (source.get('mtime_ns') == st.st_mtime_ns
+                                                  or source.get('sha1') == fileHash(model_path)):
+            return forest
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+    try:
+        return exportForest(model_path)
+    except OSError as e: # e.g. read-only model folder, use the forest without sidecar
+        print('Could not save the forest of {}: {}'.format(model_path, e))
+        return Forest.fromModel(readForestPickle(model_path))
+
+
+if __name__ == '__main__':
+    for model_path in sys.argv[1:]:
+        forest = exportForest(model_path)
+        print('{}: {} trees, {} nodes -> {}'.format(model_path, len(forest.roots), len(forest.feature),
+                                                   forestSidecar(model_path)))
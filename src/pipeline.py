@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Incremental pipeline of one movie folder:
+
+    register -> parse -> features -> classify -> spots -> coords
+                                  \-> compare (optional, several models)
+
+Every stage records the content hashes (sha1) of its input files, its
+    parameters and the hashes of its output files in <movie>/pipeline.json.
+    A stage is rerun only when one of these changed or an output is missing,
+    so changing the model only reruns classify and what follows, and an
+    interrupted batch resumes at the first stage that did not finish.
+
+Files are only rehashed when their size or mtime changed since the manifest
+    was written.
+
+With params['profile'] the stages that run are timed (see utils.Profiler)
+    and the report is saved in <movie>/profile.json.
+'''
+
+import os
+import sys
+import json
+import time
+import glob
+import pickle
+import traceback
+from collections import OrderedDict
+from utils import (fileHash, register_movie, TrackMateModel, TrackPairer, Profiler,
+                   findPairs, classifyPairs, classifyModels, spots2coords)
+from forest import loadForest
+
+
+STAGES = ('register', 'parse', 'features', 'classify', 'spots', 'coords', 'compare')
+MANIFEST = 'pipeline.json'
+_models = {} # model path -> (size, mtime_ns, classifier), see loadModel
+
+
+def loadModel(model_path):
+    '''
+    Loads a pickled classifier, once per process as long as the file is
+        unchanged. Random forests are loaded as a Forest (see forest.py),
+        other classifiers are unpickled.
+    '''
+    st = os.stat(model_path)
+    key = os.path.abspath(model_path)
+    if key not in _models or _models[key][:2] != (st.st_size, st.st_mtime_ns):
+        try:
+            model = loadForest(model_path)
+        except (ValueError, KeyError, AttributeError, pickle.UnpicklingError): # not a random forest
+            with open(model_path, 'rb') as f:
+                model = pickle.load(f)
+        _models[key] = (st.st_size, st.st_mtime_ns, model)
+    return _models[key][2]
+
+
+def movieStages(root, movie_name, model_path, params, profiler=None):
+    '''
+    The stage graph of one movie: for every stage its input files, parameters,
+        output files and the function running it. Paths are as in the batch
+        notebook. With params['models'] (name -> model path) a compare stage
+        scores the pairs with every model, see classifyModels. The pairing
+        stages report to profiler.
+    '''
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    def timed(stage, run):
+        def wrapped():
+            with profiler.stage(stage):
+                return run()
+        return wrapped
+    folder = os.path.join(root, movie_name)
+    tiff = os.path.join(folder, movie_name + '.tif')
+    r_tiff = os.path.join(folder, 'r_' + movie_name + '.tif')
+    xml = os.path.join(folder, 'r_' + movie_name + '.xml')
+    out_csv = os.path.join(folder, 'r_' + movie_name + '.txt')
+    out_coords = os.path.join(folder, 'r_' + movie_name + '_coords.txt')
+    out_cellid = os.path.join(folder, 'r_' + movie_name + '_cellIDs.txt')
+    out_spindle = os.path.join(folder, 'r_' + movie_name + '_spindle.txt')
+    features = os.path.join(folder, 'features.csv')
+    predictions = os.path.join(folder, 'predictions.csv')
+    rois = sorted(glob.glob(os.path.join(folder, 'roi', '*')))
+    drift = params.get('drift', 'roi')
+    # the roi lines, or the drift estimated from the movie
+    register_params = {'pad': params['pad']}
+    if drift != 'roi':
+        register_params.update(drift=drift, channel=params.get('channel'))
+    # only when set, so movies registered before these options stay up to date
+    register_params.update({k: params[k] for k in ('codec', 'tile') if params.get(k) is not None})
+    pair_params = {k: params[k] for k in ('maxdist', 'mindist', 'maxcongdist', 'minoverlap', 'dim')}
+    models = params.get('models') or {}
+    graph = OrderedDict([
+        ('register', {
+            'inputs': [tiff] + (rois if drift == 'roi' else []),
+            'params': register_params,
+            'outputs': [r_tiff, r_tiff + '.json'] + ([os.path.join(folder, 'drift.csv')] if drift != 'roi' else []),
+            'run': lambda: register_movie(os.path.join(root, ''), movie_name, pad=params['pad'],
+                                          stream=params['stream'], drift=drift, channel=params.get('channel'),
+                                          codec=params.get('codec'), tile=params.get('tile'))}),
+        ('parse', {
+            'inputs': [xml],
+            'params': {},
+            'outputs': [TrackMateModel.sidecar(xml)],
+            'run': timed('parse', lambda: TrackMateModel.load(xml))}),
+        ('features', {
+            # the crop borders are those of the registered movie (its sidecar),
+            # so registering again invalidates the features and what follows
+            'inputs': [xml, r_tiff, r_tiff + '.json'],
+            'params': pair_params,
+            'outputs': [features, os.path.join(folder, 'console.txt')],
+            'run': lambda: findPairs(xml, r_tiff, folder, profiler=profiler, **pair_params)}),
+        ('classify', {
+            'inputs': [features, model_path],
+            'params': {},
+            'outputs': [predictions],
+            'run': lambda: classifyPairs(loadModel(model_path), folder, profiler=profiler)}),
+        ('spots', {
+            'inputs': [predictions, xml],
+            'params': {},
+            'outputs': [out_csv],
+            'run': lambda: TrackPairer(xml, profiler=profiler).pred2SpotCSV(xml, folder, out_csv)}),
+        ('coords', {
+            'inputs': [out_csv],
+            'params': {},
+            'outputs': [out_coords, out_cellid, out_spindle],
+            'run': timed('output', lambda: spots2coords(out_csv, out_coords, out_cellid, out_spindle))})])
+    if models:
+        graph['compare'] = {
+            'inputs': [features] + list(models.values()),
+            'params': {'models': list(models)},
+            'outputs': [os.path.join(folder, 'predictions_models.csv'), os.path.join(folder, 'model_agreement.csv')],
+            'run': lambda: classifyModels({name: loadModel(path) for name, path in models.items()}, folder)}
+    return graph
+
+
+def readManifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def writeManifest(folder, manifest):
+    # write then rename, an interrupted write never leaves a broken manifest
+    path = os.path.join(folder, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def fileState(path, recorded=None):
+    '''
+    {'size', 'mtime_ns', 'sha1'} of a file, None if it does not exist. The
+        sha1 of recorded is reused when size and mtime did not change.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if recorded and (recorded['size'], recorded['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+        return recorded
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': fileHash(path)}
+
+
+def _states(folder, paths, known):
+    # path relative to the movie folder (absolute outside of it) -> fileState,
+    # known holds the states already hashed, by absolute path
+    states = OrderedDict()
+    for path in paths:
+        key = os.path.relpath(path, folder)
+        if key.startswith(os.pardir):
+            key = os.path.abspath(path)
+        state = fileState(path, known.get(os.path.abspath(path)))
+        known[os.path.abspath(path)] = state
+        states[key] = state
+    return states
+
+
+def _sameHashes(a, b):
+    return a.keys() == b.keys() and all(a[k] is not None and b[k] is not None and a[k]['sha1'] == b[k]['sha1']
+                                        for k in a)
+
+
+def runMovie(root, movie_name, model_path, params, stages=STAGES, force=False):
+    '''
+    Runs the stages of one movie that are out of date, in order. An error in
+        a stage is printed, recorded and the later stages are skipped.
+
+    - stages: the stages to run, the others are neither run nor checked
+    - force: rerun the stages even if they are up to date
+    - params: see movieStages, plus 'profile' (save profile.json) and
+        'debug_sample' (fraction of the rejected track pairs listed in
+        rejected_pairs.txt), neither of which makes a stage rerun
+
+    Returns one report row (dict) per stage, status one of 'ok' (ran),
+        'cached' (up to date), 'waiting' (an input file does not exist yet,
+        e.g. no TrackMate xml), 'failed' (an error, or an output it did not
+        write) or 'skipped' (after a failed stage).
+    '''
+    folder = os.path.join(root, movie_name)
+    debug_sample = params.get('debug_sample') or 0
+    profiler = Profiler(movie=movie_name, enabled=bool(params.get('profile')), sample=debug_sample,
+                        debug_path=os.path.join(folder, 'rejected_pairs.txt') if debug_sample else None)
+    graph = movieStages(root, movie_name, model_path, params, profiler)
+    manifest = readManifest(folder)
+    # recorded states by absolute path, so every file is hashed at most once
+    known = {}
+    for record in manifest.values():
+        for key, state in list(record.get('inputs', {}).items()) + list(record.get('outputs', {}).items()):
+            if state is not None:
+                known[os.path.abspath(os.path.join(folder, key))] = state
+    rows = []
+    blocked = None
+    for name, stage in graph.items():
+        if name not in stages:
+            continue
+        row = {'movie': movie_name, 'stage': name, 'status': 'cached', 'seconds': 0.0, 'error': ''}
+        rows.append(row)
+        if blocked is not None:
+            row['status'] = 'skipped'
+            continue
+        record = manifest.get(name, {})
+        inputs = _states(folder, stage['inputs'], known)
+        missing = [k for k, v in inputs.items() if v is None]
+        if missing:
+            row['status'] = blocked = 'waiting'
+            row['error'] = 'missing ' + ', '.join(missing)
+            continue
+        params_json = json.loads(json.dumps(stage['params']))
+        if (not force and record and record.get('params') == params_json
+                and _sameHashes(inputs, record['inputs'])
+                and _sameHashes(_states(folder, stage['outputs'], known), record['outputs'])):
+            continue
+        # the stage reruns, its old record is invalid until it finishes
+        if manifest.pop(name, None) is not None:
+            writeManifest(folder, manifest)
+        start = time.perf_counter()
+        try:
+            stage['run']()
+        except Exception as e:
+            row['status'] = blocked = 'failed'
+            row['error'] = '{}: {}'.format(type(e).__name__, e)
+            traceback.print_exc(file=sys.stdout)
+        row['seconds'] = time.perf_counter() - start
+        if blocked is None:
+            for path in stage['outputs']: # rewritten, hash again
+                known.pop(os.path.abspath(path), None)
+            outputs = _states(folder, stage['outputs'], known)
+            missing = [k for k, v in outputs.items() if v is None]
+            if missing: # ran without error but did not write everything
+                row['status'] = blocked = 'failed'
+                row['error'] = 'did not write ' + ', '.join(missing)
+                continue
+            row['status'] = 'ok'
+            manifest[name] = {'inputs': inputs, 'params': params_json,
+                              'outputs': outputs, 'seconds': row['seconds']}
+            writeManifest(folder, manifest)
+    profiler.close()
+    if profiler.enabled and profiler.stages:
+        profiler.save(os.path.join(folder, 'profile.json'))
+    return rows
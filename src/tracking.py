@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Tracking without Fiji: the LoG detector (module 2, step 6) and the simple LAP
+    tracker (step 8) of TrackMate on (t, z, [c], y, x) movies, frames on a
+    pool of threads.
+
+    $ python src/tracking.py ../data/movie/r_movie.tif --radius 1.25 --threshold 5 --channel 1
+    $ python src/tracking.py ../data/movie/r_movie.tif --radius 1.25 --threshold 5 --max-distance 2 --gap-distance 2
+
+detectSpots gives one row per spot with the spot features of a TrackMate xml
+    (POSITION_X/Y/Z in calibrated units, FRAME, QUALITY, ESTIMATED_DIAMETER,
+    MAX_INTENSITY, CONTRAST, SNR...), ready for the spot table of the pairer
+    (utils.spotTable) and the spots csv (utils.SPOT_COLUMNS).
+
+As in TrackMate, each frame is filtered with a Laplacian of Gaussian of
+    sigma = radius / sqrt(n_dim) (in calibrated units, so anisotropic in
+    pixels), the spots are the local maxima of the filtered frame above
+    threshold, localized to subpixel precision by a quadratic fit. QUALITY is
+    the scale-normalized filter response, so thresholds are close to, not
+    the same as, those of TrackMate.
+
+linkSpots links the spots into the track and edge tables of a TrackMate xml
+    (utils.parseTracks), and trackMovie does both and returns the
+    TrackMateModel, which the pairer takes in place of the xml path:
+
+    model = trackMovie('r_movie.tif', 1.25, 5, max_distance=2, gap_distance=2)
+    pair(clf, model, 'r_movie.tif', out_folder, csv_path)
+'''
+
+import os
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import ndimage, sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+try:
+    import tifffile
+except ImportError:
+    from skimage.external import tifffile
+from utils import TrackMateModel, RegisteredStack, PlaneStore, hyperstackInfo, _iterTiffFrames, _tiffFrames
+
+
+# TrackMate spot features, in the order of a TrackMate xml
+SPOT_FEATURES = ['QUALITY', 'POSITION_X', 'POSITION_Y', 'POSITION_Z', 'POSITION_T', 'FRAME', 'RADIUS',
+                 'VISIBILITY', 'MANUAL_COLOR', 'MEAN_INTENSITY', 'MEDIAN_INTENSITY', 'MIN_INTENSITY',
+                 'MAX_INTENSITY', 'TOTAL_INTENSITY', 'STANDARD_DEVIATION', 'ESTIMATED_DIAMETER', 'CONTRAST', 'SNR']
+INT_FEATURES = ('FRAME', 'VISIBILITY')
+N_DIAMETERS = 20 # radii tried by the diameter estimate
+
+
+def movieCalibration(tiff_path):
+    '''
+    (dx, dy, dz) voxel size and dt frame interval of a tiff, from its
+        resolution tags and ImageJ metadata (see utils.hyperstackInfo), 1
+        where the tiff does not say
+    '''
+    if isinstance(tiff_path, RegisteredStack):
+        tiff_path = tiff_path.tiff_path
+    if os.path.isdir(tiff_path): # a PlaneStore has no calibration
+        return (1.0, 1.0, 1.0), 1.0
+    with tifffile.TiffFile(tiff_path) as tif:
+        info = hyperstackInfo(tif)
+    dx = dy = 1.0
+    if 'resolution' in info:
+        # pixels per unit, as a rational
+        (xn, xd), (yn, yd) = [r if isinstance(r, tuple) else (r, 1) for r in info['resolution']]
+        if xn and yn:
+            dx, dy = xd / xn, yd / yn
+    dz = float(info['metadata'].get('spacing', 1.0))
+    dt = float(info['metadata'].get('finterval', 1.0))
+    return (float(dx), float(dy), dz), dt
+
+
+def _ballOffsets(radius, calibration, n_dim):
+    # voxel offsets (z, y, x) within 2 * radius of the center, and their
+    # calibrated distances
+    spacing = np.array([calibration[2], calibration[1], calibration[0]], dtype=np.float64)
+    if n_dim == 2: # a single plane
+        spacing[0] = 0
+    reach = [int(np.ceil(2 * radius / s)) if s else 0 for s in spacing]
+    grid = np.stack(np.meshgrid(*[np.arange(-r, r + 1) for r in reach], indexing='ij'), axis=-1).reshape(-1, 3)
+    dist = np.sqrt(((grid * spacing) ** 2).sum(axis=1))
+    keep = dist <= 2 * radius
+    return grid[keep], dist[keep]
+
+
+def logFilter(plane, radius, calibration):
+    '''
+    Scale-normalized negative Laplacian of Gaussian of a (z, y, x) stack,
+        sigma = radius / sqrt(n_dim) in calibrated units. Bright blobs of
+        radius give positive maxima. A single plane is filtered in 2D.
+    '''
+    plane = np.asarray(plane, dtype=np.float32)
+    n_dim = 3 if plane.shape[0] > 1 else 2
+    sigma = radius / np.sqrt(n_dim)
+    spacing = (calibration[2], calibration[1], calibration[0])
+    sigmas = [sigma / s for s in spacing]
+    if n_dim == 2:
+        sigmas[0] = 0
+    out = np.zeros(plane.shape, dtype=np.float32)
+    for axis in range(3 - n_dim, 3):
+        order = [0, 0, 0]
+        order[axis] = 2
+        out -= ndimage.gaussian_filter(plane, sigmas, order=order, mode='nearest') / spacing[axis] ** 2
+    return out * sigma ** 2
+
+
+def _subpixel(quality, peaks):
+    # quadratic fit of the quality around every peak, per axis, in pixels
+    offsets = np.zeros(peaks.shape, dtype=np.float64)
+    center = quality[tuple(peaks.T)]
+    for axis in range(3):
+        n = quality.shape[axis]
+        if n < 3:
+            continue
+        lo, hi = peaks.copy(), peaks.copy()
+        lo[:, axis] = np.maximum(peaks[:, axis] - 1, 0)
+        hi[:, axis] = np.minimum(peaks[:, axis] + 1, n - 1)
+        before, after = quality[tuple(lo.T)], quality[tuple(hi.T)]
+        curvature = before - 2 * center + after
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shift = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0)
+        inside = (peaks[:, axis] > 0) & (peaks[:, axis] < n - 1)
+        offsets[:, axis] = np.where(inside, np.clip(shift, -0.5, 0.5), 0)
+    return peaks + offsets
+
+
+def _spotFeatures(image, peaks, radius, calibration):
+    '''
+    Intensity features of the spots at integer voxels peaks of image, as
+        TrackMate: statistics of the voxels within radius, contrast and SNR
+        against the shell between radius and 2 * radius, and the estimated
+        diameter (the radius between N_DIAMETERS shells of largest drop of
+        mean intensity).
+    '''
+    n_dim = 3 if image.shape[0] > 1 else 2
+    offsets, dist = _ballOffsets(radius, calibration, n_dim)
+    voxels = peaks[:, None, :] + offsets[None, :, :]
+    valid = np.all((voxels >= 0) & (voxels < np.array(image.shape)), axis=2)
+    values = image[tuple(np.clip(voxels, 0, np.array(image.shape) - 1).transpose(2, 0, 1))].astype(np.float64)
+    inner = valid & (dist <= radius)
+    outer = valid & (dist > radius)
+    def masked(mask, reduce, fill=np.nan):
+        return reduce(np.where(mask, values, fill), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n_in = inner.sum(axis=1)
+        total = masked(inner, np.sum, 0)
+        mean_in = total / n_in
+        std_in = np.sqrt(np.where(inner, (values - mean_in[:, None]) ** 2, 0).sum(axis=1) / np.maximum(n_in - 1, 1))
+        mean_out = masked(outer, np.sum, 0) / outer.sum(axis=1)
+        contrast = (mean_in - mean_out) / (mean_in + mean_out)
+        snr = (mean_in - mean_out) / std_in
+        # diameter estimate, mean intensity of concentric shells
+        radii = np.linspace(0.5 * radius, 2 * radius, N_DIAMETERS)
+        shell = np.searchsorted(radii, dist, side='right') - 1
+        shells = np.stack([np.where(valid & (shell == k), values, 0).sum(axis=1)
+                           / (valid & (shell == k)).sum(axis=1) for k in range(N_DIAMETERS - 1)], axis=1)
+        drop = shells[:, :-1] - shells[:, 1:]
+        best = np.argmax(np.nan_to_num(drop, nan=-np.inf), axis=1)
+    return {'MEAN_INTENSITY': mean_in,
+            'MEDIAN_INTENSITY': masked(inner, np.nanmedian),
+            'MIN_INTENSITY': masked(inner, np.nanmin),
+            'MAX_INTENSITY': masked(inner, np.nanmax),
+            'TOTAL_INTENSITY': total,
+            'STANDARD_DEVIATION': std_in,
+            'ESTIMATED_DIAMETER': 2 * radii[best + 1],
+            'CONTRAST': contrast,
+            'SNR': snr}
+
+
+def detectFrame(frame, radius, threshold, calibration=(1.0, 1.0, 1.0), channel=None, median_filter=False,
+                subpixel=True):
+    '''
+    Spots of one timepoint, a (z, y, x) or (z, c, y, x) array, as a dict of
+        feature arrays (see SPOT_FEATURES, without FRAME, POSITION_T and the
+        ids), in decreasing quality
+
+    - radius: expected spot radius, in calibrated units (the estimated blob
+        diameter of TrackMate is 2 * radius)
+    - threshold: minimum quality
+    - calibration: (dx, dy, dz) voxel size
+    - channel: channel of the centrosomes in a 5D movie, default the first
+    - median_filter: 3x3 median filter of every plane first, as TrackMate's option
+    '''
+    frame = np.asarray(frame)
+    if frame.ndim == 4:
+        frame = frame[:, channel or 0]
+    image = frame
+    if median_filter:
+        image = ndimage.median_filter(image, size=(1, 3, 3))
+    quality = logFilter(image, radius, calibration)
+    local_max = ndimage.maximum_filter(quality, size=3, mode='nearest') == quality
+    peaks = np.argwhere(local_max & (quality > threshold))
+    order = np.argsort(-quality[tuple(peaks.T)], kind='stable')
+    peaks = peaks[order]
+    position = _subpixel(quality, peaks) if subpixel else peaks.astype(np.float64)
+    spots = {'QUALITY': quality[tuple(peaks.T)].astype(np.float64),
+             'POSITION_X': position[:, 2] * calibration[0],
+             'POSITION_Y': position[:, 1] * calibration[1],
+             'POSITION_Z': position[:, 0] * calibration[2],
+             'RADIUS': np.full(len(peaks), float(radius)),
+             'VISIBILITY': np.ones(len(peaks), dtype=np.int64),
+             'MANUAL_COLOR': np.full(len(peaks), np.nan)}
+    spots.update(_spotFeatures(frame, peaks, radius, calibration))
+    return spots
+
+
+def detectSpots(movie, radius, threshold, calibration=None, framerate=None, channel=None, median_filter=False,
+                subpixel=True, workers=None):
+    '''
+    Runs the LoG detector on every timepoint of a movie, workers threads
+        (default one per core) each on a timepoint, a few timepoints read
+        ahead at a time.
+
+    - movie: tiff path (registered or not), PlaneStore folder,
+        utils.RegisteredStack, or a (t, z, [c], y, x) array
+    - calibration, framerate: voxel size (dx, dy, dz) and frame interval,
+        default those of the tiff (see movieCalibration)
+    - radius, threshold, channel, median_filter, subpixel: see detectFrame
+
+    Returns the spots as a dataframe with the columns and dtypes of the spots
+        of a TrackMate xml (TrackMateModel.spots): SPOT_FEATURES, ID and name,
+        IDs numbered in frame and quality order.
+    '''
+    if isinstance(movie, np.ndarray):
+        frames = iter(movie)
+    else:
+        if calibration is None or framerate is None:
+            cal, dt = movieCalibration(movie)
+            calibration = calibration or cal
+            framerate = framerate or dt
+        frames = _iterTiffFrames(movie)
+    calibration = tuple(float(c) for c in (calibration or (1.0, 1.0, 1.0)))
+    framerate = float(framerate or 1.0)
+    workers = workers or os.cpu_count() or 1
+    detect = lambda frame: detectFrame(frame, radius, threshold, calibration=calibration, channel=channel,
+                                       median_filter=median_filter, subpixel=subpixel)
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            chunk = [frame for _, frame in zip(range(2 * workers), frames)]
+            if not chunk:
+                break
+            results.extend(pool.map(detect, chunk))
+    counts = [len(r['QUALITY']) for r in results]
+    spots = pd.DataFrame({name: np.concatenate([r[name] for r in results]) if results else np.zeros(0)
+                          for name in results[0]} if results else {})
+    spots['FRAME'] = np.repeat(np.arange(len(results), dtype=np.int64), counts)
+    spots['POSITION_T'] = spots['FRAME'] * framerate
+    for name in SPOT_FEATURES:
+        if name not in spots:
+            spots[name] = np.zeros(len(spots))
+        spots[name] = spots[name].astype(np.int64 if name in INT_FEATURES else np.float64)
+    spots = spots[SPOT_FEATURES]
+    spots['ID'] = np.arange(len(spots), dtype=np.int64)
+    spots['name'] = np.array(['ID' + str(i) for i in spots['ID']], dtype=object)
+    return spots
+
+
+def spotModel(spots, shape, calibration=(1.0, 1.0, 1.0), framerate=1.0):
+    '''
+    TrackMateModel of detected spots, without tracks or edges yet
+    - shape: (t, z, [c], y, x) shape of the movie, for the geometry
+    '''
+    tracks = pd.DataFrame({'TRACK_ID': np.zeros(0, dtype=np.int64)})
+    edges = pd.DataFrame({'TRACK_ID': np.zeros(0, dtype=np.int64)})
+    geometry = (shape[-1] - 1, shape[-2] - 1, shape[1] - 1, shape[0] - 1)
+    return TrackMateModel(spots, tracks, edges, geometry=geometry, framerate=framerate,
+                          calibration=tuple(calibration[:2]))
+
+
+def _solveLAP(rows, cols, costs, n_rows, n_cols, alternative):
+    '''
+    Sparse linear assignment of the LAP framework of TrackMate (Jaqaman et
+        al. 2008): every row is linked to at most one column through one of
+        the candidate (rows, cols, costs), or to nothing at the cost of
+        alternative (per candidate, 1.05 x the largest cost of its frame pair
+        in TrackMate). Candidates falling into separate connected components
+        are independent problems, solved one by one; the components of a
+        single candidate, most of them in sparse movies, are linked at once.
+
+    Returns the linked (rows, cols).
+    '''
+    if len(costs) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    graph = sparse.coo_matrix((np.ones(len(costs)), (rows, n_rows + cols)), shape=(n_rows + n_cols,) * 2)
+    _, labels = csgraph.connected_components(graph, directed=False)
+    component = labels[rows]
+    size = np.bincount(component)[component]
+    linked = [np.flatnonzero(size == 1)]
+    order = np.flatnonzero(size > 1)
+    order = order[np.argsort(component[order], kind='stable')]
+    for group in np.split(order, np.flatnonzero(np.diff(component[order])) + 1) if len(order) else []:
+        r, r_local = np.unique(rows[group], return_inverse=True)
+        c, c_local = np.unique(cols[group], return_inverse=True)
+        n, m = len(r), len(c)
+        cost = costs[group]
+        alt = alternative[group].max()
+        # the augmented (n + m) x (m + n) matrix of the LAP (links, no link
+        # costing alt for every row and column, transposed links costing the
+        # smallest cost) costs sum(costs) + (n + m - 2 k) alt + k min(costs)
+        # for k links: the same links as n x m with 0 for no link
+        matrix = np.zeros((n, m))
+        matrix[r_local, c_local] = cost - 2 * alt + cost.min()
+        row, col = linear_sum_assignment(matrix)
+        pick = np.full((n, m), -1, dtype=np.int64)
+        pick[r_local, c_local] = group
+        link = pick[row, col]
+        linked.append(link[link >= 0])
+    linked = np.sort(np.concatenate(linked))
+    return rows[linked], cols[linked]
+
+
+def _candidates(xyz, source, target, max_distance):
+    # (source, target, squared distance) pairs of spots within max_distance
+    if len(source) == 0 or len(target) == 0:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0)
+    pairs = cKDTree(xyz[source]).sparse_distance_matrix(cKDTree(xyz[target]), max_distance, output_type='ndarray')
+    return (np.stack([source[pairs['i']], target[pairs['j']]], axis=1).astype(np.int64),
+            pairs['v'].astype(np.float64) ** 2)
+
+
+def linkSpots(spots, max_distance, gap_distance=None, max_frame_gap=2, alternative_factor=1.05):
+    '''
+    Links spots into tracks as the simple LAP tracker of TrackMate (module 2,
+        step 8, without splitting or merging): frame to frame linking, then
+        gap closing of the track segments.
+
+    Candidate links are the spot pairs within max_distance found with a
+        KD-tree, costing their squared distance; every spot is linked to the
+        spot of the next frame that minimizes the total cost over all the
+        frame pairs (see _solveLAP). The ends of the segments are then joined
+        to the starts of segments 2 to max_frame_gap frames later (only over
+        missing frames, the frame to frame links stand) and within
+        gap_distance (default max_distance) the same way.
+
+    - spots: dataframe with the columns of a TrackMate spot table (ID,
+        FRAME, POSITION_X/Y/Z/T), e.g. detectSpots
+    - max_frame_gap: largest frame difference of a gap closing link, counted
+        from 2 (bridges one missing frame, as in TrackMate), 1 for no gap
+        closing
+
+    Returns the tracks and the edges as the dataframes of a TrackMate xml
+        (see utils.parseTracks). Spots linked to nothing are not tracks.
+    '''
+    gap_distance = max_distance if gap_distance is None else gap_distance
+    frame = spots['FRAME'].to_numpy(np.int64)
+    xyz = spots[['POSITION_X', 'POSITION_Y', 'POSITION_Z']].to_numpy(np.float64)
+    n = len(spots)
+    by_frame = np.argsort(frame, kind='stable')
+    frames, starts = np.unique(frame[by_frame], return_index=True)
+    groups = dict(zip(frames.tolist(), np.split(by_frame, starts[1:])))
+    # frame to frame: rows are the spots as sources, columns as targets
+    pairs, costs, alternative = [np.zeros((0, 2), dtype=np.int64)], [np.zeros(0)], [np.zeros(0)]
+    for f in frames.tolist():
+        if f + 1 not in groups:
+            continue
+        p, c = _candidates(xyz, groups[f], groups[f + 1], max_distance)
+        pairs.append(p)
+        costs.append(c)
+        alternative.append(np.full(len(c), alternative_factor * c.max() if len(c) else 0.0))
+    pairs, costs, alternative = np.concatenate(pairs), np.concatenate(costs), np.concatenate(alternative)
+    source, target = _solveLAP(pairs[:, 0], pairs[:, 1], costs, n, n, alternative)
+    # gap closing: segment ends (no target) to segment starts (no source)
+    if max_frame_gap > 1:
+        ends = np.setdiff1d(np.arange(n), source)
+        begins = np.setdiff1d(np.arange(n), target)
+        p, c = _candidates(xyz, ends, begins, gap_distance)
+        gap = frame[p[:, 1]] - frame[p[:, 0]]
+        keep = (gap >= 2) & (gap <= max_frame_gap)
+        p, c = p[keep], c[keep]
+        if len(c):
+            s, t = _solveLAP(p[:, 0], p[:, 1], c, n, n, np.full(len(c), alternative_factor * c.max()))
+            source, target = np.concatenate([source, s]), np.concatenate([target, t])
+    return linkTables(spots, source, target)
+
+
+def linkTables(spots, source, target):
+    '''
+    Track and edge dataframes (see utils.parseTracks) of the links between
+        the spot rows source and target, tracks numbered from 0 in order of
+        their first spot, edges in track and time order, with the features
+        TrackMate computes.
+    '''
+    n = len(spots)
+    graph = sparse.coo_matrix((np.ones(len(source)), (source, target)), shape=(n, n))
+    _, labels = csgraph.connected_components(graph, directed=False)
+    counts = np.bincount(labels)
+    labels = np.where(counts[labels] > 1, labels, -1)
+    linked = np.flatnonzero(labels >= 0)
+    # track IDs in order of the first spot of every track
+    _, first = np.unique(labels[linked], return_index=True)
+    track_id = np.full(counts.size, -1, dtype=np.int64)
+    track_id[labels[linked[np.sort(first)]]] = np.arange(len(first))
+    spot_track = np.where(labels >= 0, track_id[labels], -1)
+
+    ids = spots['ID'].to_numpy(np.int64)
+    frame = spots['FRAME'].to_numpy(np.int64)
+    time = spots['POSITION_T'].to_numpy(np.float64)
+    xyz = spots[['POSITION_X', 'POSITION_Y', 'POSITION_Z']].to_numpy(np.float64)
+    edge_track = spot_track[source]
+    order = np.lexsort((time[source], edge_track))
+    source, target, edge_track = source[order], target[order], edge_track[order]
+    step = xyz[target] - xyz[source]
+    displacement = np.sqrt((step ** 2).sum(axis=1))
+    mid = (xyz[source] + xyz[target]) / 2
+    edges = pd.DataFrame({'TRACK_ID': edge_track,
+                          'SPOT_SOURCE_ID': ids[source],
+                          'SPOT_TARGET_ID': ids[target],
+                          'LINK_COST': displacement ** 2,
+                          'EDGE_TIME': (time[source] + time[target]) / 2,
+                          'EDGE_X_LOCATION': mid[:, 0],
+                          'EDGE_Y_LOCATION': mid[:, 1],
+                          'EDGE_Z_LOCATION': mid[:, 2],
+                          'VELOCITY': displacement / (time[target] - time[source]),
+                          'DISPLACEMENT': displacement})
+
+    n_tracks = len(first)
+    owner = spot_track[linked]
+    n_spots = np.bincount(owner, minlength=n_tracks)
+    start = np.full(n_tracks, np.inf)
+    stop = np.full(n_tracks, -np.inf)
+    np.minimum.at(start, owner, time[linked])
+    np.maximum.at(stop, owner, time[linked])
+    skipped = frame[target] - frame[source] - 1
+    longest = np.zeros(n_tracks, dtype=np.int64)
+    np.maximum.at(longest, edge_track, skipped)
+    # displacement between the first and the last spot
+    by_time = linked[np.lexsort((time[linked], owner))]
+    bounds = np.cumsum(n_spots)
+    first_spot, last_spot = by_time[bounds - n_spots], by_time[bounds - 1]
+    tracks = pd.DataFrame({'TRACK_ID': np.arange(n_tracks, dtype=np.int64),
+                           'NUMBER_SPOTS': n_spots.astype(np.int64),
+                           'NUMBER_GAPS': np.bincount(edge_track, weights=skipped > 0,
+                                                      minlength=n_tracks).astype(np.int64),
+                           'LONGEST_GAP': longest,
+                           'TRACK_DURATION': stop - start,
+                           'TRACK_START': start,
+                           'TRACK_STOP': stop,
+                           'TRACK_DISPLACEMENT': np.sqrt(((xyz[last_spot] - xyz[first_spot]) ** 2).sum(axis=1)),
+                           'TRACK_X_LOCATION': np.bincount(owner, weights=xyz[linked, 0], minlength=n_tracks) / n_spots,
+                           'TRACK_Y_LOCATION': np.bincount(owner, weights=xyz[linked, 1], minlength=n_tracks) / n_spots,
+                           'TRACK_Z_LOCATION': np.bincount(owner, weights=xyz[linked, 2], minlength=n_tracks) / n_spots,
+                           'TRACK_MEAN_SPEED': np.bincount(edge_track, weights=edges['VELOCITY'].to_numpy(),
+                                                           minlength=n_tracks) / np.maximum(n_spots - 1, 1)})
+    tracks['name'] = np.array(['Track_' + str(i) for i in tracks['TRACK_ID']], dtype=object)
+    return tracks, edges
+
+
+def trackMovie(movie, radius, threshold, max_distance, gap_distance=None, max_frame_gap=2, calibration=None,
+               framerate=None, channel=None, median_filter=False, subpixel=True, workers=None):
+    '''
+    Detection and linking of a movie without Fiji, the TrackMateModel the
+        pairer would get from the TrackMate xml of the movie: pass it to
+        utils.pair (or TrackPairer, findPairs) in place of the xml path.
+
+    - radius, threshold, calibration, framerate, channel, median_filter,
+        subpixel, workers: see detectSpots
+    - max_distance, gap_distance, max_frame_gap: see linkSpots
+    '''
+    if not isinstance(movie, np.ndarray) and (calibration is None or framerate is None):
+        cal, dt = movieCalibration(movie)
+        calibration = calibration or cal
+        framerate = framerate or dt
+    calibration = tuple(float(c) for c in (calibration or (1.0, 1.0, 1.0)))
+    framerate = float(framerate or 1.0)
+    spots = detectSpots(movie, radius, threshold, calibration=calibration, framerate=framerate, channel=channel,
+                        median_filter=median_filter, subpixel=subpixel, workers=workers)
+    tracks, edges = linkSpots(spots, max_distance, gap_distance=gap_distance, max_frame_gap=max_frame_gap)
+    if isinstance(movie, (np.ndarray, RegisteredStack)):
+        shape = movie.shape
+    elif os.path.isdir(movie):
+        shape = PlaneStore.open(movie).shape
+    else:
+        shape = _tiffFrames(movie)[0]
+    model = spotModel(spots, shape, calibration=calibration, framerate=framerate)
+    model.tracks, model.edges = tracks, edges
+    return model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Detect (and link) centrosomes in a movie as TrackMate.')
+    parser.add_argument('movie', help='tiff (t, z, [c], y, x)')
+    parser.add_argument('--radius', type=float, required=True, help='spot radius, calibrated units')
+    parser.add_argument('--threshold', type=float, default=0.0, help='minimum quality')
+    parser.add_argument('--channel', type=int, default=None, help='channel of the centrosomes (from 0), default the first')
+    parser.add_argument('--median', action='store_true', help='median filter the planes first')
+    parser.add_argument('--workers', type=int, default=None, help='threads, default all cores')
+    parser.add_argument('--max-distance', type=float, default=None,
+                        help='linking max distance, calibrated units, default no linking')
+    parser.add_argument('--gap-distance', type=float, default=None, help='gap closing max distance, default --max-distance')
+    parser.add_argument('--max-gap', type=int, default=2, help='gap closing max frame gap, 1 for no gap closing')
+    parser.add_argument('--out', default=None, help='spots csv, default <movie>_spots.csv')
+    args = parser.parse_args(argv)
+    spots = detectSpots(args.movie, args.radius, args.threshold, channel=args.channel,
+                        median_filter=args.median, workers=args.workers)
+    out = args.out or os.path.splitext(args.movie)[0] + '_spots.csv'
+    spots.to_csv(out, index=False)
+    print('{} spots in {} frames saved in {}'.format(len(spots), spots['FRAME'].nunique(), out))
+    if args.max_distance is not None:
+        tracks, edges = linkSpots(spots, args.max_distance, gap_distance=args.gap_distance,
+                                  max_frame_gap=args.max_gap)
+        base = os.path.splitext(out)[0]
+        base = base[:-len('_spots')] if base.endswith('_spots') else base
+        tracks.to_csv(base + '_tracks.csv', index=False)
+        edges.to_csv(base + '_edges.csv', index=False)
+        print('{} tracks, {} edges saved in {}_tracks.csv and {}_edges.csv'.format(len(tracks), len(edges), base, base))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Training a pair classifier (the trainable option) without refitting a forest
+    per grid point.
+
+    $ python src/training.py ../data/train_example/ --out src/myModel.sav
+
+The training set of every movie (features of predictions.csv, labels of
+    True.csv, as in notebooks/trainable.ipynb step 4) is kept in
+    <movie>/training.npz, keyed on the hashes of both files, so it is built
+    once. train_pair_classifier then sweeps n_estimators by growing a single
+    warm-started forest per fold, the folds on a pool of processes, and saves
+    the final forest in the Forest format of forest.py.
+
+With a fixed random_state the first n trees of a warm-started forest are the
+    trees of RandomForestClassifier(n_estimators=n), so the scores are those
+    of GridSearchCV over n_estimators with that random_state.
+'''
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import StratifiedKFold, train_test_split
+from sklearn.metrics import accuracy_score, precision_score, f1_score, classification_report
+from utils import minMaxScale
+from pipeline import fileState
+from forest import Forest, exportForest
+
+
+# classifier input, in the order of features.csv
+X_COLUMNS = ['center_stdev', 'normal_stdev', 'sl_f', 'sl_i', 'sl_max', 'sl_min', 't_cong',
+             't_overlap', 'intensity_normalized', 'diameter', 'contrast_normalized']
+STORE = 'training.npz'
+
+
+def movieTrainingData(root, m_name, n_false=100, random_state=3020):
+    '''
+    X and y of one movie as in trainable.ipynb: the pairs of predictions.csv
+        labelled by True.csv, contrast and intensity min-max normalized, all
+        true pairs and n_false false ones.
+
+    Read from <movie>/training.npz when predictions.csv, True.csv and the
+        arguments are unchanged, else built and saved there.
+    '''
+    folder = os.path.join(root, m_name)
+    paths = [os.path.join(folder, 'predictions.csv'), os.path.join(folder, 'True.csv')]
+    store = os.path.join(folder, STORE)
+    params = {'n_false': n_false, 'random_state': random_state}
+    try:
+        with np.load(store, allow_pickle=False) as npz:
+            recorded = json.loads(str(npz['source']))
+            states = [fileState(path, known) for path, known in zip(paths, recorded['inputs'])]
+            if [s and s['sha1'] for s in states] == [s['sha1'] for s in recorded['inputs']] \
+                    and recorded['params'] == params:
+                return pd.DataFrame(npz['X'], columns=X_COLUMNS), npz['y']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    true = pd.read_csv(paths[1], index_col=0)
+    data = pd.read_csv(paths[0])
+    data['True_Label'] = true['True_pairs'].values
+    data['contrast_normalized'] = minMaxScale(data['contrast'].values)
+    data['intensity_normalized'] = minMaxScale(data['intensity'].values)
+    true = data[data['True_Label'] == 1]
+    false = data[data['True_Label'] == 0]
+    false = false.sample(n_false, random_state=random_state)
+    data = pd.concat([false, true], axis=0)
+    X = data[X_COLUMNS]
+    y = data['True_Label'].to_numpy()
+
+    source = {'inputs': [fileState(path) for path in paths], 'params': params}
+    try:
+        with open(store + '.tmp', 'wb') as f:
+            np.savez(f, X=X.to_numpy(dtype=np.float64), y=y, source=np.array(json.dumps(source)))
+        os.replace(store + '.tmp', store)
+    except OSError as e: # e.g. read-only data folder, build it again next time
+        print('Could not save {}: {}'.format(store, e))
+    return X, y
+
+
+def trainingData(root, movie_names=None, n_false=100, random_state=3020):
+    '''
+    X and y of all movies under root (default all folders), concatenated
+    '''
+    if movie_names is None:
+        (_, movie_names, _) = next(os.walk(root))
+        movie_names = sorted(movie_names)
+    xs, ys = [], []
+    for m_name in movie_names:
+        X, y = movieTrainingData(root, m_name, n_false=n_false, random_state=random_state)
+        xs.append(X)
+        ys.append(y)
+    return pd.concat(xs, axis=0, ignore_index=True), np.concatenate(ys)
+
+
+def _growScores(X_train, y_train, X_val, y_val, sizes, params):
+    # accuracy on the validation set of the forest at every size, growing one
+    # warm-started forest and adding up the probabilities of the new trees only
+    clf = RandomForestClassifier(warm_start=True, **params)
+    X_val = np.asarray(X_val, dtype=np.float32)
+    total = None
+    scores = []
+    for n in sizes:
+        n_trees = len(getattr(clf, 'estimators_', []))
+        clf.set_params(n_estimators=n)
+        clf.fit(X_train, y_train)
+        for tree in clf.estimators_[n_trees:]: # in tree order, as predict_proba
+            proba = tree.predict_proba(X_val, check_input=False)
+            total = proba if total is None else total + proba
+        y_pred = clf.classes_.take(np.argmax(total, axis=1), axis=0)
+        scores.append(accuracy_score(y_val, y_pred))
+    return scores
+
+
+def train_pair_classifier(X, y, n_estimators=range(10, 200, 5), cv=3, test_size=0.2, random_state=12,
+                          workers=None, out_path=None, **forest_params):
+    '''
+    Chooses n_estimators of a random forest by cv-fold cross-validation
+        accuracy, as GridSearchCV does in trainable.ipynb, then fits it on the
+        training split and reports its scores on the test split.
+
+    - X, y: features (X_COLUMNS) and labels, see trainingData
+    - n_estimators: forest sizes to score. Each fold grows one warm-started
+        forest through all sizes instead of fitting a forest per size.
+    - cv: number of folds, run on a pool of workers processes (default one
+        per fold)
+    - test_size: fraction of the pairs held out, split with random_state
+        (as train_test_split in the notebook), 0 to train on all pairs
+    - random_state: seed of the split and of the forests, so the forest of
+        size n in a fold is RandomForestClassifier(n_estimators=n)
+    - out_path: saves the final classifier. A path ending in .npz gets the
+        Forest arrays only (see forest.py), any other path the pickle and its
+        <out_path>.npz sidecar, ready for pair and the batch runner.
+    - forest_params: other RandomForestClassifier arguments, default
+        criterion='gini', min_impurity_decrease=0.0
+
+    Returns the fitted classifier and the cross-validation results, laid out
+        as GridSearchCV.cv_results_.
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    y = np.ravel(np.asarray(y))
+    sizes = sorted(set(int(n) for n in n_estimators))
+    params = dict({'criterion': 'gini', 'min_impurity_decrease': 0.0}, **forest_params)
+    params['random_state'] = random_state
+    if test_size:
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=random_state)
+    else:
+        X_train, X_test, y_train, y_test = X, None, y, None
+
+    start = time.time()
+    folds = list(StratifiedKFold(n_splits=cv).split(X_train, y_train))
+    with ProcessPoolExecutor(max_workers=workers or cv) as pool:
+        futures = [pool.submit(_growScores, X_train[train], y_train[train], X_train[val], y_train[val], sizes, params)
+                   for train, val in folds]
+        split_scores = np.array([future.result() for future in futures])
+    mean = split_scores.mean(axis=0)
+    results = {'param_n_estimators': np.array(sizes), 'params': [{'n_estimators': n} for n in sizes],
+               'mean_test_score': mean, 'std_test_score': split_scores.std(axis=0)}
+    for k, scores in enumerate(split_scores):
+        results['split{}_test_score'.format(k)] = scores
+    # ties share the best rank, as in GridSearchCV
+    results['rank_test_score'] = np.searchsorted(np.sort(-mean), -mean) + 1
+    best = sizes[int(np.argmax(mean))]
+    print('Scored {} forest sizes on {} folds in {:.2f} seconds, best n_estimators: {} (accuracy {:.3f})'.format(
+        len(sizes), cv, time.time() - start, best, mean.max()))
+
+    clf = RandomForestClassifier(n_estimators=best, **params)
+    clf.fit(X_train, y_train)
+    if X_test is not None:
+        y_pred = clf.predict(X_test)
+        print(classification_report(y_test, y_pred))
+        print('accuracy: {:.3f}, precision: {:.3f}, f1: {:.3f}'.format(
+            accuracy_score(y_test, y_pred), precision_score(y_test, y_pred, average='weighted'),
+            f1_score(y_test, y_pred)))
+    if out_path is not None:
+        if out_path.endswith('.npz'):
+            Forest.fromModel(clf).save(out_path)
+        else:
+            with open(out_path, 'wb') as f:
+                pickle.dump(clf, f)
+            exportForest(out_path)
+        print('Model saved in ' + out_path)
+    return clf, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train a pair classifier on the labelled movies under a folder.')
+    parser.add_argument('root', help='folder with one subfolder per movie, with predictions.csv and True.csv')
+    parser.add_argument('--movies', nargs='+', default=None, help='movies to train on, default all')
+    parser.add_argument('--out', default='myModel.sav', help='model path, .npz for the Forest arrays only')
+    parser.add_argument('--cv', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, default one per fold')
+    parser.add_argument('--random-state', type=int, default=12)
+    args = parser.parse_args(argv)
+    X, y = trainingData(args.root, movie_names=args.movies)
+    train_pair_classifier(X, y, cv=args.cv, random_state=args.random_state, workers=args.workers,
+                          out_path=args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,14 +2,36 @@
 # -*- coding: utf-8 -*-
 
 
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import inspect
+import hashlib
+import queue
+import threading
+import contextlib
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from scipy.spatial import distance
-from statistics import mean, stdev
+from scipy.spatial import distance, cKDTree
+from statistics import mean
 import matplotlib.pyplot as plt
-from sklearn.preprocessing import MinMaxScaler
 import numpy as np
-from skimage.external import tifffile
-import xml.etree.cElementTree as et
+try:
+    import tifffile
+except ImportError:
+    from skimage.external import tifffile
+try:
+    import resource
+except ImportError: # not on windows
+    resource = None
+import xml.etree.ElementTree as et
+from array import array
 
 
 ################################################
@@ -25,6 +47,30 @@ def normalize(vector):
         return (0,0,0)
     return (x/length, y/length, z/length)
 
+def fileHash(path, chunk_size=1 << 20):
+    '''
+    sha1 hex digest of a file, read in chunks
+    '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def time2frame(time, framerate):
+    '''
+    converts trackmate times (TRACK_START, POSITION_T..., in s) to integer frames
+    '''
+    return np.rint(np.asarray(time, dtype=float) / framerate).astype(np.int64)
+
+def edge2frame(edge_time, framerate):
+    '''
+    EDGE_TIME is the midpoint of the source and target spot times, returns
+        floor((source + target) / 2) in integer frames, i.e. the frame of the
+        source spot for edges between consecutive frames
+    '''
+    return np.rint(2 * np.asarray(edge_time, dtype=float) / framerate).astype(np.int64) // 2
+
 def findCong(time, dist, max_dist):
     """
     Counts the number of continuous time points in which the two 
@@ -53,29 +99,301 @@ def findCong(time, dist, max_dist):
 # XML parsing related
 ################################################
 
-def parseSpots(trackmate_xml_path):
+class _Column(object):
+    '''
+    Growable typed buffer for one xml attribute, filled while streaming.
+    Integer features go to int64 (float64 with NaN if some element lacks the
+        attribute), the other features to float64 and 'name' stays a string.
+    '''
+    def __init__(self, label, kind):
+        self.label = label
+        self.kind = kind # 'int', 'float' or 'str'
+        self.missing = [] # row indices where the attribute was absent
+        if kind == 'int':
+            self.values = array('q')
+        elif kind == 'float':
+            self.values = array('d')
+        else:
+            self.values = []
+
+    def append(self, value):
+        if value is None and self.kind != 'str':
+            self.missing.append(len(self.values))
+            self.values.append(0)
+        elif self.kind == 'int':
+            try:
+                self.values.append(int(value))
+            except ValueError: # e.g. "3.0"
+                self.values.append(int(float(value)))
+        elif self.kind == 'float':
+            self.values.append(float(value))
+        else:
+            self.values.append(value)
+
+    def toarray(self):
+        if self.kind == 'str':
+            return np.array(self.values, dtype=object)
+        if self.kind == 'int':
+            arr = np.frombuffer(self.values, dtype=np.int64)
+        else:
+            arr = np.frombuffer(self.values, dtype=np.float64)
+        if self.missing:
+            arr = arr.astype(np.float64)
+            arr[self.missing] = np.nan
+        return arr
+
+
+def _columns2df(columns):
+    return pd.DataFrame({c.label: c.toarray() for c in columns},
+                        columns=[c.label for c in columns])
+
+
+class _HashingReader(object):
+    '''
+    File wrapper handed to iterparse so the content hash of the xml is
+        computed in the same read as the parse.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha1.update(data)
+        return data
+
+
+def _parseGeometry(log, image_data):
+    '''
+    Finds (X, Y, Z, T), the frame interval and the pixel size (dx, dy) in the
+        "Geometry:" block of the trackmate log, falling back to the
+        Settings/ImageData attributes.
+    '''
+    geometry, steps = {}, {}
+    for axis, upper, step in re.findall(r'^\s*([XYZT]) =\s*\d+\s*-\s*(\d+),\s*d[xyzt] = (\S+)\s*$',
+                                        log or '', flags=re.M):
+        geometry[axis] = int(upper)
+        steps[axis] = float(step)
+    if image_data is not None:
+        for axis, key in (('X', 'width'), ('Y', 'height'), ('Z', 'nslices'), ('T', 'nframes')):
+            if axis not in geometry and image_data.get(key) is not None:
+                geometry[axis] = int(image_data.get(key)) - 1
+        for axis, key in (('X', 'pixelwidth'), ('Y', 'pixelheight'), ('T', 'timeinterval')):
+            if axis not in steps and image_data.get(key) is not None:
+                steps[axis] = float(image_data.get(key))
+    framerate = steps.get('T')
+    calibration = (steps['X'], steps['Y']) if 'X' in steps and 'Y' in steps else None
+    if len(geometry) < 4:
+        return None, framerate, calibration
+    return (geometry['X'], geometry['Y'], geometry['Z'], geometry['T']), framerate, calibration
+
+
+def _readTrackMate(trackmate_xml_path):
+    '''
+    Single streaming pass (iterparse) over a trackmate xml. Elements are
+        cleared as soon as they are read, so peak memory is bounded by the
+        typed output columns, not by the xml tree.
+    '''
+    declared = {}
+    spots = tracks = edges = None
+    track_id = None
+    log = image_data = None
+    with open(trackmate_xml_path, 'rb') as f:
+        reader = _HashingReader(f)
+        for event, elem in et.iterparse(reader, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == 'Track':
+                    # edges need the id of the enclosing track
+                    track_id = int(elem.get('TRACK_ID'))
+                continue
+            if tag == 'Spot':
+                for col in spots:
+                    col.append(elem.get(col.label))
+                elem.clear()
+            elif tag == 'Edge':
+                edges[0].append(track_id)
+                for col in edges[1:]:
+                    col.append(elem.get(col.label))
+                elem.clear()
+            elif tag == 'Track':
+                for col in tracks:
+                    col.append(elem.get(col.label))
+                elem.clear()
+            elif tag == 'SpotsInFrame':
+                elem.clear()
+            elif tag in ('SpotFeatures', 'EdgeFeatures', 'TrackFeatures'):
+                declared[tag] = [(c.get('feature'), 'int' if c.get('isint') == 'true' else 'float')
+                                 for c in elem]
+            elif tag == 'FeatureDeclarations':
+                spots = [_Column(label, kind) for label, kind in declared.get('SpotFeatures', [])]
+                spots += [_Column('ID', 'int'), _Column('name', 'str')]
+                edges = [_Column('TRACK_ID', 'int')]
+                edges += [_Column(label, kind) for label, kind in declared.get('EdgeFeatures', [])]
+                tracks = [_Column(label, kind) for label, kind in declared.get('TrackFeatures', [])]
+                tracks += [_Column('name', 'str')]
+            elif tag == 'Log':
+                log = elem.text
+                elem.clear()
+            elif tag == 'ImageData':
+                image_data = dict(elem.attrib)
+            elif tag in ('AllSpots', 'AllTracks', 'FilteredTracks'):
+                elem.clear()
+    geometry, framerate, calibration = _parseGeometry(log, image_data)
+    return (TrackMateModel(_columns2df(spots), _columns2df(tracks), _columns2df(edges),
+                           geometry=geometry, framerate=framerate, calibration=calibration),
+            reader.sha1.hexdigest())
+
+
+def parseTrackMate(trackmate_xml_path):
     '''
     trackmate_xml_path : str
-    parses the spots info from trackmate xml
-    code adaptd from: https://github.com/hadim/pytrackmate
+    
+    reads spots, tracks and edges from a trackmate xml in a single streaming
+        pass, reusing the parsed model cached next to the xml when possible
+        (see TrackMateModel.load)
+        
+    returns:
+        spots_df: one row per spot, declared spot features + ID + name
+        tracks_df: one row per track, declared track features + name
+        edges_df: one row per edge, TRACK_ID + declared edge features
+    
+    Features declared with isint="true" (ID, FRAME, TRACK_ID, SPOT_SOURCE_ID...)
+        are int64, all other features are float64.
     '''
-    root = et.fromstring(open(trackmate_xml_path).read())
-    objects = []
-    features = root.find('Model').find('FeatureDeclarations').find('SpotFeatures')
-    features = [c.get('feature') for c in features.getchildren()] + ['ID'] + ['name']
+    model = TrackMateModel.load(trackmate_xml_path)
+    return model.spots.copy(), model.tracks.copy(), model.edges.copy()
 
-    spots = root.find('Model').find('AllSpots')
-    objects = []
-    for frame in spots.findall('SpotsInFrame'):
-        for spot in frame.findall('Spot'):
-            single_object = []
-            for label in features:
-                single_object.append(spot.get(label))
-            objects.append(single_object)
 
-    spots_df = pd.DataFrame(objects, columns=features)
+class TrackMateModel(object):
+    '''
+    Everything the pipeline needs from one trackmate xml: spots, tracks and
+        edges as typed dataframes, the geometry (X, Y, Z, T) as given by
+        parseDim, the frame interval as given by getFramerate and the pixel
+        size (dx, dy) in the units of the positions.
+    
+    TrackMateModel.load(xml) parses the xml once and persists the result as a
+        binary sidecar (<xml>.npz) keyed on the size, mtime and sha1 of the xml,
+        so pairing or re-classifying a movie again skips the xml entirely.
+    '''
+    TABLES = ('spots', 'tracks', 'edges')
+    _memo = OrderedDict() # abspath -> (size, mtime_ns, model), in-process
+    
+    def __init__(self, spots, tracks, edges, geometry=None, framerate=None, calibration=None):
+        self.spots = spots
+        self.tracks = tracks
+        self.edges = edges
+        self.geometry = geometry
+        self.framerate = framerate
+        self.calibration = calibration
+    
+    @staticmethod
+    def sidecar(trackmate_xml_path):
+        return trackmate_xml_path + '.npz'
+    
+    @classmethod
+    def load(cls, trackmate_xml_path, cache=True):
+        '''
+        Returns the model of a trackmate xml, from memory, from its sidecar or
+            by parsing the xml (in that order). With cache=False the xml is
+            always parsed and no sidecar is written. A model is returned as
+            is, so the pairer takes one in place of an xml path (e.g. from
+            tracking.trackMovie).
+        '''
+        if isinstance(trackmate_xml_path, TrackMateModel):
+            return trackmate_xml_path
+        if not cache:
+            return _readTrackMate(trackmate_xml_path)[0]
+        key = os.path.abspath(trackmate_xml_path)
+        st = os.stat(trackmate_xml_path)
+        if key in cls._memo:
+            size, mtime_ns, model = cls._memo[key]
+            if (size, mtime_ns) == (st.st_size, st.st_mtime_ns):
+                return model
+        model = cls._loadSidecar(trackmate_xml_path, st)
+        if model is None:
+            model, sha1 = _readTrackMate(trackmate_xml_path)
+            model.save(cls.sidecar(trackmate_xml_path), source={
+                'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1})
+        cls._memo[key] = (st.st_size, st.st_mtime_ns, model)
+        while len(cls._memo) > 2: # keep the current movie, not the whole batch
+            cls._memo.popitem(last=False)
+        return model
+    
+    @classmethod
+    def _loadSidecar(cls, trackmate_xml_path, st):
+        path = cls.sidecar(trackmate_xml_path)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                source = json.loads(str(npz['source']))
+                if source['size'] != st.st_size:
+                    return None
+                if source['mtime_ns'] == st.st_mtime_ns:
+                    return cls._fromnpz(npz)
+                if source['sha1'] != fileHash(trackmate_xml_path):
+                    return None
+                model = cls._fromnpz(npz)
+        except (OSError, ValueError, KeyError):
+            # unreadable or from an older layout, parse the xml again
+            return None
+        # only touched (e.g. copied), record the new mtime so the xml is not
+        # hashed again on every load
+        source.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+        model.save(path, source=source)
+        return model
+    
+    @classmethod
+    def _fromnpz(cls, npz):
+        tables = {}
+        for name in cls.TABLES:
+            columns = [str(c) for c in npz[name + '_columns']]
+            data = {}
+            for i, c in enumerate(columns):
+                arr = npz['{}_{}'.format(name, i)]
+                data[c] = arr.astype(object) if arr.dtype.kind == 'U' else arr
+            tables[name] = pd.DataFrame(data, columns=columns)
+        geometry = tuple(int(v) for v in npz['geometry']) or None
+        framerate = float(npz['framerate'])
+        calibration = tuple(float(v) for v in npz['calibration']) or None
+        return cls(tables['spots'], tables['tracks'], tables['edges'], geometry=geometry,
+                   framerate=None if np.isnan(framerate) else framerate, calibration=calibration)
+    
+    def save(self, path, source=None):
+        '''
+        Writes the model as an uncompressed npz. Failing to write (e.g. a
+            read-only data folder) is not an error, the xml is simply parsed
+            again next time.
+        '''
+        arrays = {'source': np.array(json.dumps(source or {})),
+                  'geometry': np.array(self.geometry or (), dtype=np.int64),
+                  'framerate': np.array(np.nan if self.framerate is None else self.framerate),
+                  'calibration': np.array(self.calibration or (), dtype=np.float64)}
+        for name in self.TABLES:
+            df = getattr(self, name)
+            arrays[name + '_columns'] = np.array(list(df.columns), dtype=str)
+            for i, c in enumerate(df.columns):
+                values = df[c].to_numpy()
+                if values.dtype == object or not np.issubdtype(values.dtype, np.number):
+                    values = values.astype(str)
+                arrays['{}_{}'.format(name, i)] = values
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Could not cache parsed xml in {}: {}".format(path, e))
 
-    return spots_df
+
+def parseSpots(trackmate_xml_path):
+    '''
+    trackmate_xml_path : str
+    parses the spots info from trackmate xml
+    code adaptd from: https://github.com/hadim/pytrackmate
+    '''
+    return TrackMateModel.load(trackmate_xml_path).spots.copy()
 
 
 def parseTracks(trackmate_xml_path):
@@ -92,44 +410,9 @@ def parseTracks(trackmate_xml_path):
     reference: 
         https://imagej.net/TrackMate
     '''
-    
-    tree = et.parse(trackmate_xml_path)
-    root = tree.getroot()
-    objects = []
-    df = pd.DataFrame([])
-    df2 = pd.DataFrame([])
-    features = root.find('Model').find('FeatureDeclarations').find('TrackFeatures')
-    features = [c.get('feature') for c in features.getchildren()]
-    features.append('name')
-    tracks = root.find('Model').find('AllTracks')
-    objects = []
-    edges = []
-    
-    for track in tracks.findall('Track'):
-        single_object = []
-        track_id = int(track.get("TRACK_ID"))
-        for edge in track.findall('Edge'):
-            edge_object = [track_id,
-                    edge.get('SPOT_SOURCE_ID'), 
-                     edge.get('SPOT_TARGET_ID'), 
-                     edge.get('LINK_COST'),
-                     edge.get('EDGE_TIME'),
-                     edge.get('EDGE_X_LOCATION'),
-                     edge.get('EDGE_Y_LOCATION'),
-                     edge.get('EDGE_Z_LOCATION'),
-                     edge.get('VELOCITY'),
-                     edge.get('DISPLACEMENT')]
-            
-            edges.append(edge_object)               
-        
-        for label in features:
-            single_object.append(track.get(label))
-        objects.append(single_object)
-      
-        
-    df = pd.DataFrame(objects, columns = features)
-    #df = df.astype(np.float)
-    df2 = pd.DataFrame(edges, columns = [
+    model = TrackMateModel.load(trackmate_xml_path)
+    df = model.tracks.copy()
+    df2 = model.edges.reindex(columns=[
                     'TRACK_ID',
                     'SPOT_SOURCE_ID',
                     'SPOT_TARGET_ID',
@@ -140,25 +423,15 @@ def parseTracks(trackmate_xml_path):
                     'EDGE_Z_LOCATION',
                     'VELOCITY',
                     'DISPLACEMENT'])
-    df2 = df2.astype(np.float)
+    df2 = df2.astype(np.float64)
     
     return df, df2
 
 def parseDim(trackmate_xml_path):
-    f=open(trackmate_xml_path)
-    ln=f.readline().split()
-    while ln[0] != 'Geometry:':
-        ln=f.readline().split()
-    ln=f.readline().split()
-    X = int(ln[4][:-1])
-    ln=f.readline().split()
-    Y = int(ln[4][:-1])
-    ln=f.readline().split()
-    Z = int(ln[4][:-1])
-    ln=f.readline().split()
-    T = int(ln[4][:-1]) 
-    f.close()
-    return (X,Y,Z,T)
+    '''
+    returns the (X,Y,Z,T) geometry of the trackmate xml
+    '''
+    return TrackMateModel.load(trackmate_xml_path).geometry
 
 
 
@@ -167,76 +440,165 @@ def parseDim(trackmate_xml_path):
 ################################################
 
 
+def registrationSidecar(tiff_path):
+    '''
+    path of the json written by register() next to a registered tiff
+    '''
+    return tiff_path + '.json'
+
+def registeredMovie(tiff_path):
+    '''
+    The registered movie of a tiff: root/<movie>/r_<movie>.tif for
+        root/<movie>/<movie>.tif when it exists (as register_movie writes
+        it), else tiff_path itself, e.g. a tiff registered already
+    '''
+    if not isinstance(tiff_path, str):
+        return tiff_path
+    folder, name = os.path.split(tiff_path)
+    if name.startswith('r_'):
+        return tiff_path
+    sibling = os.path.join(folder, 'r_' + name)
+    return sibling if os.path.exists(sibling) else tiff_path
+
+def _outputStat(path):
+    # stat of a registered movie, of the .zarray written last for a PlaneStore
+    if os.path.isdir(path):
+        return os.stat(os.path.join(path, '.zarray'))
+    return os.stat(path)
+
+def findFrameBorders(translation, y_dim, x_dim, pad=True):
+    '''
+    translation: per-frame integer (x, y) translations, already scaled
+    y_dim, x_dim: size of the input frames
+    pad: as in register()
+    
+    returns an (n_frame, 4) int array of top, bottom, left, right: the first
+        and last row and column (inclusive) holding image data in each
+        registered frame. Everything outside is zero padding.
+    '''
+    translation = np.asarray(translation, dtype=int).reshape(-1, 2)
+    trans_x, trans_y = translation[:, 0], translation[:, 1]
+    if pad:
+        x_low, _, y_low, _ = findCanvas(translation, y_dim, x_dim)
+        top = -trans_y - y_low
+        left = -trans_x - x_low
+        bottom = top + y_dim - 1
+        right = left + x_dim - 1
+    else:
+        top = np.maximum(0, -trans_y)
+        bottom = np.minimum(y_dim, y_dim - trans_y) - 1
+        left = np.maximum(0, -trans_x)
+        right = np.minimum(x_dim, x_dim - trans_x) - 1
+    return np.stack([top, bottom, left, right], axis=1)
+
+def bordersOf(frame_borders):
+    '''
+    top, bottom, left, right of the region holding image data in every
+        frame, from the per-frame borders of findFrameBorders
+    '''
+    frame_borders = np.asarray(frame_borders)
+    return (int(frame_borders[:, 0].max()), int(frame_borders[:, 1].min()),
+            int(frame_borders[:, 2].max()), int(frame_borders[:, 3].min()))
+
+def writeRegistrationInfo(out_tiff_path, tiff_path, translation, shape, pad):
+    '''
+    Writes the translation, the canvas and the valid region of every frame
+        (see findFrameBorders) of a registered tiff to its json sidecar, so the
+        crop borders never have to be searched for in the pixels again.
+    translation: per-frame integer (x, y) translations, already scaled
+    shape: shape of the input movie
+    '''
+    n_frame = shape[0]
+    y_dim, x_dim = shape[-2:]
+    translation = np.asarray(translation, dtype=int).reshape(-1, 2)[:n_frame]
+    x_low, x_high, y_low, y_high = findCanvas(translation, y_dim, x_dim) if pad else (0, x_dim, 0, y_dim)
+    borders = findFrameBorders(translation, y_dim, x_dim, pad=pad)
+    top, bottom, left, right = bordersOf(borders)
+    st = _outputStat(out_tiff_path)
+    info = {
+        'source': os.path.basename(tiff_path),
+        'tiff': {'size': st.st_size, 'mtime_ns': st.st_mtime_ns},
+        'shape': list(shape[:-2]) + [y_high - y_low, x_high - x_low],
+        'pad': bool(pad),
+        'translation': translation.tolist(),
+        'canvas': {'x_low': x_low, 'x_high': x_high, 'y_low': y_low, 'y_high': y_high},
+        'frame_borders': borders.tolist(),
+        'borders': {'top': top, 'bottom': bottom, 'left': left, 'right': right},
+        }
+    with open(registrationSidecar(out_tiff_path), 'w') as f:
+        json.dump(info, f, indent=1)
+    return info
+
+def readRegistrationInfo(tiff_path):
+    '''
+    Returns the sidecar written by register() for this tiff, or None if there
+        is none or the tiff was rewritten since.
+    '''
+    path = registrationSidecar(tiff_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        info = json.load(f)
+    st = _outputStat(tiff_path)
+    if info.get('tiff') != {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}:
+        return None
+    return info
+
 def findCroppedDim(tiff_path):
+    '''
+    Returns top, bottom, left, right: the region of a registered tiff that
+        holds image data in every frame.
+    
+    Read from the sidecar written by register() when there is one. Otherwise
+        only the first plane of each frame is read (memory-mapped when
+        possible) and the zero padding is measured along its middle row
+        and column.
+    '''
+    if isinstance(tiff_path, RegisteredStack):
+        return tiff_path.croppedDim()
+    info = readRegistrationInfo(tiff_path)
+    if info is not None:
+        borders = info['borders']
+        return borders['top'], borders['bottom'], borders['left'], borders['right']
+    top = left = 0
+    bottom = right = None
+    for plane in _iterFirstPlanes(tiff_path):
+        y_dim, x_dim = plane.shape
+        if bottom is None:
+            bottom, right = y_dim, x_dim
+        if not np.any(plane): # check if empty frame
+            continue
+        column = np.flatnonzero(plane[:, int(x_dim/2)])
+        if len(column):
+            top = max(top, column[0])
+            bottom = min(bottom, column[-1])
+        row = np.flatnonzero(plane[int(y_dim/2)])
+        if len(row):
+            left = max(left, row[0])
+            right = min(right, row[-1])
+    return int(top), int(bottom), int(left), int(right)
+
+def _iterFirstPlanes(tiff_path):
+    '''
+    Yields the first (y, x) plane (z = 0, channel 0) of every timepoint.
+    '''
+    if isinstance(tiff_path, RegisteredStack):
+        yield from tiff_path.firstPlanes()
+        return
+    if os.path.isdir(tiff_path):
+        store = PlaneStore.open(tiff_path)
+        for t in range(store.shape[0]):
+            yield store.readPlane((t,) + (0,) * (len(store.shape) - 3))
+        return
+    shape, pages_per_frame, frames = _tiffFrames(tiff_path)
+    if frames is not None:
+        for t in range(shape[0]):
+            yield np.array(frames[t].reshape((-1,) + shape[-2:])[0])
+        return
     with tifffile.TiffFile(tiff_path) as tif:
-        # read tiff
-        im_in = tif.asarray()
-        if len(im_in.shape) == 4:
-            n_frame, n_zstep, y_dim, x_dim = im_in.shape
-        else:
-            n_frame, n_zstep, n_channel, y_dim, x_dim = im_in.shape
-        top = 0
-        bottom = y_dim
-        left = 0
-        right = x_dim
-        if len(im_in.shape) == 4:
-            for t in range(n_frame):
-                if not np.any(im_in[t][0]): # check if empty frame
-                    continue
-                # top border
-                y = 0
-                while im_in[t][0][y][int(x_dim/2)] == 0:
-                    y+=1
-                if top < y:
-                    top = y
-                # bottom border
-                y = y_dim - 1
-                while im_in[t][0][y][int(x_dim/2)] == 0:
-                    y-=1
-                if bottom > y:
-                    bottom = y
-                # left border
-                x = 0
-                while im_in[t][0][int(y_dim/2)][x] == 0:
-                    x+=1
-                if left < x:
-                    left = x
-                # right border
-                x = x_dim - 1
-                while im_in[t][0][int(y_dim/2)][x] == 0:
-                    x-=1
-                if right > x:
-                    right = x
-        else:
-            for t in range(n_frame):
-                if not np.any(im_in[t][0]): # check if empty frame
-                    continue
-                # top border
-                y = 0
-                while im_in[t][0][0][y][int(x_dim/2)] == 0:
-                    y+=1
-                if top < y:
-                    top = y
-                # bottom border
-                y = y_dim - 1
-                while im_in[t][0][0][y][int(x_dim/2)] == 0:
-                    y-=1
-                if bottom > y:
-                    bottom = y
-                
-                # left border
-                x = 0
-                while im_in[t][0][0][int(y_dim/2)][x] == 0:
-                    x+=1
-                if left < x:
-                    left = x
-                # right border
-                x = x_dim - 1
-                while im_in[t][0][0][int(y_dim/2)][x] == 0:
-                    x-=1
-                if right > x:
-                    right = x
-    return top, bottom, left, right
+        for t in range(shape[0]):
+            page = tif.asarray(key=t * pages_per_frame)
+            yield page.reshape((-1,) + shape[-2:])[0]
 
 def combine(csv_path,n_csv = 2):
     mat = pd.read_csv(csv_path+"1.csv", index_col=0, header=0)
@@ -251,22 +613,42 @@ def combine(csv_path,n_csv = 2):
         counter+=1
     return mat
 
-def register_movie(root, movie_name,pad=True):
+def register_movie(root, movie_name,pad=True,stream=False,drift='roi',channel=None,workers=None,
+                   codec=None,level=None,tile=None):
+    '''
+    Registers root/<movie>/<movie>.tif to root/<movie>/r_<movie>.tif.
+    
+    - drift: 'roi' for the translation matrix of the roi lines in
+        root/<movie>/roi/, 'auto' to estimate it from the movie (see
+        estimateDrift), saved in root/<movie>/drift.csv
+    - channel, workers: see estimateDrift
+    - codec, level, tile: compression and tiling of r_<movie>.tif, see register
+    '''
     tiff = root+movie_name+'/'+movie_name+'.tif'
     r_tiff =root+movie_name+'/r_'+movie_name+'.tif'
+    if drift == 'auto':
+        print("Estimating drift...")
+        trans_mat = estimateDrift(tiff, channel=channel, workers=workers)
+        pd.DataFrame(trans_mat, columns=['X', 'Y']).to_csv(root+movie_name+'/drift.csv')
+        print("Start registration...")
+        register(tiff, trans_mat, r_tiff, pad=True, stream=stream, codec=codec, level=level, tile=tile)
+        print("Registration of {} was successful. Saved in {} .".format(movie_name, r_tiff))
+        return
     csv_path = root+movie_name+'/roi/'
     import os
     (_,_,filenames) = next(os.walk(csv_path))
     n_roi = len(filenames)
     print("Number of ROI found: ", n_roi)
     print("Start registration...")
-    register_w_roi(tiff,r_tiff,csv_path,n_roi=n_roi,pad=True)
+    register_w_roi(tiff,r_tiff,csv_path,n_roi=n_roi,pad=True,stream=stream,codec=codec,level=level,tile=tile)
     print("Registration of {} was successful. Saved in {} .".format(movie_name, r_tiff))
     return
     
-def register_w_roi(tiff_path,out_tiff_path, csv_path,n_roi=2,high_res=True,compress=1,pad=True):
+def register_w_roi(tiff_path,out_tiff_path, csv_path,n_roi=2,high_res=True,compress=1,pad=True,stream=False,
+                   codec=None,level=None,tile=None):
     trans_mat = combine(csv_path, n_csv = n_roi)
-    metadata = register(tiff_path,trans_mat,out_tiff_path,highres=high_res,compress=compress, pad=pad)
+    metadata = register(tiff_path,trans_mat,out_tiff_path,highres=high_res,compress=compress, pad=pad, stream=stream,
+                        codec=codec, level=level, tile=tile)
     return metadata
 
 def roi2mat(roi_df):
@@ -291,13 +673,122 @@ def combine_roi(mat1, mat2):
     mat = mat1 + mat2
     return mat
 
+def maxProjections(tiff_path, channel=None):
+    '''
+    z max projection of every timepoint of a (t, z, y, x) or (t, z, c, y, x)
+        tiff, as a (t, y, x) float32 array, read one timepoint at a time.
+        channel: the channel to project, default the max over all channels
+    '''
+    projections = []
+    for frame in _iterTiffFrames(tiff_path):
+        if channel is not None and frame.ndim == 4:
+            frame = frame[:, channel]
+        projections.append(frame.reshape((-1,) + frame.shape[-2:]).max(axis=0).astype(np.float32))
+    return np.stack(projections)
+
+def _peakOffset(corr, axis, peak):
+    # sub-pixel position of the peak along axis, parabola through the peak and its neighbours
+    n = corr.shape[axis + 1]
+    rows = np.arange(len(corr))
+    index = [rows, peak[0], peak[1]]
+    center = corr[tuple(index)]
+    index[axis + 1] = (peak[axis] - 1) % n
+    before = corr[tuple(index)]
+    index[axis + 1] = (peak[axis] + 1) % n
+    after = corr[tuple(index)]
+    denom = before - 2 * center + after
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(denom < 0, 0.5 * (before - after) / denom, 0.0)
+    return np.clip(offset, -0.5, 0.5)
+
+def phaseCorrelation(reference, moving):
+    '''
+    Displacement (dx, dy) of moving relative to reference, by phase
+        correlation: the peak of the normalized cross-power spectrum,
+        refined to sub-pixel by a parabola.
+    reference, moving: (n, y, x) stacks of images, compared pairwise
+    
+    returns an (n, 2) float array, moving[k] ~ reference[k] shifted by it
+    '''
+    reference = np.asarray(reference, dtype=np.float32)
+    moving = np.asarray(moving, dtype=np.float32)
+    y_dim, x_dim = reference.shape[-2:]
+    # remove the mean and taper the borders, so the frame edges do not correlate
+    window = np.outer(np.hanning(y_dim), np.hanning(x_dim)).astype(np.float32)
+    def spectrum(images):
+        images = images - images.mean(axis=(-2, -1), keepdims=True)
+        return np.fft.rfft2(images * window)
+    cross = spectrum(moving) * np.conj(spectrum(reference))
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    corr = np.fft.irfft2(cross, s=(y_dim, x_dim))
+    flat = corr.reshape(len(corr), -1).argmax(axis=1)
+    peak = np.unravel_index(flat, (y_dim, x_dim))
+    dy = peak[0] + _peakOffset(corr, 0, peak)
+    dx = peak[1] + _peakOffset(corr, 1, peak)
+    # peaks past the middle are negative shifts
+    dy = np.where(dy > y_dim / 2, dy - y_dim, dy)
+    dx = np.where(dx > x_dim / 2, dx - x_dim, dx)
+    return np.stack([dx, dy], axis=1)
+
+def estimateDrift(tiff_path, channel=None, workers=None, chunk_size=16):
+    '''
+    Translation matrix of a movie without roi: the x-y drift of every
+        timepoint relative to the first, from the phase correlation of the z
+        max projections of consecutive timepoints, summed up and rounded.
+    
+    - channel: channel of the centrosomes in a 5D movie, default all channels
+    - workers: threads the frames are correlated on, in chunks of chunk_size
+        pairs of frames, default one
+    
+    returns the translation list register() takes, as roi2mat or combine:
+        [(0, 0), (x_1, y_1), ...] in pixels
+    '''
+    projections = maxProjections(tiff_path, channel=channel)
+    chunks = [(start, min(start + chunk_size, len(projections) - 1))
+              for start in range(0, len(projections) - 1, chunk_size)]
+    correlate = lambda c: phaseCorrelation(projections[c[0]:c[1]], projections[c[0] + 1:c[1] + 1])
+    if workers is None or workers <= 1:
+        steps = [correlate(c) for c in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            steps = list(pool.map(correlate, chunks))
+    steps = np.concatenate([np.zeros((1, 2))] + steps)
+    drift = np.rint(np.cumsum(steps, axis=0)).astype(int)
+    return [(int(x), int(y)) for x, y in drift]
+
+def findCanvas(translation, y_dim, x_dim):
+    '''
+    translation: per-frame integer (x, y) translations, already scaled
+    y_dim, x_dim: size of the input frames
+    
+    returns x_low, x_high, y_low, y_high: extent of the zero-padded canvas
+        that holds every translated frame, in input pixel coordinates. Frame t
+        lands at rows -y_t - y_low and columns -x_t - x_low of the canvas.
+    '''
+    translation = np.asarray(translation, dtype=int).reshape(-1, 2)
+    x_low = min(0, int((-translation[:, 0]).min(initial=0)))
+    x_high = max(x_dim, int((x_dim - translation[:, 0]).max(initial=x_dim)))
+    y_low = min(0, int((-translation[:, 1]).min(initial=0)))
+    y_high = max(y_dim, int((y_dim - translation[:, 1]).max(initial=y_dim)))
+    return x_low, x_high, y_low, y_high
+
+def _shiftSlices(shift, dim):
+    # out[i] = in[i + shift] for every i where both are inside [0, dim)
+    start = max(0, -shift)
+    stop = max(start, min(dim, dim - shift))
+    return slice(start, stop), slice(start + shift, stop + shift)
+
 def translate(im_in,translation,hi_res=True,compression=1,padzeros = True):
     '''
         input:
-        im_in: input tiff
+        im_in: input tiff, (t, z, y, x) or (t, z, c, y, x)
         translation: translation matrix
         output:
-        im_out: output tiff
+        im_out: output tiff, same dtype as im_in
+        
+        Each frame is copied as whole (z, [c], y, x) slices, with padzeros
+        the canvas grows to fit every translated frame (see findCanvas),
+        otherwise pixels shifted out of the frame are dropped.
         
         tifffile documentation: https://scikit-image.org/docs/0.12.x/api/skimage.external.tifffile.html
         '''
@@ -307,115 +798,1038 @@ def translate(im_in,translation,hi_res=True,compression=1,padzeros = True):
         translation = np.array(translation) * compression
     translation = np.array(translation).astype(int)
     
-    n_channel = 1
     if len(im_in.shape) == 5:
         # multiple channel
         print("Multiple channels detected...")
-        n_frame, n_zstep, n_channel, y_dim, x_dim = im_in.shape
     else:
         # single channel
         print("Single channel detected...")
-        n_frame, n_zstep, y_dim, x_dim = im_in.shape
+    n_frame = im_in.shape[0]
+    y_dim, x_dim = im_in.shape[-2:]
+    if len(translation) < n_frame:
+        raise IndexError("translation matrix covers {} frames, movie has {}".format(len(translation), n_frame))
     
     if padzeros == False:
         # create empty tiff
-        im_out = np.zeros(im_in.shape)
+        im_out = np.zeros_like(im_in)
         for t in range(n_frame):
-            print("Start processing t = " + str(t))
             trans_x, trans_y = translation[t]
-            for z in range(n_zstep):
-                if n_channel == 1:
-                    for y in range(y_dim):
-                        for x in range(x_dim):
-                            if (x+trans_x < 0) or (y+trans_y < 0):
-                                continue
-                            elif (x+trans_x >= x_dim) or (y+trans_y >= y_dim):
-                                continue
-                            else:
-                                im_out[t][z][y][x] = im_in[t][z][y+trans_y][x+trans_x]
-                else:
-                    for ch in range(n_channel):
-                        for y in range(y_dim):
-                            for x in range(x_dim):
-                                if (x+trans_x < 0) or (y+trans_y < 0):
-                                    continue
-                                elif (x+trans_x >= x_dim) or (y+trans_y >= y_dim):
-                                    continue
-                                else:
-                                    im_out[t][z][ch][y][x] = im_in[t][z][ch][y+trans_y][x+trans_x]
-
-    
+            out_y, in_y = _shiftSlices(trans_y, y_dim)
+            out_x, in_x = _shiftSlices(trans_x, x_dim)
+            im_out[t, ..., out_y, out_x] = im_in[t, ..., in_y, in_x]
     else:
-        # search for extrema
-        x_low, x_high  = 0, x_dim
-        y_low, y_high  = 0, y_dim
-        for t in range(n_frame):
-            trans_x, trans_y = translation[t]
-            if -trans_y < y_low:
-                y_low = -trans_y
-            if y_dim-trans_y > y_high:
-                y_high = y_dim-trans_y
-            if -trans_x < x_low:
-                x_low = -trans_x
-            if x_dim-trans_x > x_high:
-                x_high = x_dim-trans_x
-            
-            x_high, x_low, y_high, y_low = int(x_high), int(x_low), int(y_high), int(y_low)
-            x_dim_adj, y_dim_adj = x_high-x_low, y_high-y_low
-            #create empty tiff
-        if n_channel == 1:
-            im_out = np.zeros((n_frame, n_zstep, y_dim_adj, x_dim_adj))
-        else:
-            im_out = np.zeros((n_frame, n_zstep, n_channel, y_dim_adj, x_dim_adj))
+        x_low, x_high, y_low, y_high = findCanvas(translation[:n_frame], y_dim, x_dim)
+        # create empty tiff
+        im_out = np.zeros(im_in.shape[:-2] + (y_high-y_low, x_high-x_low), dtype=im_in.dtype)
         # translate
         for t in range(n_frame):
-            print("Start processing t = " + str(t))
             trans_x, trans_y = translation[t]
-            for z in range(n_zstep):
-                if n_channel==1:
-                    for y in range(y_dim):
-                        for x in range(x_dim):
-                            im_out[t][z][y-trans_y-y_low][x-trans_x-x_low] = int(im_in[t][z][y][x])
-                else:
-                    for ch in range(n_channel):
-                        for y in range(y_dim):
-                            for x in range(x_dim):
-                                im_out[t][z][ch][y-trans_y-y_low][x-trans_x-x_low] = int(im_in[t][z][ch][y][x])
+            top, left = -trans_y-y_low, -trans_x-x_low
+            im_out[t, ..., top:top+y_dim, left:left+x_dim] = im_in[t]
 
     return im_out
 
-def register(tiff_path, trans_mat, out_tiff_path, highres = True, compress = 1, pad = True):
+def _tiffWrite(tif, data, **kwargs):
+    # TiffWriter.save was renamed to TiffWriter.write in newer tifffile
+    write = getattr(tif, 'write', None) or getattr(tif, 'save')
+    return write(data, **kwargs)
+
+# lossless codecs the registered movie can be written with, without imagecodecs
+CODECS = ('zlib', 'lzma')
+
+def _tiffCodecArgs(codec=None, level=None, tile=None):
+    '''
+    keyword arguments of TiffWriter.write for a compressed and/or tiled tiff,
+        in the API of the installed tifffile (compress= before 2020.9)
+    '''
+    kwargs = {}
+    if tile is not None:
+        kwargs['tile'] = (int(tile), int(tile)) if np.isscalar(tile) else tuple(tile)
+    if codec is None:
+        return kwargs
+    if codec not in CODECS:
+        raise ValueError('codec must be one of {}, got {}'.format(CODECS, codec))
+    write = getattr(tifffile.TiffWriter, 'write', None) or getattr(tifffile.TiffWriter, 'save')
+    if 'compression' in inspect.signature(write).parameters:
+        kwargs['compression'] = codec
+        if level is not None:
+            kwargs['compressionargs'] = {'level': level}
+    else:
+        kwargs['compress'] = (codec, 6 if level is None else level)
+    return kwargs
+
+class PlaneStore(object):
+    '''
+    A movie as a chunked array store, one zlib compressed chunk per (y, x)
+        plane of every timepoint, z and channel, in the zarr (v2) directory
+        layout, so zarr.open(path) reads it too. Planes that are all zeros
+        (e.g. the padding of a registered movie) are not stored.
+    
+    PlaneStore.create(path, shape) then writeFrame for every timepoint in
+        order, then close; PlaneStore.open(path) then readPlane/readFrame,
+        which only read the chunks asked for.
+    '''
+    _CHUNK = re.compile(r'^\d+(\.\d+)+$') # chunk file names, see _key
+    
+    def __init__(self, path, shape, dtype, level=5):
+        self.path = path
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.level = level
+        self._t = 0
+    
+    @classmethod
+    def create(cls, path, shape, dtype='uint16', level=5):
+        '''
+        An empty store at path. An older store there is cleared, any other
+            existing directory is refused (ValueError) rather than emptied.
+        '''
+        if os.path.isdir(path) and os.listdir(path):
+            if not os.path.isfile(os.path.join(path, '.zarray')):
+                raise ValueError('{} exists and is not a plane store'.format(path))
+            for name in os.listdir(path):
+                if name == '.zarray' or cls._CHUNK.match(name):
+                    os.remove(os.path.join(path, name))
+        os.makedirs(path, exist_ok=True)
+        return cls(path, shape, dtype, level)
+    
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, '.zarray')) as f:
+            meta = json.load(f)
+        return cls(path, meta['shape'], meta['dtype'], meta['compressor']['level'])
+    
+    def _key(self, index):
+        return os.path.join(self.path, '.'.join(str(int(i)) for i in index) + '.0.0')
+    
+    def writeFrame(self, frame):
+        '''
+        Writes the next timepoint, a (z, y, x) or (z, c, y, x) array
+        '''
+        frame = np.ascontiguousarray(frame, dtype=self.dtype)
+        for index in np.ndindex(*frame.shape[:-2]):
+            plane = frame[index]
+            if plane.any():
+                with open(self._key((self._t,) + index), 'wb') as f:
+                    f.write(zlib.compress(plane.tobytes(), self.level))
+        self._t += 1
+    
+    def close(self):
+        # the array metadata last, a store without it is incomplete
+        meta = {'zarr_format': 2, 'shape': list(self.shape), 'chunks': [1] * (len(self.shape) - 2) + list(self.shape[-2:]),
+                'dtype': self.dtype.str, 'compressor': {'id': 'zlib', 'level': self.level}, 'fill_value': 0,
+                'order': 'C', 'filters': None, 'dimension_separator': '.'}
+        with open(os.path.join(self.path, '.zarray'), 'w') as f:
+            json.dump(meta, f, indent=1)
+    
+    def readPlane(self, index):
+        '''
+        The (y, x) plane at index, (t, z) or (t, z, c)
+        '''
+        try:
+            with open(self._key(index), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except FileNotFoundError: # all zeros
+            return np.zeros(self.shape[-2:], dtype=self.dtype)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.shape[-2:]).copy()
+    
+    def readFrame(self, t):
+        frame = np.empty(self.shape[1:], dtype=self.dtype)
+        for index in np.ndindex(*self.shape[1:-2]):
+            frame[index] = self.readPlane((t,) + index)
+        return frame
+
+def hyperstackInfo(tif):
+    '''
+    What the registered movie keeps of the ImageJ metadata of an open source
+        tiff: the x-y resolution tags and the voxel depth, unit and frame
+        interval of the ImageJ description (each only if present)
+    '''
+    info = {'metadata': {}}
+    tags = tif.pages[0].tags
+    if 'XResolution' in tags and 'YResolution' in tags:
+        info['resolution'] = (tags['XResolution'].value, tags['YResolution'].value)
+    for key in ('spacing', 'unit', 'finterval'):
+        if key in (tif.imagej_metadata or {}):
+            info['metadata'][key] = tif.imagej_metadata[key]
+    return info
+
+# largest tiff written as a classic (ImageJ readable) tiff, as tifffile does
+_CLASSIC_TIFF_BYTES = 2**32 - 2**25
+
+def _pages(frames, page_shape, tile=None):
+    # the (y, x) pages of a stream of timepoints, or with tile their tiles,
+    # row by row and zero padded at the edges, as TiffWriter.write takes them
+    for frame in frames:
+        for page in np.ascontiguousarray(frame).reshape((-1,) + tuple(page_shape)):
+            if tile is None:
+                yield page
+                continue
+            for y in range(0, page.shape[0], tile[0]):
+                for x in range(0, page.shape[1], tile[1]):
+                    block = page[y:y + tile[0], x:x + tile[1]]
+                    if block.shape != tuple(tile):
+                        block = np.pad(block, [(0, tile[0] - block.shape[0]), (0, tile[1] - block.shape[1])])
+                    yield np.ascontiguousarray(block)
+
+@contextlib.contextmanager
+def _pushFrames(consume, depth=2):
+    '''
+    Yields a function pushing items to consume(iterator), which runs in its
+        own thread and gets the items in order, at most depth waiting. For
+        writers that pull their data (TiffWriter.write of an iterator) fed
+        one timepoint at a time. An error of consume is raised on exit.
+    '''
+    done = object()
+    items = queue.Queue(depth)
+    errors = []
+    finished = threading.Event() # consume got done, nothing more will come
+
+    def pull():
+        while True:
+            item = items.get()
+            if item is done:
+                finished.set()
+                return
+            yield item
+
+    def run():
+        try:
+            consume(pull())
+        except BaseException as e:
+            errors.append(e)
+        # keep draining so the producer never blocks, unless consume
+        # already read to the end
+        while not finished.is_set() and items.get() is not done:
+            pass
+
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    try:
+        yield lambda item: None if errors else items.put(item)
+    finally:
+        items.put(done)
+        worker.join()
+    if errors:
+        raise errors[0]
+
+@contextlib.contextmanager
+def _frameWriter(out_path, shape, bigtiff=True, codec=None, level=None, tile=None, hyperstack=None, dtype='uint16'):
+    '''
+    Yields a function writing the registered movie one timepoint at a time:
+        a PlaneStore for a path ending in .zarr, else a tiff, uncompressed
+        by default or with codec (see CODECS) and tile.
+    shape: shape of the registered movie, dtype: its data type
+    hyperstack: metadata of the source (see hyperstackInfo). The tiff is
+        written as one ImageJ hyperstack (t, z, [c], y, x) with it, so Fiji
+        and tifffile see the whole movie with the dimensions, voxel size and
+        frame interval of the original movie. bigtiff only if the movie
+        needs it.
+    '''
+    if out_path.endswith('.zarr'):
+        store = PlaneStore.create(out_path, shape, dtype=dtype, level=5 if level is None else level)
+        yield store.writeFrame
+        store.close()
+        return
+    # every timepoint written as (z, c, y, x) so the series is t, z, c
+    hyperstack = hyperstack or {'metadata': {}}
+    metadata = dict(hyperstack['metadata'])
+    if len(shape) == 5 and shape[2] > 1:
+        metadata['mode'] = 'composite'
+    kwargs = {'photometric': 'minisblack', 'metadata': metadata}
+    if 'resolution' in hyperstack:
+        kwargs['resolution'] = hyperstack['resolution']
+    frame_shape = tuple(shape[1:2]) + (tuple(shape[2:3]) if len(shape) == 5 else (1,)) + tuple(shape[-2:])
+    bigtiff = bigtiff and np.prod(shape, dtype=np.int64) * np.dtype(dtype).itemsize >= _CLASSIC_TIFF_BYTES
+    codec_kwargs = _tiffCodecArgs(codec, level, tile)
+    with tifffile.TiffWriter(out_path, bigtiff = bigtiff, imagej = True) as tif:
+        if codec_kwargs:
+            # one series of compressed pages (or tiles), pulled from the
+            # timepoints as they are written
+            kwargs.update(codec_kwargs)
+            series = (shape[0],) + frame_shape
+            with _pushFrames(lambda frames: _tiffWrite(
+                    tif, _pages(frames, shape[-2:], kwargs.get('tile')), shape=series, dtype=dtype, **kwargs)) as push:
+                yield push
+            return
+        # uncompressed timepoints make one contiguous series, which can be
+        # memory mapped
+        kwargs['contiguous'] = True
+        yield lambda frame: _tiffWrite(tif, np.asarray(frame, dtype=dtype).reshape(frame_shape), **kwargs)
+
+def _tiffFrames(tiff_path):
+    '''
+    returns shape, pages_per_frame, frames: the shape of the first series, the
+        number of pages holding one timepoint, and a read-only memory map of
+        the series when the file is uncompressed and contiguous (else None).
+        A tiff of series of the same shape (a compressed registered movie of
+        earlier versions, one timepoint per series) is read as one series of
+        them.
+    '''
+    with tifffile.TiffFile(tiff_path) as tif:
+        shape = tuple(tif.series[0].shape)
+        if len(tif.series) > 1 and all(tuple(s.shape) == shape for s in tif.series):
+            shape = (len(tif.series),) + shape
+        page_size = int(np.prod(tif.pages[0].shape, dtype=np.int64))
+    pages_per_frame = int(np.prod(shape[1:], dtype=np.int64)) // page_size
+    try:
+        frames = tifffile.memmap(tiff_path, mode='r')
+    except (ValueError, TypeError):
+        frames = None
+    if frames is not None and frames.shape != shape:
+        frames = None
+    return shape, pages_per_frame, frames
+
+def _iterTiffFrames(tiff_path):
+    '''
+    Yields the timepoints of a tiff one at a time, as (z, y, x) or (z, c, y, x)
+        arrays, without reading the rest of the movie. Uses a memory map when
+        the file is uncompressed and contiguous, else reads one timepoint worth
+        of pages at a time (or of chunks, for a PlaneStore).
+    '''
+    if isinstance(tiff_path, RegisteredStack):
+        yield from tiff_path.frames()
+        return
+    if os.path.isdir(tiff_path):
+        store = PlaneStore.open(tiff_path)
+        for t in range(store.shape[0]):
+            yield store.readFrame(t)
+        return
+    shape, pages_per_frame, frames = _tiffFrames(tiff_path)
+    if frames is not None:
+        for t in range(shape[0]):
+            yield np.array(frames[t])
+        return
+    with tifffile.TiffFile(tiff_path) as tif:
+        for t in range(shape[0]):
+            start = t * pages_per_frame
+            frame = tif.asarray(key=slice(start, start + pages_per_frame))
+            yield frame.reshape(shape[1:])
+
+def _translateFrame(frame, trans_x, trans_y, padzeros, canvas, dtype=None):
+    '''
+    Translates a single (z, [c], y, x) frame, see translate().
+    canvas: (x_low, x_high, y_low, y_high) from findCanvas, used with padzeros
+    '''
+    y_dim, x_dim = frame.shape[-2:]
+    if padzeros == False:
+        frame_out = np.zeros(frame.shape, dtype=dtype or frame.dtype)
+        out_y, in_y = _shiftSlices(trans_y, y_dim)
+        out_x, in_x = _shiftSlices(trans_x, x_dim)
+        frame_out[..., out_y, out_x] = frame[..., in_y, in_x]
+    else:
+        x_low, x_high, y_low, y_high = canvas
+        frame_out = np.zeros(frame.shape[:-2] + (y_high-y_low, x_high-x_low), dtype=dtype or frame.dtype)
+        top, left = -trans_y-y_low, -trans_x-x_low
+        frame_out[..., top:top+y_dim, left:left+x_dim] = frame
+    return frame_out
+
+def _runPipeline(source, work, sink, depth=2):
+    '''
+    Runs source -> work -> sink with the reading and the writing each in its
+        own thread, connected by queues of at most depth items, so reading,
+        shifting and writing overlap while only a few frames are in memory.
+    source: iterable of items
+    work: function applied to each item in the calling thread
+    sink: function consuming the results, in order
+    '''
+    done = object()
+    q_in, q_out = queue.Queue(depth), queue.Queue(depth)
+    errors = []
+
+    def read():
+        try:
+            for item in source:
+                q_in.put(item)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            q_in.put(done)
+
+    def write():
+        try:
+            while True:
+                item = q_out.get()
+                if item is done:
+                    return
+                if not errors:
+                    sink(item)
+        except BaseException as e:
+            errors.append(e)
+            # keep draining so the producer never blocks
+            while q_out.get() is not done:
+                pass
+
+    reader = threading.Thread(target=read, daemon=True)
+    writer = threading.Thread(target=write, daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            item = q_in.get()
+            if item is done:
+                break
+            if not errors:
+                q_out.put(work(item))
+    except BaseException as e:
+        errors.append(e)
+        while q_in.get() is not done:
+            pass
+    finally:
+        q_out.put(done)
+        writer.join()
+        reader.join()
+    if errors:
+        raise errors[0]
+
+def register_stream(tiff_path, trans_mat, out_tiff_path, highres = True, compress = 1, pad = True,
+                    codec = None, level = None, tile = None):
+    '''
+        Same as register(), but reads, translates and writes one timepoint at
+        a time (see _runPipeline), so peak memory is a few frames whatever the
+        length of the movie. The padded canvas is sized up front from trans_mat.
+        
+        Returns the tags of the first page of the input, like register().
+        '''
+    with tifffile.TiffFile(tiff_path) as tif:
+        shape = tuple(tif.series[0].shape)
+        tif_tags = tif.pages[0].tags.values()
+        hyperstack = hyperstackInfo(tif)
+    n_frame = shape[0]
+    y_dim, x_dim = shape[-2:]
+    print("Multiple channels detected..." if len(shape) == 5 else "Single channel detected...")
+    
+    translation = np.array(trans_mat)
+    if highres == True:
+        translation = translation * compress
+    translation = translation.astype(int)
+    if len(translation) < n_frame:
+        raise IndexError("translation matrix covers {} frames, movie has {}".format(len(translation), n_frame))
+    canvas = findCanvas(translation[:n_frame], y_dim, x_dim)
+    x_low, x_high, y_low, y_high = canvas if pad else (0, x_dim, 0, y_dim)
+    
+    def shift(item):
+        t, frame = item
+        trans_x, trans_y = translation[t]
+        return _translateFrame(frame, trans_x, trans_y, pad, canvas, dtype='uint16')
+    
+    # save registered movie, see _frameWriter
+    with _frameWriter(out_tiff_path, shape[:-2] + (y_high - y_low, x_high - x_low), bigtiff=highres,
+                      codec=codec, level=level, tile=tile, hyperstack=hyperstack) as write:
+        _runPipeline(enumerate(_iterTiffFrames(tiff_path)), shift, write)
+    writeRegistrationInfo(out_tiff_path, tiff_path, translation, shape, pad)
+    return tif_tags
+
+def register(tiff_path, trans_mat, out_tiff_path, highres = True, compress = 1, pad = True, stream = False,
+             codec = None, level = None, tile = None):
     '''
         tiff_path: tiff file name
         trans_mat: translation matrix, can be obtained by roi2mat()
         highres: optional, if set to True, will multiply the trans_mat by compress (which is set to 3 by default)
         compress: as above
         pad: whehther or not pad the periphery to zeros. If false, will crop the tiff
+        stream: if True, register one timepoint at a time (see register_stream), for movies larger than memory
+        codec, level: lossless compression of the output tiff, 'zlib' or 'lzma' (see CODECS), default none.
+            The output is an ImageJ hyperstack with the voxel size and frame interval of the input
+        tile: optional (y, x) tile size (or one int) of the output tiff, so readers decode only the tiles they need
+        An out_tiff_path ending in .zarr writes a chunked store instead, one compressed chunk per plane (see PlaneStore)
         
         This function returns a dict of metadata, and writes the tiff to current working directory
         
         '''
+    if stream:
+        return register_stream(tiff_path, trans_mat, out_tiff_path, highres=highres, compress=compress, pad=pad,
+                               codec=codec, level=level, tile=tile)
     with tifffile.TiffFile(tiff_path) as tif:
         # read tiff
         im_in = tif.asarray()
         # read metadata as tif_tags (dict)
         tif_tags = tif.pages[0].tags.values()
+        # voxel size and frame interval, kept in the registered hyperstack
+        hyperstack = hyperstackInfo(tif)
     
     
     # register using trans_mat
     im_out = translate(im_in,trans_mat,hi_res=highres,compression=compress,padzeros=pad)
-    im_out = im_out.astype('uint16')
+    im_out = im_out.astype('uint16', copy=False)
     
-    # save registered tiff, no compression
-    with tifffile.TiffWriter(out_tiff_path, bigtiff = highres) as tif:
+    # save registered movie, see _frameWriter
+    with _frameWriter(out_tiff_path, im_out.shape, bigtiff=highres, codec=codec, level=level, tile=tile,
+                      hyperstack=hyperstack) as write:
         for i in range(im_out.shape[0]):
-            tif.save(im_out[i])
+            write(im_out[i])
+    translation = np.array(trans_mat)
+    if highres == True:
+        translation = translation * compress
+    writeRegistrationInfo(out_tiff_path, tiff_path, translation.astype(int), im_in.shape, pad)
     return tif_tags
 
+class RegisteredStack(object):
+    '''
+    The registered movie of register(), without writing it: a read-only view
+        of the original tiff that translates the planes as they are read.
+    
+    Indexed like the array register() writes, (t, z, [c], y, x), with ints,
+        slices, lists and Ellipsis, e.g. stack[10, 3] is one registered plane
+        and stack[:, 0] the first plane of every timepoint. Only the pages of
+        the requested planes are read (memory-mapped when the tiff is
+        uncompressed and contiguous), the last cache_size decoded pages are
+        kept. export() writes the registered movie when a file is needed
+        (Fiji, TrackMate).
+    
+    findCroppedDim, maxProjections and estimateDrift accept a RegisteredStack
+        in place of a registered tiff.
+    
+    - tiff_path, trans_mat, highres, compress, pad: see register
+    '''
+    def __init__(self, tiff_path, trans_mat, highres=True, compress=1, pad=True, cache_size=64, dtype='uint16'):
+        self.tiff_path = tiff_path
+        self.pad = pad
+        self.cache_size = cache_size
+        self.dtype = np.dtype(dtype)
+        self.source_shape, pages_per_frame, self._frames = _tiffFrames(tiff_path)
+        if pages_per_frame != int(np.prod(self.source_shape[1:-2], dtype=np.int64)):
+            raise ValueError('{}: expected one page per (y, x) plane'.format(tiff_path))
+        n_frame = self.source_shape[0]
+        y_dim, x_dim = self.source_shape[-2:]
+        translation = np.array(trans_mat)
+        if highres == True:
+            translation = translation * compress
+        translation = translation.astype(int)
+        if len(translation) < n_frame:
+            raise IndexError("translation matrix covers {} frames, movie has {}".format(len(translation), n_frame))
+        self.translation = translation[:n_frame]
+        self.canvas = findCanvas(self.translation, y_dim, x_dim)
+        x_low, x_high, y_low, y_high = self.canvas if pad else (0, x_dim, 0, y_dim)
+        self.shape = self.source_shape[:-2] + (y_high - y_low, x_high - x_low)
+        self._tif = None
+        self._pages = OrderedDict() # page index -> decoded page, least recently used first
+    
+    @classmethod
+    def fromMovie(cls, root, movie_name, pad=True, **kwargs):
+        '''
+        The registered view of root/<movie>/<movie>.tif, as register_movie
+            would write it: with root/<movie>/drift.csv when there is one (see
+            estimateDrift), else the roi lines in root/<movie>/roi/
+        '''
+        folder = os.path.join(root, movie_name)
+        drift = os.path.join(folder, 'drift.csv')
+        if os.path.exists(drift):
+            trans_mat = pd.read_csv(drift, index_col=0)[['X', 'Y']].to_numpy()
+        else:
+            csv_path = os.path.join(folder, 'roi', '')
+            trans_mat = combine(csv_path, n_csv=len(next(os.walk(csv_path))[2]))
+        return cls(os.path.join(folder, movie_name + '.tif'), trans_mat, pad=pad, **kwargs)
+    
+    @property
+    def ndim(self):
+        return len(self.shape)
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def _page(self, index):
+        # the (y, x) source plane at (t, z[, c])
+        if self._frames is not None:
+            return self._frames[index]
+        i = int(np.ravel_multi_index(index, self.source_shape[:-2]))
+        if i in self._pages:
+            self._pages.move_to_end(i)
+            return self._pages[i]
+        if self._tif is None:
+            self._tif = tifffile.TiffFile(self.tiff_path)
+        page = self._tif.pages[i].asarray()
+        self._pages[i] = page
+        if len(self._pages) > self.cache_size:
+            self._pages.popitem(last=False)
+        return page
+    
+    def plane(self, index):
+        '''
+        The registered (y, x) plane at (t, z[, c])
+        '''
+        trans_x, trans_y = self.translation[index[0]]
+        return _translateFrame(self._page(tuple(index)), trans_x, trans_y, self.pad, self.canvas, dtype=self.dtype)
+    
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for a stack of shape {}'.format(self.shape))
+        key = key + (slice(None),) * (self.ndim - len(key))
+        lead = [np.arange(n)[k] for n, k in zip(self.shape[:-2], key[:-2])]
+        planes = [self.plane(index)[key[-2], key[-1]] for index in np.broadcast(*np.ix_(*[np.atleast_1d(a) for a in lead]))]
+        out = np.stack(planes).reshape(tuple(np.size(a) for a in lead) + planes[0].shape)
+        # an int index drops its axis, as in numpy
+        return out[tuple(0 if np.ndim(a) == 0 else slice(None) for a in lead)]
+    
+    def __array__(self, dtype=None, copy=None):
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
+    
+    def frames(self):
+        '''
+        Yields the registered timepoints, (z, y, x) or (z, c, y, x)
+        '''
+        for t in range(self.shape[0]):
+            yield self[t]
+    
+    def firstPlanes(self):
+        '''
+        Yields the first registered plane (z = 0, channel 0) of every timepoint
+        '''
+        for t in range(self.shape[0]):
+            yield self.plane((t,) + (0,) * (self.ndim - 3))
+    
+    def croppedDim(self):
+        '''
+        top, bottom, left, right as findCroppedDim, from the translation
+        '''
+        return bordersOf(findFrameBorders(self.translation, *self.source_shape[-2:], pad=self.pad))
+    
+    def export(self, out_tiff_path, highres=True, codec=None, level=None, tile=None):
+        '''
+        Writes the registered movie and its sidecar, the same files as
+            register() with the same arguments, one timepoint at a time
+        '''
+        with tifffile.TiffFile(self.tiff_path) as tif:
+            hyperstack = hyperstackInfo(tif)
+        with _frameWriter(out_tiff_path, self.shape, bigtiff=highres, codec=codec, level=level, tile=tile,
+                          hyperstack=hyperstack, dtype=self.dtype) as write:
+            _runPipeline(range(self.shape[0]), lambda t: self[t], write)
+        return writeRegistrationInfo(out_tiff_path, self.tiff_path, self.translation, self.source_shape, self.pad)
+    
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+        self._pages.clear()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def registerModel(model, trans_mat, compress=1, pad=True, calibration=None):
+    '''
+    The TrackMateModel of a movie tracked before registration, moved into the
+        registered movie: the model TrackMate would give on the output of
+        register(tiff, trans_mat, compress=compress, pad=pad), for integer x-y
+        translations. Spot, edge and track positions are shifted in one pass,
+        the geometry is that of the registered movie.
+    
+    - model: TrackMateModel of the original movie (see TrackMateModel.load)
+    - trans_mat, compress, pad: see register
+    - calibration: pixel size (dx, dy) in the units of the positions, default
+        the one of the xml
+    '''
+    calibration = calibration or model.calibration
+    if calibration is None:
+        raise ValueError('pixel size not found in the xml, pass calibration=(dx, dy)')
+    if model.geometry is None:
+        raise ValueError('movie size not found in the xml')
+    x_dim, y_dim, n_frame = model.geometry[0] + 1, model.geometry[1] + 1, model.geometry[3] + 1
+    translation = (np.asarray(trans_mat) * compress).astype(int).reshape(-1, 2)
+    if len(translation) < n_frame:
+        raise IndexError("translation matrix covers {} frames, movie has {}".format(len(translation), n_frame))
+    translation = translation[:n_frame]
+    x_low, x_high, y_low, y_high = findCanvas(translation, y_dim, x_dim) if pad else (0, x_dim, 0, y_dim)
+    # per frame shift of the positions, (x, y) in calibrated units
+    shift = (translation + [x_low, y_low]) * np.asarray(calibration, dtype=np.float64)
+    
+    spots = model.spots.copy()
+    spot_shift = shift[spots['FRAME'].to_numpy(np.int64)]
+    spots['POSITION_X'] = spots['POSITION_X'].to_numpy(np.float64) - spot_shift[:, 0]
+    spots['POSITION_Y'] = spots['POSITION_Y'].to_numpy(np.float64) - spot_shift[:, 1]
+    ids = pd.Index(spots['ID'])
+    
+    edges = model.edges.copy()
+    source = spot_shift[ids.get_indexer(edges['SPOT_SOURCE_ID'])]
+    target = spot_shift[ids.get_indexer(edges['SPOT_TARGET_ID'])]
+    for k, axis in enumerate('XY'):
+        column = 'EDGE_{}_LOCATION'.format(axis)
+        if column in edges:
+            edges[column] = edges[column].to_numpy(np.float64) - (source[:, k] + target[:, k]) / 2
+    
+    # a track position is the mean of its spots, shifted by their mean shift
+    tracks = model.tracks.copy()
+    members = np.unique(np.stack([np.r_[edges['TRACK_ID'], edges['TRACK_ID']],
+                                  ids.get_indexer(np.r_[edges['SPOT_SOURCE_ID'], edges['SPOT_TARGET_ID']])],
+                                 axis=1), axis=0)
+    rows = pd.Index(tracks['TRACK_ID']).get_indexer(members[:, 0])
+    members, rows = members[rows >= 0], rows[rows >= 0]
+    n = np.bincount(rows, minlength=len(tracks))
+    for k, axis in enumerate('XY'):
+        column = 'TRACK_{}_LOCATION'.format(axis)
+        if column in tracks:
+            total = np.bincount(rows, weights=spot_shift[members[:, 1], k], minlength=len(tracks))
+            tracks[column] = tracks[column].to_numpy(np.float64) - np.divide(total, n, out=np.zeros(len(tracks)),
+                                                                             where=n > 0)
+    geometry = (x_high - x_low - 1, y_high - y_low - 1) + tuple(model.geometry[2:])
+    return TrackMateModel(spots, tracks, edges, geometry=geometry, framerate=model.framerate,
+                          calibration=tuple(calibration))
+
+################################################
+# Columnar storage
+################################################
+class ColumnTable(object):
+    '''
+    Records stored as parallel NumPy columns, one row per record, instead of
+        one Python object per spot, track or edge.
+    
+    - columns: dict of 1D arrays of equal length
+    - key: name of the ID column, rows(ids) maps IDs to rows
+    '''
+    def __init__(self, columns, key='id'):
+        self.columns = OrderedDict((name, np.asarray(values)) for name, values in columns.items())
+        self.key = key
+        self._sorter = None
+    
+    def __len__(self):
+        return len(self.columns[self.key])
+    
+    def __getitem__(self, name):
+        return self.columns[name]
+    
+    def __setitem__(self, name, values):
+        self.columns[name] = np.asarray(values)
+        if name == self.key:
+            self._sorter = None
+    
+    def rows(self, ids, strict=True):
+        '''
+        Returns the row of every ID in ids. Unknown IDs raise a KeyError, or
+            get row -1 with strict=False.
+        '''
+        keys = self.columns[self.key]
+        if self._sorter is None:
+            self._sorter = np.argsort(keys, kind='stable')
+        ids = np.asarray(ids)
+        if len(keys) == 0:
+            found = np.full(ids.shape, -1, dtype=np.int64)
+        else:
+            found = self._sorter[np.minimum(np.searchsorted(keys, ids, sorter=self._sorter), len(keys) - 1)]
+            found[keys[found] != ids] = -1
+        if strict and (found < 0).any():
+            raise KeyError(ids[found < 0].flat[0].item())
+        return found
+    
+    def take(self, rows):
+        return ColumnTable(OrderedDict((name, values[rows]) for name, values in self.columns.items()), key=self.key)
+    
+    def todf(self):
+        return pd.DataFrame(self.columns)
+
+
+def _record(cls, table, row):
+    # one record object (spot, track, edge) filled from a table row
+    obj = cls()
+    for name in cls.__slots__:
+        if name in table.columns:
+            setattr(obj, name, table.columns[name][row].item())
+    return obj
+
+
+class _RowMap(Mapping):
+    '''
+    Read-only dict-like view ID -> record object of a ColumnTable, the
+        records are only built when asked for
+    '''
+    def __init__(self, table, cls):
+        self.table = table
+        self.cls = cls
+    
+    def __getitem__(self, key):
+        return _record(self.cls, self.table, self.table.rows([key])[0])
+    
+    def __iter__(self):
+        return iter(self.table[self.table.key].tolist())
+    
+    def __len__(self):
+        return len(self.table)
+
+
+class _EdgeMap(Mapping):
+    '''
+    Read-only dict-like view track ID -> {frame: source spot ID} of an edge
+        table (see edgeTable)
+    '''
+    def __init__(self, edges):
+        self.table = edges
+    
+    def span(self, track_id):
+        # rows of the track, the table is sorted by track
+        track_ids = self.table['track_id']
+        return (np.searchsorted(track_ids, track_id, side='left'),
+                np.searchsorted(track_ids, track_id, side='right'))
+    
+    def __getitem__(self, track_id):
+        lo, hi = self.span(track_id)
+        if lo == hi:
+            raise KeyError(track_id)
+        return dict(zip(self.table['t'][lo:hi].tolist(), self.table['source'][lo:hi].tolist()))
+    
+    def __iter__(self):
+        return iter(np.unique(self.table['track_id']).tolist())
+    
+    def __len__(self):
+        return len(np.unique(self.table['track_id']))
+
+
+class _RecordList(Sequence):
+    '''
+    Read-only list-like view of the rows of a dataframe as record objects
+        (e.g. cells), the records are only built when asked for
+    '''
+    def __init__(self, df, make):
+        self.df = df
+        self.make = make
+    
+    def __len__(self):
+        return len(self.df)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.make(row) for row in self.df.iloc[i].itertuples(index=False)]
+        return self.make(next(self.df.iloc[[i]].itertuples(index=False)))
+    
+    def __iter__(self):
+        return (self.make(row) for row in self.df.itertuples(index=False))
+
+
+def spotTable(spots):
+    '''
+    Spot table of a spots dataframe (see parseSpots), one row per spot
+    '''
+    return ColumnTable(OrderedDict([
+        ('id', spots['ID'].to_numpy(np.int64)),
+        ('x', spots['POSITION_X'].to_numpy(np.float64)),
+        ('y', spots['POSITION_Y'].to_numpy(np.float64)),
+        ('z', spots['POSITION_Z'].to_numpy(np.float64)),
+        ('t', spots['FRAME'].to_numpy(np.int64)),
+        ('diam', spots['ESTIMATED_DIAMETER'].to_numpy(np.float64)),
+        ('maxInt', spots['MAX_INTENSITY'].to_numpy(np.float64)),
+        ('contrast', spots['CONTRAST'].to_numpy(np.float64))]))
+
+
+def edgeTable(edges, framerate):
+    '''
+    Edge table of an edges dataframe (see parseTracks), sorted by track and
+        frame, one row per track and frame. Edges are keyed by the frame of
+        EDGE_TIME, when two edges of a track share a frame the last one in
+        the xml is kept.
+    '''
+    track_id = edges['TRACK_ID'].to_numpy(np.int64)
+    t = edge2frame(edges['EDGE_TIME'].to_numpy(np.float64), framerate)
+    source = edges['SPOT_SOURCE_ID'].to_numpy(np.int64)
+    target = edges['SPOT_TARGET_ID'].to_numpy(np.int64)
+    order = np.lexsort((t, track_id))
+    track_id, t, source, target = track_id[order], t[order], source[order], target[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (track_id[1:] != track_id[:-1]) | (t[1:] != t[:-1])
+    return ColumnTable(OrderedDict([
+        ('track_id', track_id[last]),
+        ('t', t[last]),
+        ('source', source[last]),
+        ('target', target[last])]), key='track_id')
+
+
+def trackTable(tracks, edges, spots, framerate):
+    '''
+    Track table of a tracks dataframe (see parseTracks), one row per track,
+        t_i and t_f are frames. The mean diameter, contrast and max intensity
+        of the spots of every track between t_i and t_f (see findTrackInfo)
+        are computed at once, 0 for tracks without spots.
+    
+    - edges: edge table (see edgeTable)
+    - spots: spot table (see spotTable)
+    '''
+    table = ColumnTable(OrderedDict([
+        ('id', tracks['TRACK_ID'].to_numpy(np.int64)),
+        ('x', tracks['TRACK_X_LOCATION'].to_numpy(np.float64)),
+        ('y', tracks['TRACK_Y_LOCATION'].to_numpy(np.float64)),
+        ('z', tracks['TRACK_Z_LOCATION'].to_numpy(np.float64)),
+        ('t_i', time2frame(tracks['TRACK_START'].to_numpy(np.float64), framerate)),
+        ('t_f', time2frame(tracks['TRACK_STOP'].to_numpy(np.float64), framerate)),
+        ('duration', tracks['TRACK_DURATION'].to_numpy(np.float64))]))
+    owner = table.rows(edges['track_id'], strict=False)
+    t = edges['t']
+    inside = (owner >= 0)
+    inside[inside] = (t[inside] >= table['t_i'][owner[inside]]) & (t[inside] <= table['t_f'][owner[inside]])
+    owner = owner[inside]
+    spot_rows = spots.rows(edges['source'][inside])
+    n = np.bincount(owner, minlength=len(table))
+    for name, column in (('diameter', 'diam'), ('contrast', 'contrast'), ('intensity', 'maxInt')):
+        total = np.bincount(owner, weights=spots[column][spot_rows], minlength=len(table))
+        table[name] = np.divide(total, n, out=np.zeros(len(table)), where=n > 0)
+    return table
+
+
+def _trackSpots(trackIDs, tracks, edges):
+    '''
+    Spots of every track of trackIDs from t_i up to (not including) t_f, in
+        frame order, as in linkID. Returns two arrays: the position in
+        trackIDs of the track of each spot, and the spot IDs.
+    
+    - tracks: track table (see trackTable)
+    - edges: edge map (see _EdgeMap)
+    '''
+    trackIDs = np.asarray(trackIDs, dtype=np.int64)
+    rows = tracks.rows(trackIDs)
+    lo, hi = edges.span(trackIDs)
+    n = hi - lo
+    owner = np.repeat(np.arange(len(trackIDs)), n)
+    e = np.repeat(lo - (np.cumsum(n) - n), n) + np.arange(n.sum())
+    t = edges.table['t'][e]
+    inside = (t >= tracks['t_i'][rows][owner]) & (t < tracks['t_f'][rows][owner])
+    return owner[inside], edges.table['source'][e[inside]]
+
+
+def _linkTables(trackIDList, tracks, edges):
+    # linkID on a track table and an edge map
+    trackIDList = list(trackIDList)
+    track2spot = {trackID: [] for trackID in trackIDList}
+    spot2track = {}
+    owner, spotIDs = _trackSpots(trackIDList, tracks, edges)
+    for k, spotID in zip(owner.tolist(), spotIDs.tolist()):
+        track2spot[trackIDList[k]].append(spotID)
+        spot2track[spotID] = trackIDList[k]
+    return track2spot, spot2track
+
+
+################################################
+# Instrumentation
+################################################
+def _rssMiB():
+    # resident set size of this process now, None where /proc is missing
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _peakRssMiB():
+    # peak resident set size of this process (since the last _resetPeakRss)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10 # bytes on macOS, KiB elsewhere
+
+def _resetPeakRss():
+    # linux only: start measuring the peak rss again from the current rss
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class Profiler(object):
+    '''
+    Opt-in instrumentation of the pairing of one movie:
+    - per stage (parse, borders, tracks, candidates, features, predict,
+        output): wall time and resident memory (at start, at end and peak
+        during the stage where the OS can reset the peak, else the process
+        peak so far)
+    - counters, e.g. how many track pairs every filter rejected
+    - a debug log of the rejected pairs, a random sample of them
+    
+    A disabled profiler (the default of TrackPairer) only keeps the counters.
+    
+    - movie: name in the report
+    - debug_path: file receiving the sampled rejected pairs, none by default
+    - sample: fraction of the rejected pairs written to debug_path
+    '''
+    def __init__(self, movie=None, debug_path=None, sample=0.01, seed=0, enabled=True):
+        self.movie = movie
+        self.enabled = enabled
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.sample = sample
+        self._rng = random.Random(seed)
+        self.debug_path = debug_path
+        self._debug = None # opened on the first rejected pair
+        self._depth = 0
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Times the block as stage name. A stage entered again adds up, a stage
+            inside another stage is not measured on its own.
+        '''
+        if not self.enabled or self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        record = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'rss_start_mib': _rssMiB(),
+                                               'rss_end_mib': None, 'peak_rss_mib': None})
+        reset = _resetPeakRss()
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['seconds'] += time.perf_counter() - start
+            self._depth -= 1
+            record['calls'] += 1
+            record['rss_end_mib'] = _rssMiB()
+            peak = _peakRssMiB()
+            if peak is not None:
+                record['peak_rss_mib'] = max(peak, record['peak_rss_mib'] or 0)
+            record['peak_since_start'] = reset
+    
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+    
+    def reject(self, name, ids_i, ids_j, reason):
+        '''
+        Counts the pairs (ids_i[k], ids_j[k]) rejected by filter name, and
+            writes a sample of them to the debug log
+        '''
+        self.count(name, len(ids_i))
+        if self.debug_path is None or not len(ids_i):
+            return
+        if self._debug is None:
+            self._debug = open(self.debug_path, 'w')
+        for a, b in zip(np.asarray(ids_i).tolist(), np.asarray(ids_j).tolist()):
+            if self._rng.random() < self.sample:
+                self._debug.write(str(a) + ' and ' + str(b) + ' not pair: ' + reason + '\n')
+    
+    def report(self):
+        return {'movie': self.movie, 'stages': self.stages, 'counters': self.counters}
+    
+    def save(self, path):
+        '''
+        Writes the report as json
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+    
+    def close(self):
+        if self._debug is not None:
+            self._debug.close()
+            self._debug = None
+
 ################################################
 # Cell object
 ################################################
 class cell(object):
+    __slots__ = ('centID_i', 'centID_j', 't_overlap', 't_cong', 'sl_i', 'sl_f', 'sl_min', 'sl_max',
+                 'center', 'center_stdev', 'normal_stdev', 'dist2border', 'diameter', 'intensity', 'contrast')
     def __init__(self):
         self.centID_i = None # track object, i
         self.centID_j = None # track object, j
@@ -429,7 +1843,7 @@ class cell(object):
         self.center_stdev = None
         self.normal_stdev = None
         self.dist2border = None # dist from the center of cell to closest tiff border
-        self.diam = None
+        self.diameter = None
         self.intensity = None
         self.contrast = None
         
@@ -437,6 +1851,8 @@ class cell(object):
 # Spot object
 ############################################
 class spot(object):
+    __slots__ = ('x', 'y', 'z', 't', 'id', 'raw_int', 'Nbr', 'currLoc', 'sumInt', 'next', 'intRatio',
+                 'dist', 'summinRatio', 'diam', 'maxInt', 'contrast')
     def __init__(self):
         self.x = None
         self.y = None
@@ -460,6 +1876,7 @@ class spot(object):
 # Edge object
 ################################################
 class edge(object):
+    __slots__ = ('source', 'target', 'track_id', 't')
     def __init__(self):
         self.source = None
         self.target = None
@@ -470,6 +1887,7 @@ class edge(object):
 # Track object
 ################################################
 class track(object):
+    __slots__ = ('x', 'y', 'z', 'id', 't_i', 't_f', 'duration', 'contrast', 'intensity', 'diameter')
     def __init__(self):
         self.x = None
         self.y = None
@@ -486,8 +1904,16 @@ class track(object):
 ################################################
 # Pairer object
 ################################################
+# filters of findNeighbors, in order: counter name in Profiler, console message
+PAIR_FILTERS = [('mindist_never', 'never within min distance'),
+                ('overlap', 'overlap time too short'),
+                ('frames', 'overlap time too short (<2) '),
+                ('maxdist', 'too far away'),
+                ('mindist', 'too far away (min distance filter) ')]
+
 class TrackPairer(object):
-    def __init__(self,xml,DIM=None,maxdist=11,mindist=4,maxcongdist=4,minoverlap=10):
+    def __init__(self,xml,DIM=None,maxdist=11,mindist=4,maxcongdist=4,minoverlap=10,profiler=None,
+                 trans_mat=None,compress=1,pad=True,calibration=None):
         """
         Initialzing a pairer object
         
@@ -502,6 +1928,13 @@ class TrackPairer(object):
         - The minoverlap argument is a duration threshold. Two tracks with fewer overlapped frames will be filtered.
     
         - The mindist arguent is a distance threshold of the minimum proximity two centrosomes must have for at least 1 time frame in order to be considered as "paired"
+        
+        - The profiler argument is an optional Profiler, timing the stages and counting the rejected pairs
+        
+        - The trans_mat argument is for an xml tracked on the original, unregistered movie: its translation
+            matrix (see register, with compress and pad). Spot positions are then moved into the registered
+            movie (see registerModel, calibration is the pixel size if the xml has none) and the borders are
+            found from trans_mat, so the registered movie is not needed.
         """
         print("Input parameters: ")
         print("maxdist (um): ",maxdist)
@@ -515,6 +1948,12 @@ class TrackPairer(object):
         self.min_dist = mindist
         self.maxcongdist = maxcongdist
         self.DIM = DIM
+        self.profiler = profiler if profiler is not None else Profiler(enabled=False)
+        self.trans_mat = trans_mat
+        self.compress = compress
+        self.pad = pad
+        self.calibration = calibration
+        self._model = None # (loaded model, registered model), see loadModel
         
         # create dynamic variables
         self.nbrTracks = []
@@ -522,6 +1961,12 @@ class TrackPairer(object):
         self.allSpots = {}
         self.allEdges = {}
         self.cells = []
+        self.spots = None # spot table, see spotTable
+        self.tracks = None # track table of the kept tracks, see trackTable
+        self.edges = None # edge table, see edgeTable
+        self.framerate = None # seconds per frame
+        self.features = None # dataframe of the cells, see pairFeatures
+        self.store = None # dense per-track positions, see _buildTrackStore
         self.top = None
         self.bottom = None
         self.left = None
@@ -536,81 +1981,82 @@ class TrackPairer(object):
         toLeft = x - self.left
         toRight = self.right - x
         return min([toTop, toBottom, toLeft, toRight])
-
-        
+    
+    def loadModel(self):
+        '''
+        The model of the xml, moved into the registered movie with trans_mat
+            if the pairer has one (see registerModel)
+        '''
+        model = TrackMateModel.load(self.xml_path)
+        if self.trans_mat is None:
+            return model
+        if self._model is None or self._model[0] is not model:
+            self._model = (model, registerModel(model, self.trans_mat, compress=self.compress, pad=self.pad,
+                                                calibration=self.calibration))
+        return self._model[1]
+    
     def getAllTracks(self, f, originalMovie):
         # read tiff dim
         if self.DIM == None:
-            self.top, self.bottom, self.left, self.right = findCroppedDim(tiff_path = originalMovie)
-        # read from xml all info about tracks
-        track_general, track_detail = parseTracks(self.xml_path)
-                
-        # populate edge objects
-        for index, row in track_detail.iterrows():
-            myEdge = edge()
-            myEdge.source = int(row['SPOT_SOURCE_ID'])
-            myEdge.target = int(row['SPOT_TARGET_ID'])
-            myEdge.track_id = int(row['TRACK_ID'])
-            myEdge.t = float(int(row['EDGE_TIME'])) # round to nearest int
-            if myEdge.track_id in self.allEdges:
-                self.allEdges[myEdge.track_id][myEdge.t] = myEdge.source
-            else:
-                self.allEdges[myEdge.track_id] = {myEdge.t: myEdge.source}        
-        # populate the track objects
-        for index, row in track_general.iterrows():
-            myTrack = track()
-            myTrack.id = int(row['TRACK_ID'])
-            myTrack.x = float(row['TRACK_X_LOCATION'])
-            myTrack.y = float(row['TRACK_Y_LOCATION'])
-            myTrack.z = float(row['TRACK_Z_LOCATION'])
-            myTrack.t_i = float(row['TRACK_START']) 
-            myTrack.t_f = float(row['TRACK_STOP'])
-            myTrack.duration = float(row['TRACK_DURATION'])
-            myTrack.diameter, myTrack.contrast, myTrack.intensity = self.findTrackInfo(myTrack)
-            # apply the border filter
-            dist2border = self.track_dist2border(myTrack.x, myTrack.y)
-            if dist2border <= 0: # track on border, discard the track
-                f.write(str(int(myTrack.id)) + ' not included: outside border\n')
-                continue
-            # apply the track duration filter
-            if myTrack.duration < self.min_overlap:
-                f.write(str(int(myTrack.id)) +' not included: duration less than min_overlap\n')
-                continue
-            # centrosome diameter filter
-            self.allTracks[myTrack.id] = myTrack
+            with self.profiler.stage('borders'):
+                if self.trans_mat is not None: # the borders the registered movie would have
+                    geometry = TrackMateModel.load(self.xml_path).geometry
+                    translation = (np.asarray(self.trans_mat) * self.compress).astype(int).reshape(-1, 2)
+                    self.top, self.bottom, self.left, self.right = bordersOf(findFrameBorders(
+                        translation[:geometry[3] + 1], geometry[1] + 1, geometry[0] + 1, pad=self.pad))
+                else:
+                    # the borders of the registered movie (its sidecar), also
+                    # when given the original one
+                    self.top, self.bottom, self.left, self.right = findCroppedDim(
+                        tiff_path = registeredMovie(originalMovie))
+        with self.profiler.stage('parse'):
+            model = self.loadModel()
+            if self.framerate is None:
+                self.framerate = _frameInterval(self.xml_path)
+            if self.spots is None:
+                self.getAllSpots()
+        with self.profiler.stage('tracks'):
+            # tracks and edges are indexed by frame, converted once here
+            self.edges = edgeTable(model.edges, self.framerate)
+            tracks = trackTable(model.tracks, self.edges, self.spots, self.framerate)
+            # apply the border filter, then the track duration filter
+            dist2border = np.minimum.reduce([tracks['y'] - self.top, self.bottom - tracks['y'],
+                                             tracks['x'] - self.left, self.right - tracks['x']])
+            on_border = dist2border <= 0 # track on border, discard the track
+            too_short = (tracks['duration'] < self.min_overlap) & ~on_border
+            for row in np.flatnonzero(on_border | too_short):
+                if on_border[row]:
+                    f.write(str(int(tracks['id'][row])) + ' not included: outside border\n')
+                else:
+                    f.write(str(int(tracks['id'][row])) +' not included: duration less than min_overlap\n')
+            self.profiler.count('tracks', len(tracks['id']))
+            self.profiler.count('tracks_border', on_border.sum())
+            self.profiler.count('tracks_duration', too_short.sum())
+            self.tracks = tracks.take(np.flatnonzero(~(on_border | too_short)))
+        self.allEdges = _EdgeMap(self.edges)
+        self.allTracks = _RowMap(self.tracks, track)
         return self.allTracks
     
     def getAllSpots(self):
-        spots = parseSpots(self.xml_path)
-        # populate the track objects
-        for index, row in spots.iterrows():
-            mySpot = spot()
-            mySpot.id = int(row['ID'])
-            mySpot.x = float(row['POSITION_X'])
-            mySpot.y = float(row['POSITION_Y'])
-            mySpot.z = float(row['POSITION_Z'])
-            mySpot.diam = float(row['ESTIMATED_DIAMETER'])
-            mySpot.maxInt = float(row['MAX_INTENSITY'])
-            mySpot.contrast = float(row['CONTRAST'])
-            self.allSpots[mySpot.id] = mySpot
+        with self.profiler.stage('parse'):
+            self.spots = spotTable(self.loadModel().spots)
+        self.allSpots = _RowMap(self.spots, spot)
         return self.allSpots
     
     def findTrackInfo(self, myTrack):
         # print(myTrack.id)
-        t = myTrack.t_i
         maxInt = []
         diam = []
         contrast = []
-        while t <= myTrack.t_f:
-            if t not in self.allEdges[myTrack.id]: 
-                t+=1
+        track_edges = self.allEdges[myTrack.id]
+        for t in range(myTrack.t_i, myTrack.t_f + 1):
+            if t not in track_edges: 
                 continue
-            spotID = self.allEdges[myTrack.id][int(t)]
+            spotID = track_edges[t]
             spot = self.allSpots[spotID]
             maxInt.append(spot.maxInt)
             contrast.append(spot.contrast)
             diam.append(spot.diam)
-            t+=1
         if len(diam) <1:
             return 0,0,0
         return mean(diam), mean(contrast), mean(maxInt)
@@ -635,28 +2081,23 @@ class TrackPairer(object):
         stop = min([trackI.t_f, trackJ.t_f])
         if stop - start <= 0:
             return
-        t = start 
+        # note: allEdges[trackI.id] is a dict, k is frame, v is spot_id
+        edges_i = self.allEdges[trackI.id]
+        edges_j = self.allEdges[trackJ.id]
         
-        while t < stop :    
+        for t in range(start, stop):
             # calculate distance
             # find ids of spots from i, j
-            if t not in self.allEdges[trackI.id]: 
-                # note: allEdges[trackI.id] is a dict, k is time, v is spot_id
-                t+=1
+            if t not in edges_i: 
                 continue
-            if t not in self.allEdges[trackJ.id]:
-                t+=1
+            if t not in edges_j:
                 continue
             # get spot id
-            spot_i = self.allEdges[trackI.id][t]
-            spot_j = self.allEdges[trackJ.id][t]
+            spot_i = edges_i[t]
+            spot_j = edges_j[t]
             # find spot loc by spot id
-            ix = self.allSpots[spot_i].x
-            iy = self.allSpots[spot_i].y
-            iz = self.allSpots[spot_i].z
-            jx = self.allSpots[spot_j].x
-            jy = self.allSpots[spot_j].y
-            jz = self.allSpots[spot_j].z
+            ix, iy, iz = self.allSpots[spot_i].x, self.allSpots[spot_i].y, self.allSpots[spot_i].z
+            jx, jy, jz = self.allSpots[spot_j].x, self.allSpots[spot_j].y, self.allSpots[spot_j].z
             dist = distance.euclidean((ix,iy,iz),(jx,jy,jz))
             center = ((ix+jx)/2, (iy+jy)/2, (iz+jz)/2)
             normal = ((ix-jx), (iy-jy), (iz-jz))
@@ -671,172 +2112,276 @@ class TrackPairer(object):
             normals['x'].append(n_normal[0])
             normals['y'].append(n_normal[1])
             normals['z'].append(n_normal[2])
-            t+=1
         return sl, centers, normals, time
           
     def cell_dist2border(self):
         '''
-        Finds the distance of cell center to the closest border
+        Finds the distance of cell center to the closest border, as the
+            dist2border column of self.features
+        '''
+        x, y = self.features['center_x'], self.features['center_y']
+        self.features['dist2border'] = np.minimum.reduce([y - self.top, self.bottom - y,
+                                                          x - self.left, self.right - x])
+
+    def _buildTrackStore(self):
+        '''
+        Lays every track out as a dense (T x 3) block of spot positions, one
+            row per frame of its edges, NaN where the track has no spot.
+            The blocks are stacked in one array, in self.tracks order.
+        '''
+        tracks, edges = self.tracks, self.edges
+        first = np.zeros(len(tracks), dtype=np.int64)
+        length = np.zeros(len(tracks), dtype=np.int64)
+        owner = tracks.rows(edges['track_id'], strict=False)
+        mine = owner >= 0
+        owner, t, source = owner[mine], edges['t'][mine], edges['source'][mine]
+        # edges are sorted by track and frame
+        if len(owner):
+            starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+            stops = np.r_[starts[1:], len(owner)] - 1
+            first[owner[starts]] = t[starts]
+            length[owner[starts]] = t[stops] - t[starts] + 1
+        offset = np.concatenate([[0], np.cumsum(length)])
+        pos = np.full((offset[-1], 3), np.nan)
+        spot_rows = self.spots.rows(source)
+        pos[offset[owner] + t - first[owner]] = np.stack([self.spots['x'][spot_rows], self.spots['y'][spot_rows],
+                                                          self.spots['z'][spot_rows]], axis=1)
+        self.store = {'ids': tracks['id'], 'first': first, 'length': length,
+                      'offset': offset, 'pos': pos,
+                      't_i': tracks['t_i'], 't_f': tracks['t_f'],
+                      'contrast': tracks['contrast'], 'intensity': tracks['intensity'], 'diameter': tracks['diameter']}
+        return self.store
+
+    def findCandidates(self):
+        '''
+        Finds the unordered track pairs worth comparing, without looking at
+            every pair of tracks (the rejected ones are counted by self.profiler):
+        - per time point, a KD-tree over the spots of the tracks present then
+            gives the pairs that come within min_dist at that time point
+            (a pair that never does fails the min distance filter anyway)
+        - of those, pairs overlapping in time for less than min_overlap are dropped
+        
+        Returns two arrays of rows into self.store (see _buildTrackStore),
+            row_i < row_j.
         '''
-        for myCell in self.cells:          
-            # unpack cell_center
-            x, y, z = myCell.center
-            toTop = y - self.top
-            toBottom = self.bottom - y 
-            toLeft = x - self.left
-            toRight = self.right - x
-            myCell.dist2border = min([toTop, toBottom, toLeft, toRight])
+        store = self.store
+        n_tracks = len(store['ids'])
+        empty = np.zeros(0, dtype=np.int64)
+        valid = np.flatnonzero(~np.isnan(store['pos'][:, 0]))
+        rows = np.searchsorted(store['offset'], valid, side='right') - 1
+        keys = store['first'][rows] + valid - store['offset'][rows]
+        order = np.argsort(keys, kind='stable')
+        keys, rows, coords = keys[order], rows[order], store['pos'][valid[order]]
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        # slightly larger radius so no pair at exactly min_dist is lost to
+        # rounding, the exact filter is applied with the other features
+        radius = self.min_dist * (1 + 1e-9)
+        found = []
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(keys)]):
+            if stop - start < 2:
+                continue
+            close = cKDTree(coords[start:stop]).query_pairs(radius, output_type='ndarray')
+            if len(close):
+                found.append(rows[start:stop][close])
+        n_pairs = n_tracks * (n_tracks - 1) // 2
+        if not found:
+            self.profiler.count('mindist_never', n_pairs)
+            return empty, empty
+        found = np.sort(np.concatenate(found), axis=1)
+        found = np.unique(found[:, 0] * n_tracks + found[:, 1])
+        self.profiler.count('mindist_never', n_pairs - len(found))
+        row_i, row_j = np.divmod(found, n_tracks)
+        # time overlap filter
+        t_i, t_f = store['t_i'], store['t_f']
+        overlap = np.minimum(t_f[row_i], t_f[row_j]) - np.maximum(t_i[row_i], t_i[row_j])
+        keep = overlap * self.framerate >= self.min_overlap
+        self.profiler.reject('overlap', store['ids'][row_i[~keep]], store['ids'][row_j[~keep]], 'overlap time too short')
+        return row_i[keep], row_j[keep]
+
+    def pairFeatures(self, row_i, row_j):
+        '''
+        Computes the features of features.csv for all candidate pairs at once,
+            the batched equivalent of findDist, findCong and the filters of
+            findNeighbors. Per pair, the frames visited are the frames of
+            [start, stop) where both tracks have a spot.
+        
+        - row_i, row_j: candidate pairs, as rows into self.store
+        
+        t_cong and t_overlap are in seconds, with self.framerate.
+        
+        The pairs rejected by the filters go to self.profiler.reject.
+        
+        Returns a dataframe with the features.csv columns plus the center
+            (center_x, center_y, center_z), one row per kept pair, i before j.
+        '''
+        store = self.store
+        pos, first, offset, ids = store['pos'], store['first'], store['offset'], store['ids']
+        start = np.maximum(store['t_i'][row_i], store['t_i'][row_j])
+        stop = np.minimum(store['t_f'][row_i], store['t_f'][row_j])
+        # visited frames, clipped to the stored blocks of both tracks
+        lo = np.maximum(start, np.maximum(first[row_i], first[row_j]))
+        hi = np.minimum(stop - 1,
+                        np.minimum(first[row_i] + store['length'][row_i], first[row_j] + store['length'][row_j]) - 1)
+        n_steps = np.maximum(hi - lo + 1, 0)
+        pid = np.repeat(np.arange(len(row_i)), n_steps)
+        t = lo[pid] + np.arange(len(pid)) - np.repeat(np.cumsum(n_steps) - n_steps, n_steps)
+        p_i = pos[offset[row_i[pid]] + t - first[row_i[pid]]]
+        p_j = pos[offset[row_j[pid]] + t - first[row_j[pid]]]
+        both = ~(np.isnan(p_i[:, 0]) | np.isnan(p_j[:, 0]))
+        pid, t, p_i, p_j = pid[both], t[both], p_i[both], p_j[both]
+        
+        n = np.bincount(pid, minlength=len(row_i))
+        diff = p_i - p_j
+        dist = np.sqrt((diff ** 2).sum(axis=1))
+        centers = (p_i + p_j) / 2
+        # normalized normal vector, (0,0,0) for coinciding spots
+        normals = np.divide(diff, dist[:, None], out=np.zeros_like(diff), where=dist[:, None] != 0)
+        
+        # per pair reductions, entries of a pair are contiguous and in time order
+        has = n > 0
+        seg = (np.cumsum(n) - n)[has]
+        sl_max = np.full(len(row_i), np.nan)
+        sl_min = np.full(len(row_i), np.nan)
+        sl_i = np.full(len(row_i), np.nan)
+        sl_f = np.full(len(row_i), np.nan)
+        if len(dist):
+            sl_max[has] = np.maximum.reduceat(dist, seg)
+            sl_min[has] = np.minimum.reduceat(dist, seg)
+            sl_i[has] = dist[seg]
+            sl_f[has] = dist[seg + n[has] - 1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg_dist = np.bincount(pid, weights=dist, minlength=len(row_i)) / n
+        
+        # filters, in the order of findNeighbors
+        reasons = [(n < 2, 'frames', 'overlap time too short (<2) '),
+                   (avg_dist > self.max_dist, 'maxdist', 'too far away'),
+                   (sl_min > self.min_dist, 'mindist', 'too far away (min distance filter) ')]
+        keep = np.ones(len(row_i), dtype=bool)
+        for rejected, name, reason in reasons:
+            rejected = rejected & keep
+            self.profiler.reject(name, ids[row_i[rejected]], ids[row_j[rejected]], reason)
+            keep &= ~rejected
+        
+        def seg_stdev(values):
+            # sample standard deviation per pair, two-pass
+            mu = np.stack([np.bincount(pid, weights=values[:, k], minlength=len(row_i)) for k in range(3)], axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mu /= n[:, None]
+                ss = np.stack([np.bincount(pid, weights=(values[:, k] - mu[pid, k]) ** 2, minlength=len(row_i))
+                               for k in range(3)], axis=1)
+                sd = np.sqrt(ss / (n[:, None] - 1))
+            return mu, (sd ** 2).sum(axis=1) ** 0.5
+        center, center_stdev = seg_stdev(centers)
+        _, normal_stdev = seg_stdev(normals)
+        
+        # t_cong: per block of consecutive time points, the number of points
+        # closer than maxcongdist, max over the blocks of the pair (findCong)
+        new_block = np.ones(len(t), dtype=bool)
+        new_block[1:] = (pid[1:] != pid[:-1]) | (t[1:] - t[:-1] != 1)
+        block = np.cumsum(new_block) - 1
+        per_block = np.bincount(block, weights=dist < self.maxcongdist).astype(np.int64)
+        t_cong = np.zeros(len(row_i), dtype=np.int64)
+        np.maximum.at(t_cong, pid[new_block], per_block)
+        
+        i, j = row_i[keep], row_j[keep]
+        df = pd.DataFrame({
+            'center_stdev': center_stdev[keep],
+            'normal_stdev': normal_stdev[keep],
+            'sl_f': sl_f[keep],
+            'sl_i': sl_i[keep],
+            'sl_max': sl_max[keep],
+            'sl_min': sl_min[keep],
+            't_cong': t_cong[keep] * self.framerate,
+            't_overlap': (stop - start)[keep] * self.framerate,
+            'intensity': (store['intensity'][i] + store['intensity'][j])/2,
+            'diameter': (store['diameter'][i] + store['diameter'][j])/2,
+            'contrast': (store['contrast'][i] + store['contrast'][j])/2,
+            'centID_i': ids[i],
+            'centID_j': ids[j],
+            'center_x': center[keep, 0],
+            'center_y': center[keep, 1],
+            'center_z': center[keep, 2]})
+        return df
 
     def findNeighbors(self, f, originalMovie, framerate):
+        '''
+        Finds the candidate pairs and their features (self.features). The
+            filtered tracks are listed in f, the console file, and the number
+            of track pairs rejected by each filter (PAIR_FILTERS).
+        '''
+        self.framerate = framerate
         # 1. spots bookkeeping
         self.allSpots = self.getAllSpots()
         # 2. tracks and edges bookkeeping
         self.allTracks = self.getAllTracks(f, originalMovie)
+        with self.profiler.stage('tracks'):
+            self._buildTrackStore()
         # 3. find neighbors by crude filters
         print("Total number of tracks: " + str(len(self.allTracks)) )
-        for myTrack in self.allTracks.values():            
-            for nbr in self.allTracks.values():
-                # 1) if track duration less than min_overlap, out
-                if nbr.duration < self.min_overlap:
-                    continue
-                # 2)  myTrack is the same track as nbr, out
-                elif myTrack.id == nbr.id:
-                    continue
-                # 3) find period of overlap: if fewer frames than min_overlap , out
-                t_start = max([myTrack.t_i, nbr.t_i]) 
-                t_stop = min([myTrack.t_f, nbr.t_f])
-                if t_stop - t_start < self.min_overlap:
-                    f.write(str(int(myTrack.id)) + ' and ' + str(int(nbr.id)) + ' not pair: overlap time too short\n')
-                    continue
-                # 4) find max distance: if greater than max_dist um, out
-                dist, centers, normals, time = self.findDist(myTrack.id, nbr.id)
-                if len(dist) < 2:
-                    f.write(str(int(myTrack.id)) + ' and ' + str(int(nbr.id)) + ' not pair: overlap time too short (<2) \n')
-                    continue
-                avg_dist = mean(dist)
-                max_dist = max(dist)
-                min_dist = min(dist)
-                if avg_dist > self.max_dist:
-                    f.write(str(int(myTrack.id)) + ' and ' + str(int(nbr.id)) + ' not pair: too far away\n')
-                    continue
-                # 5) find min distance, if greater than min_dist microns, out FOR DEBUG
-                if min_dist > self.min_dist:
-                    f.write(str(int(myTrack.id)) + ' and ' + str(int(nbr.id)) + ' not pair: too far away (min distance filter) \n')
-                    continue
-                # filtering finished, fill in cell info
-                myCell = cell()
-                myCell.centID_i = myTrack.id
-                myCell.centID_j = nbr.id
-                myCell.t_overlap = t_stop - t_start
-                myCell.sl_i = dist[0]
-                myCell.sl_f = dist[-1]
-                myCell.sl_max = max_dist
-                myCell.sl_min = min_dist
-                myCell.center = (mean(centers['x']), mean(centers['y']), mean(centers['z']))
-                stdev_x = stdev(centers['x'])
-                stdev_y = stdev(centers['y'])
-                stdev_z = stdev(centers['z'])
-                stdev_x_n = stdev(normals['x'])
-                stdev_y_n = stdev(normals['y'])
-                stdev_z_n = stdev(normals['z'])
-                myCell.center_stdev = (stdev_x**2 + stdev_y**2 + stdev_z**2)**0.5
-                myCell.normal_stdev = (stdev_x_n**2 + stdev_y_n**2 + stdev_z_n**2)**0.5
-                myCell.t_cong = findCong(time, dist, self.maxcongdist) * framerate
-                myCell.contrast = (myTrack.contrast + nbr.contrast)/2
-                myCell.intensity = (myTrack.intensity + nbr.intensity)/2
-                myCell.diameter = (myTrack.diameter + nbr.diameter)/2
-                self.cells.append(myCell)
-        self.cell_dist2border()
+        before = dict(self.profiler.counters)
+        n_pairs = len(self.allTracks) * (len(self.allTracks) - 1) // 2
+        self.profiler.count('pairs', n_pairs)
+        # tracks shorter than min_overlap are gone already, pairs that never
+        # come within min_dist or overlap for less than min_overlap are never
+        # generated
+        with self.profiler.stage('candidates'):
+            row_i, row_j = self.findCandidates()
+        with self.profiler.stage('features'):
+            # all remaining filters and the features, for all candidates at once
+            df = self.pairFeatures(row_i, row_j)
+            self.profiler.count('pairs_kept', len(df))
+            # every feature is symmetric in i and j, the (j, i) rows only swap the ids
+            mirrored = df.copy()
+            mirrored['centID_i'], mirrored['centID_j'] = df['centID_j'].values, df['centID_i'].values
+            df = pd.concat([df, mirrored], ignore_index=True)
+            # same order as comparing every track with every other track
+            order = np.lexsort((self.tracks.rows(df['centID_j']), self.tracks.rows(df['centID_i'])))
+            self.features = df.iloc[order].reset_index(drop=True)
+            self.cell_dist2border()
+        for name, reason in PAIR_FILTERS:
+            rejected = self.profiler.counters.get(name, 0) - before.get(name, 0)
+            f.write(str(rejected) + ' of ' + str(n_pairs) + ' track pairs not pair: ' + reason + '\n')
+        # cell objects are built from self.features on access
+        self.cells = _RecordList(self.features, self._df2cell)
         return self.cells
+
+    @staticmethod
+    def _df2cell(row):
+        myCell = cell()
+        myCell.centID_i = row.centID_i
+        myCell.centID_j = row.centID_j
+        myCell.t_overlap = row.t_overlap
+        myCell.t_cong = row.t_cong
+        myCell.sl_i = row.sl_i
+        myCell.sl_f = row.sl_f
+        myCell.sl_min = row.sl_min
+        myCell.sl_max = row.sl_max
+        myCell.center = (row.center_x, row.center_y, row.center_z)
+        myCell.center_stdev = row.center_stdev
+        myCell.normal_stdev = row.normal_stdev
+        myCell.dist2border = row.dist2border
+        myCell.diameter = row.diameter
+        myCell.intensity = row.intensity
+        myCell.contrast = row.contrast
+        return myCell
     
     def linkID(self, trackIDList):
         '''
         Creates a dictionary of trackID: [SpotIDs]
         '''
-        track2spot = {}
-        spot2track = {}
-        for trackID in trackIDList:
-            track2spot[trackID] = []
-            track = self.allTracks[trackID]
-            start = track.t_i
-            stop = track.t_f            
-            t = start 
-            while t < stop :    
-                if t not in self.allEdges[trackID]: 
-                    t+=1
-                    continue
-                # get spot id
-                spotID = self.allEdges[trackID][t]
-                t+=1
-                track2spot[trackID].append(spotID)
-                spot2track[spotID] = trackID
-        return track2spot, spot2track
+        return _linkTables(trackIDList, self.tracks, self.allEdges)
         
     def pred2SpotCSV(self,r_xml_path,out_folder,out_name):
-        pred = pd.read_csv(out_folder+'/predictions.csv')
-        spots = parseSpots(r_xml_path)
-        allTracks = []
-        allPairs = []
-        for index, row in pred.iterrows():
-            if int(row['Predicted_Label']) == 1 :
-                i = int(row['centID_i'])
-                j = int(row['centID_j'])
-                allTracks.append(i)
-                allTracks.append(j)
-                allPairs.append((i,j))
-        allTracks = list(set(allTracks)) # unique
-        if allTracks == []: 
-            print("No cells found")
-            return 
-        track2spots, spot2track = self.linkID(allTracks) # link spot to track
-        for i, j in allPairs:
-            if (j,i) in allPairs:
-                allPairs.remove((j,i))
-                
-        allSpotIDs = []        
-        for k, v in track2spots.items():
-            allSpotIDs = allSpotIDs + v
-        mySpots = {}    
-        for index, row in spots.iterrows():
-            spotID = int(row['ID'])
-            if spotID in allSpotIDs:
-                row['TRACK_ID'] = spot2track[spotID]
-                mySpots[spotID]=row
-        counter = 0
-        allSpots = []
-        for i, j in allPairs:
-            counter+=1
-            spots_i = track2spots[i]
-            spots_j = track2spots[j]
-            name_i ='Cent_'+str(counter)+'a'
-            name_j ='Cent_'+str(counter)+'b'
-            for spotID in spots_i:
-                spotSeries = mySpots[spotID].copy()
-                spotSeries['Label'] = name_i
-                allSpots.append(spotSeries)
-            for spotID in spots_j:
-                spotSeries = mySpots[spotID].copy()
-                spotSeries['Label'] = name_j
-                allSpots.append(spotSeries)
-        df = pd.DataFrame(allSpots)
-        # reorder
-        df = df[["Label", "ID", "TRACK_ID",
-                 "QUALITY", "POSITION_X","POSITION_Y", 
-                 "POSITION_Z", "POSITION_T", "FRAME", 
-                 "RADIUS", "VISIBILITY", "MANUAL_COLOR", 
-                 "MEAN_INTENSITY", "MEDIAN_INTENSITY",
-                 "MIN_INTENSITY", "MAX_INTENSITY",
-                 "TOTAL_INTENSITY", "STANDARD_DEVIATION",
-                 "ESTIMATED_DIAMETER", "ESTIMATED_DIAMETER", "SNR"]]
-        
-        df['POSITION_Z'] = df['POSITION_Z'].astype('float') 
-        df['POSITION_X'] = df['POSITION_X'].astype('float') 
-        df['POSITION_Y'] = df['POSITION_Y'].astype('float') 
-        df['POSITION_T'] = df['POSITION_T'].astype('float')  
-        
-        df.to_csv(out_name, index=False)
-        print("Number of cells found: " + str(len(allPairs)))
-        return allSpots, allPairs
+        with self.profiler.stage('output'):
+            if self.tracks is None: # predictions of an earlier run, no findNeighbors here
+                self.allTracks, self.allEdges = getAllTracks(r_xml_path, self.getAllSpots(), model=self.loadModel())
+                self.tracks = self.allTracks.table
+            pred = pd.read_csv(out_folder+'/predictions.csv')
+            pred = pred[pred['Predicted_Label'].astype(int) == 1]
+            result = pairs2spots(pred, r_xml_path, out_name, self.tracks, self.allEdges, model=self.loadModel())
+        if result is not None:
+            print("Number of cells found: " + str(len(result[1])))
+        return result
         
         
 def cell2df(cells):
@@ -871,174 +2416,251 @@ def cell2df(cells):
     
     df = pd.DataFrame(myDict)
     
-    # normalize contrast and intensity
-        
-    scaler = MinMaxScaler()
-    df['contrast'] = scaler.fit_transform(df['contrast'].values.reshape(-1,1))
-    df['intensity'] = scaler.fit_transform(df['intensity'].values.reshape(-1,1))
+    return normalizeFeatures(df)
+
+# columns of features.csv, the first 11 are the classifier input
+FEATURES = ['center_stdev', 'normal_stdev', 'sl_f', 'sl_i', 'sl_max', 'sl_min',
+            't_cong', 't_overlap', 'intensity', 'diameter', 'contrast',
+            'centID_i', 'centID_j']
+
+def minMaxScale(values):
+    '''
+    scales values to [0, 1], the arithmetic of sklearn's MinMaxScaler so
+        results are identical, without importing sklearn
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    data_range = np.nanmax(values) - np.nanmin(values)
+    scale = 1.0 / (data_range if data_range != 0 else 1.0)
+    return values * scale + (0 - np.nanmin(values) * scale)
+
+def normalizeFeatures(df):
+    '''
+    min-max normalizes the contrast and intensity columns, in place
+    '''
+    df['contrast'] = minMaxScale(df['contrast'].values)
+    df['intensity'] = minMaxScale(df['intensity'].values)
 
     return df
 
-def pair(clf,r_xml_path,originalMovie,out_folder,csv_path,maxdist=11,mindist=4,maxcongdist=4,minoverlap=10,dim=None):
+def findPairs(r_xml_path,originalMovie,out_folder,maxdist=11,mindist=4,maxcongdist=4,minoverlap=10,dim=None,profiler=None,
+              trans_mat=None,compress=1,pad=True,calibration=None):
+    '''
+    First half of pair: finds the candidate track pairs and their features,
+        saved in out_folder/features.csv (log of the filters in console.txt)
+    
+    - originalMovie: root/<movie>/<movie>.tif or r_<movie>.tif, the crop
+        borders are those of the registered movie (see registeredMovie)
+    - trans_mat, compress, pad, calibration: for an xml tracked on the
+        original movie, see TrackPairer
+    '''
     f = open(out_folder+'/console.txt', 'w')
-    print('Original movie: ' + originalMovie)
+    print('Original movie: ' + str(originalMovie))
+    coords = {'trans_mat': trans_mat, 'compress': compress, 'pad': pad, 'calibration': calibration}
     # crude pairer, generate features
     if dim == None:
-        myPairer = TrackPairer(r_xml_path,maxdist=maxdist,mindist=mindist,maxcongdist=maxcongdist,minoverlap=minoverlap)
+        myPairer = TrackPairer(r_xml_path,maxdist=maxdist,mindist=mindist,maxcongdist=maxcongdist,minoverlap=minoverlap,profiler=profiler,**coords)
     else: 
-        myPairer = TrackPairer(r_xml_path,DIM = dim,maxdist=maxdist,mindist=mindist,maxcongdist=maxcongdist,minoverlap=minoverlap)
+        myPairer = TrackPairer(r_xml_path,DIM = dim,maxdist=maxdist,mindist=mindist,maxcongdist=maxcongdist,minoverlap=minoverlap,profiler=profiler,**coords)
         myPairer.left, myPairer.right, myPairer.top, myPairer.bottom = dim 
-    framerate = getFramerate(r_xml_path)
-    cells = myPairer.findNeighbors(f, originalMovie,framerate)
-    df = cell2df(cells)
-    df.to_csv(out_folder+'/features.csv', index = False, header=True)
+    with myPairer.profiler.stage('parse'):
+        framerate = float(getFramerate(r_xml_path))
+    myPairer.findNeighbors(f, originalMovie,framerate)
+    f.close()
+    with myPairer.profiler.stage('features'):
+        df = normalizeFeatures(myPairer.features[FEATURES].copy())
+        df.to_csv(out_folder+'/features.csv', index = False, header=True)
     print("Potential pairs generated.")
-    # generate features panel for ml clf
-    X_df = pd.read_csv(out_folder+'/features.csv', usecols = range(11))    
-    X = X_df.to_numpy()
-    # predict
-    y_pred = clf.predict(X)
-    df['Predicted_Label'] = y_pred
-    df = df.loc[df['centID_j'] > df['centID_i']]
-    df.to_csv (out_folder+'/predictions.csv', index = False, header=True)
+    return myPairer
+
+def classifyPairs(clf,out_folder,profiler=None):
+    '''
+    Second half of pair: classifies the pairs of out_folder/features.csv,
+        saved in out_folder/predictions.csv (one row per unordered pair)
+    '''
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    with profiler.stage('predict'):
+        # generate features panel for ml clf
+        df = pd.read_csv(out_folder+'/features.csv', float_precision='round_trip')
+        X = df.iloc[:, :11].to_numpy()
+        # predict
+        y_pred = clf.predict(X)
+        df['Predicted_Label'] = y_pred
+        df = df.loc[df['centID_j'] > df['centID_i']]
+        df.to_csv (out_folder+'/predictions.csv', index = False, header=True)
+        profiler.count('cells', (df['Predicted_Label'].astype(int) == 1).sum())
     print("Predictions generated.")
-    f.close()
+    return df
+
+def classifyModels(models,out_folder,workers=None):
+    '''
+    Classifies the pairs of out_folder/features.csv with several models at
+        once (e.g. those of model_archive), features read once, models run
+        in parallel threads.
+    
+    - models: dict of model name -> classifier
+    
+    Saves out_folder/predictions_models.csv: the features, one column of
+        predicted labels per model, n_models (number of models calling the
+        pair a cell) and agreement (fraction of models agreeing with the
+        majority), one row per unordered pair. Saves out_folder/model_agreement.csv:
+        for every two models, the fraction of pairs they label the same.
+    Returns both dataframes.
+    '''
+    names = list(models)
+    df = pd.read_csv(out_folder+'/features.csv', float_precision='round_trip')
+    df = df.loc[df['centID_j'] > df['centID_i']].reset_index(drop=True)
+    X = df.iloc[:, :11].to_numpy()
+    with ThreadPoolExecutor(max_workers=workers or min(len(names), os.cpu_count() or 1)) as pool:
+        labels = list(pool.map(lambda name: models[name].predict(X), names))
+    for name, y in zip(names, labels):
+        df[name] = y
+    votes = np.stack([y.astype(int) == 1 for y in labels], axis=1).reshape(len(df), len(names))
+    df['n_models'] = votes.sum(axis=1)
+    df['agreement'] = np.maximum(df['n_models'], len(names) - df['n_models']) / len(names)
+    df.to_csv(out_folder+'/predictions_models.csv', index = False, header=True)
+    same = votes[:, :, np.newaxis] == votes[:, np.newaxis, :]
+    agreement = pd.DataFrame(same.mean(axis=0) if len(df) else np.full((len(names), len(names)), np.nan),
+                             index=names, columns=names)
+    agreement.to_csv(out_folder+'/model_agreement.csv')
+    for name in names:
+        print(name + ": " + str(int(df[name].astype(int).eq(1).sum())) + " cells")
+    print("Predictions of {} models generated.".format(len(names)))
+    return df, agreement
+
+def pair(clf,r_xml_path,originalMovie,out_folder,csv_path,maxdist=11,mindist=4,maxcongdist=4,minoverlap=10,dim=None,
+         profile=False,debug_sample=0,trans_mat=None,compress=1,pad=True,calibration=None):
+    '''
+    Pairs the tracks of a TrackMate xml and writes the spots of the pairs
+        classified as cells to csv_path.
+    
+    - trans_mat: for an xml tracked on the original movie instead of the
+        registered one, its translation matrix (see register, with compress
+        and pad). The spot positions are registered instead of the pixels,
+        originalMovie is not read and csv_path has the registered positions.
+        calibration: pixel size (dx, dy), default the one of the xml
+    
+    - profile: saves the time and memory of every stage and the number of
+        track pairs every filter rejected in out_folder/profile.json
+    - debug_sample: fraction of the rejected track pairs listed in
+        out_folder/rejected_pairs.txt, 0 for none
+    '''
+    profiler = None
+    if profile or debug_sample:
+        profiler = Profiler(movie=os.path.basename(os.path.normpath(out_folder)), enabled=profile, sample=debug_sample,
+                            debug_path=out_folder+'/rejected_pairs.txt' if debug_sample else None)
+    myPairer = findPairs(r_xml_path,originalMovie,out_folder,maxdist=maxdist,mindist=mindist,
+                         maxcongdist=maxcongdist,minoverlap=minoverlap,dim=dim,profiler=profiler,
+                         trans_mat=trans_mat,compress=compress,pad=pad,calibration=calibration)
+    classifyPairs(clf,out_folder,profiler=profiler)
     myPairer.pred2SpotCSV(r_xml_path,out_folder,csv_path)
+    if profiler is not None:
+        profiler.close()
+        if profile:
+            profiler.save(out_folder+'/profile.json')
         
        
-def features2spots(features,r_xml_path,movie,output_csv_path):
-    # pred to spots
-    spots_df = parseSpots(r_xml_path)
-    spots = getAllSpots(r_xml_path)
-    tracks , edges = getAllTracks(r_xml_path, spots)
-    allTracks = []
-    allPairs = []
-    for index, row in features.iterrows():
-        # if int(row['Predicted_Label']) == 1 : 
-        i = int(row['centID_i'])
-        j = int(row['centID_j'])
-        allTracks.append(i)
-        allTracks.append(j)
-        allPairs.append((i,j))
-    allTracks = list(set(allTracks)) # unique
-    if allTracks == []: 
+# columns of the spots csv (ESTIMATED_DIAMETER twice, as always)
+SPOT_COLUMNS = ["Label", "ID", "TRACK_ID",
+                "QUALITY", "POSITION_X","POSITION_Y", 
+                "POSITION_Z", "POSITION_T", "FRAME", 
+                "RADIUS", "VISIBILITY", "MANUAL_COLOR", 
+                "MEAN_INTENSITY", "MEDIAN_INTENSITY",
+                "MIN_INTENSITY", "MAX_INTENSITY",
+                "TOTAL_INTENSITY", "STANDARD_DEVIATION",
+                "ESTIMATED_DIAMETER", "ESTIMATED_DIAMETER", "SNR"]
+
+def pairs2spots(pairs, r_xml_path, out_name, tracks=None, edges=None, model=None):
+    '''
+    Writes the spots of track pairs to a csv, the spots of the n-th pair
+        labelled Cent_<n>a (track centID_i) and Cent_<n>b (track centID_j).
+        Of (i, j) and (j, i) only the first is kept.
+    
+    - pairs: dataframe with centID_i and centID_j columns
+    - tracks, edges: track table and edge map (see getAllTracks), read from
+        r_xml_path if not given
+    - model: TrackMateModel the spots are taken from, default the one of
+        r_xml_path
+    
+    Returns the spots dataframe and the list of pairs, None if there is no
+        pair (the csv then only has the header).
+    '''
+    i = pairs['centID_i'].to_numpy().astype(np.int64)
+    j = pairs['centID_j'].to_numpy().astype(np.int64)
+    if len(i) == 0:
         print("No cells found")
+        pd.DataFrame(columns=SPOT_COLUMNS).to_csv(out_name, index=False)
         return
-    track2spots, spot2track = linkID(allTracks,tracks, edges) # link spot to track
-    for i, j in allPairs:
-        if (j,i) in allPairs:
-            allPairs.remove((j,i))
-            
-    allSpotIDs = []        
-    for k, v in track2spots.items():
-        allSpotIDs = allSpotIDs + v
-    mySpots = {}    
-    for index, row in spots_df.iterrows():
-        spotID = int(row['ID'])
-        if spotID in allSpotIDs:
-            row['TRACK_ID'] = spot2track[spotID]
-            mySpots[spotID]=row
-    counter = 0
-    allSpots = []
-    for i, j in allPairs:
-        counter+=1
-        spots_i = track2spots[i]
-        spots_j = track2spots[j]
-        name_i ='Cent_'+str(counter)+'a'
-        name_j ='Cent_'+str(counter)+'b'
-        for spotID in spots_i:
-            spotSeries = mySpots[spotID].copy()
-            spotSeries['Label'] = name_i
-            allSpots.append(spotSeries)
-        for spotID in spots_j:
-            spotSeries = mySpots[spotID].copy()
-            spotSeries['Label'] = name_j
-            allSpots.append(spotSeries)
-    
-    df = pd.DataFrame(allSpots)
+    if model is None:
+        model = TrackMateModel.load(r_xml_path)
+    if tracks is None:
+        allTracks, edges = getAllTracks(r_xml_path, None, model=model)
+        tracks = allTracks.table
+    # first occurrence of every unordered pair, in order
+    _, first = np.unique(np.stack([np.minimum(i, j), np.maximum(i, j)], axis=1), axis=0, return_index=True)
+    first = np.sort(first)
+    i, j = i[first], j[first]
+    # spots of track a then track b of pair 1, then of pair 2...
+    owner, spotIDs = _trackSpots(np.stack([i, j], axis=1).ravel(), tracks, edges)
+    spots = model.spots
+    rows = pd.Index(spots['ID']).get_indexer(spotIDs)
+    if (rows < 0).any():
+        raise KeyError(int(spotIDs[rows < 0][0]))
+    df = spots.iloc[rows].reset_index(drop=True)
+    df['TRACK_ID'] = np.stack([i, j], axis=1).ravel()[owner]
+    df['Label'] = 'Cent_' + pd.Series(owner // 2 + 1).astype(str) + np.where(owner % 2, 'b', 'a')
     # reorder
-    df = df[["Label", "ID", "TRACK_ID",
-             "QUALITY", "POSITION_X","POSITION_Y", 
-             "POSITION_Z", "POSITION_T", "FRAME", 
-             "RADIUS", "VISIBILITY", "MANUAL_COLOR", 
-             "MEAN_INTENSITY", "MEDIAN_INTENSITY",
-             "MIN_INTENSITY", "MAX_INTENSITY",
-             "TOTAL_INTENSITY", "STANDARD_DEVIATION",
-             "ESTIMATED_DIAMETER", "ESTIMATED_DIAMETER", "SNR"]]
-    
-    df['POSITION_Z'] = df['POSITION_Z'].astype('float')
+    df = df[SPOT_COLUMNS]
+    
+    df['POSITION_Z'] = df['POSITION_Z'].astype('float') 
     df['POSITION_X'] = df['POSITION_X'].astype('float') 
     df['POSITION_Y'] = df['POSITION_Y'].astype('float') 
-    df['POSITION_T'] = df['POSITION_T'].astype('float') 
-    
-    
-    df.to_csv('{}_spots_all.csv'.format(movie), index=False)
-    print("Number of cells: " + str(len(allPairs)))
-
-def getAllTracks(xml_path,allSpots):
-    track_general, track_detail = parseTracks(xml_path)
-    allEdges = {}
-    allTracks = {}
-    for index, row in track_detail.iterrows():
-        myEdge = edge()
-        myEdge.source = int(row['SPOT_SOURCE_ID'])
-        myEdge.target = int(row['SPOT_TARGET_ID'])
-        myEdge.track_id = int(row['TRACK_ID'])
-        myEdge.t = float(int(row['EDGE_TIME'])) # round to nearest int
-        if myEdge.track_id in allEdges:
-            allEdges[myEdge.track_id][myEdge.t] = myEdge.source
-        else:
-            allEdges[myEdge.track_id] = {myEdge.t: myEdge.source}        
-    # populate the track objects
-#     track_general['TRACK_DURATION'] =  track_general['TRACK_DURATION']/60
-#     track_general['TRACK_START'] =  track_general['TRACK_START']/60
-#     track_general['TRACK_STOP'] =  track_general['TRACK_STOP']/60
-    
-    for index, row in track_general.iterrows():
-        myTrack = track()
-        myTrack.id = int(row['TRACK_ID'])
-        myTrack.x = float(row['TRACK_X_LOCATION'])
-        myTrack.y = float(row['TRACK_Y_LOCATION'])
-        myTrack.z = float(row['TRACK_Z_LOCATION'])
-        myTrack.t_i = float(row['TRACK_START'])
-        myTrack.t_f = float(row['TRACK_STOP'])
-        myTrack.duration = float(row['TRACK_DURATION'])
-        myTrack.diameter, myTrack.contrast, myTrack.intensity = findTrackInfo(myTrack, allEdges, allSpots)
-        allTracks[myTrack.id] = myTrack
-    return allTracks, allEdges
+    df['POSITION_T'] = df['POSITION_T'].astype('float')  
+    
+    df.to_csv(out_name, index=False)
+    return df, list(zip(i.tolist(), j.tolist()))
+       
+def features2spots(features,r_xml_path,movie,output_csv_path):
+    # pred to spots
+    result = pairs2spots(features, r_xml_path, '{}_spots_all.csv'.format(movie))
+    if result is not None:
+        print("Number of cells: " + str(len(result[1])))
+
+def getAllTracks(xml_path,allSpots,model=None):
+    '''
+    Returns allTracks (track ID -> track) and allEdges (track ID ->
+        {frame: source spot ID}), views of the track and edge tables
+        (of model if given, else of the model of xml_path)
+    '''
+    if model is None:
+        model = TrackMateModel.load(xml_path)
+    framerate = _frameInterval(xml_path)
+    spots = allSpots.table if isinstance(allSpots, _RowMap) else spotTable(model.spots)
+    # tracks and edges are indexed by frame, converted once here
+    edges = edgeTable(model.edges, framerate)
+    tracks = trackTable(model.tracks, edges, spots, framerate)
+    return _RowMap(tracks, track), _EdgeMap(edges)
 
 def getAllSpots(xml_path):
-    spots = parseSpots(xml_path)
-    allSpots = {}
-    # populate the track objects
-    for index, row in spots.iterrows():
-        mySpot = spot()
-        mySpot.id = int(row['ID'])
-        mySpot.x = float(row['POSITION_X'])
-        mySpot.y = float(row['POSITION_Y'])
-        mySpot.z = float(row['POSITION_Z'])
-        mySpot.diam = float(row['ESTIMATED_DIAMETER'])
-        mySpot.maxInt = float(row['MAX_INTENSITY'])
-        mySpot.contrast = float(row['CONTRAST'])
-        allSpots[mySpot.id] = mySpot
-    return allSpots
+    '''
+    Returns allSpots (spot ID -> spot), a view of the spot table
+    '''
+    return _RowMap(spotTable(TrackMateModel.load(xml_path).spots), spot)
 
 def findTrackInfo(myTrack, allEdges, allSpots):
     # print(myTrack.id)
-    t = myTrack.t_i
     maxInt = []
     diam = []
     contrast = []
-    while t <= myTrack.t_f:
-        if t not in allEdges[myTrack.id]: 
-            t+=1
+    track_edges = allEdges[myTrack.id]
+    for t in range(myTrack.t_i, myTrack.t_f + 1):
+        if t not in track_edges:
             continue
-        spotID = allEdges[myTrack.id][int(t)]
+        spotID = track_edges[t]
         spot = allSpots[spotID]
         maxInt.append(spot.maxInt)
         contrast.append(spot.contrast)
         diam.append(spot.diam)
-        t+=1
     if len(diam) <1:
         return 0,0,0
     return mean(diam), mean(contrast), mean(maxInt)
@@ -1049,63 +2671,74 @@ def linkID(trackIDList, allTracks,allEdges):
     '''
     Creates a dictionary of trackID: [SpotIDs]
     '''
+    if isinstance(allTracks, _RowMap) and isinstance(allEdges, _EdgeMap):
+        return _linkTables(trackIDList, allTracks.table, allEdges)
     track2spot = {}
     spot2track = {}
     for trackID in trackIDList:
         track2spot[trackID] = []
         track = allTracks[trackID]
-        start = track.t_i
-        stop = track.t_f            
-        t = start 
-        while t < stop :    
+        for t in range(track.t_i, track.t_f):
             if t not in allEdges[trackID]: 
-                t+=1
                 continue
             # get spot id
             spotID = allEdges[trackID][t]
-            t+=1
             track2spot[trackID].append(spotID)
             spot2track[spotID] = trackID
     return track2spot, spot2track
 
 
+def _frameInterval(xml):
+    # frame interval (s) without prompting, 1 if the xml does not say
+    framerate = TrackMateModel.load(xml).framerate
+    return framerate if framerate else 1.0
+
 def getFramerate(xml):
-    with open(xml, 'r') as f:
-        lines = f.readlines()
-        for l in lines:
-            if l.startswith("  T ="):
-                import re
-                framerate = float(re.findall(r'\d+', l)[2] + '.' + re.findall(r'\d+', l)[3])
-                print("framerate (per sec): ", framerate)
-                return framerate
-        framerate = input("framerate not found in xml.. Please input manually: ")
+    framerate = TrackMateModel.load(xml).framerate
+    if framerate is not None:
+        print("framerate (per sec): ", framerate)
         return framerate
+    framerate = input("framerate not found in xml.. Please input manually: ")
+    return framerate
+    
+    
+def spots2coords(out_csv,out_coords,out_cellid,out_spindle=None):
+    '''
+    Spindle midpoint (between centrosomes a and b) of every cell at every frame
+        where both centrosomes are present, from the spots csv of pair.
     
+    - out_coords: tab separated Cell, Frame, X, Y, Z
+    - out_cellid: one cell name per line
+    - out_spindle: optional, tab separated Cell, Frame, Length, the spindle
+        length (distance between a and b) per cell and frame
     
-def spots2coords(out_csv,out_coords,out_cellid):
+    Returns a dataframe with columns Cell, Frame, X, Y, Z and Length.
+    '''
+    xyz = ['POSITION_X','POSITION_Y','POSITION_Z']
     try:
-        spots = pd.read_csv(out_csv)
+        spots = pd.read_csv(out_csv, usecols=['Label','FRAME']+xyz)
     except FileNotFoundError:
         print("Spots csv not found.")
         return
-    cent_dict = {}
-    for index, row in spots.iterrows():
-        cell_id = row['Label'][:-1]
-        side = row['Label'][-1]
-        if cell_id not in cent_dict:
-            cent_dict[cell_id] = {'a':{},'b':{}}
-        frame = row['FRAME']
-        cent_dict[cell_id][side][frame] = (row['POSITION_X'],row['POSITION_Y'],row['POSITION_Z'])
-    df_list = []
-    for cell_id, mydict in cent_dict.items():
-        id = 'Cell_'+cell_id.split("_")[1]
-        frames = set(mydict['a'].keys()).intersection(mydict['b'].keys())
-        for f in frames:
-            x,y,z = [(mydict['a'][f][0] + mydict['b'][f][0])/2,
-                   (mydict['a'][f][1] + mydict['b'][f][1])/2,
-                   (mydict['a'][f][2] + mydict['b'][f][2])/2 ]
-            df_list.append([id, f,x,y,z])
-    df = pd.DataFrame(df_list)
-    df.columns = ['Cell','Frame','X','Y','Z']
-    df.to_csv(out_coords,sep='\t',index=None)
+    cell_id = spots['Label'].str[:-1]
+    side = spots['Label'].str[-1]
+    spots = spots.assign(cell=cell_id, side=side).drop_duplicates(['cell','side','FRAME'], keep='last')
+    a = spots.loc[spots['side'] == 'a'].set_index(['cell','FRAME'])[xyz]
+    b = spots.loc[spots['side'] == 'b'].set_index(['cell','FRAME'])[xyz]
+    a, b = a.align(b, join='inner')
+    # cells in order of appearance, frames in increasing order
+    cells = a.index.get_level_values('cell')
+    frames = a.index.get_level_values('FRAME').to_numpy()
+    rank = pd.Categorical(cells, categories=pd.unique(cell_id)).codes
+    order = np.lexsort((frames, rank))
+    a, b = a.to_numpy()[order], b.to_numpy()[order]
+    mid = (a + b)/2
+    df = pd.DataFrame({'Cell': 'Cell_' + cells[order].str.split('_').str[1],
+                       'Frame': frames[order],
+                       'X': mid[:,0], 'Y': mid[:,1], 'Z': mid[:,2],
+                       'Length': np.sqrt(((a - b)**2).sum(axis=1))})
+    df[['Cell','Frame','X','Y','Z']].to_csv(out_coords,sep='\t',index=None)
     pd.DataFrame(df['Cell'].unique()).to_csv(out_cellid,index=None,header=None)
+    if out_spindle is not None:
+        df[['Cell','Frame','Length']].to_csv(out_spindle,sep='\t',index=None)
+    return df
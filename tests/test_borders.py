@@ -0,0 +1,24 @@
+'''
+Crop borders of the pairer after register_movie: read from the sidecar of
+    the registered movie, whichever movie pairing is given
+'''
+
+import os
+
+from synthetic import makeMovieFolder
+from utils import register_movie, readRegistrationInfo, findCroppedDim, findPairs
+
+
+def test_findPairs_uses_registered_borders(tmp_path):
+    root = str(tmp_path) + '/'
+    makeMovieFolder(root, 'movie', n_pairs=4, n_noise=4, n_frames=12, nz=3, height=96, width=96, seed=1)
+    register_movie(root, 'movie')
+    folder = root + 'movie'
+    info = readRegistrationInfo(folder + '/r_movie.tif')
+    borders = info['borders']
+    expected = (borders['top'], borders['bottom'], borders['left'], borders['right'])
+    # the unpadded original has other borders
+    assert findCroppedDim(folder + '/movie.tif') != expected
+    for movie in ('movie.tif', 'r_movie.tif'):
+        pairer = findPairs(folder + '/r_movie.xml', os.path.join(folder, movie), folder)
+        assert (pairer.top, pairer.bottom, pairer.left, pairer.right) == expected
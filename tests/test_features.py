@@ -0,0 +1,60 @@
+'''
+features.csv of the batched TrackPairer.pairFeatures against the per-pair
+    path (findDist, findCong and the filters of the original findNeighbors)
+'''
+
+from statistics import mean, stdev
+import pandas as pd
+import pytest
+
+from synthetic import makeMovieFolder
+from utils import findPairs, findCong, normalizeFeatures, FEATURES
+
+
+def perPairFeatures(pairer):
+    # every ordered pair of kept tracks, as findNeighbors did before batching
+    framerate = pairer.framerate
+    rows = []
+    ids = list(pairer.allTracks)
+    for id_i in ids:
+        myTrack = pairer.allTracks[id_i]
+        for id_j in ids:
+            if id_i == id_j:
+                continue
+            nbr = pairer.allTracks[id_j]
+            t_start = max(myTrack.t_i, nbr.t_i)
+            t_stop = min(myTrack.t_f, nbr.t_f)
+            if (t_stop - t_start) * framerate < pairer.min_overlap:
+                continue
+            dist, centers, normals, time = pairer.findDist(id_i, id_j)
+            if len(dist) < 2 or mean(dist) > pairer.max_dist or min(dist) > pairer.min_dist:
+                continue
+            rows.append({
+                'center_stdev': sum(stdev(centers[k]) ** 2 for k in 'xyz') ** 0.5,
+                'normal_stdev': sum(stdev(normals[k]) ** 2 for k in 'xyz') ** 0.5,
+                'sl_f': dist[-1],
+                'sl_i': dist[0],
+                'sl_max': max(dist),
+                'sl_min': min(dist),
+                't_cong': findCong(time, dist, pairer.maxcongdist) * framerate,
+                't_overlap': (t_stop - t_start) * framerate,
+                'intensity': (myTrack.intensity + nbr.intensity) / 2,
+                'diameter': (myTrack.diameter + nbr.diameter) / 2,
+                'contrast': (myTrack.contrast + nbr.contrast) / 2,
+                'centID_i': id_i,
+                'centID_j': id_j})
+    return normalizeFeatures(pd.DataFrame(rows, columns=FEATURES))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_features_match_per_pair_path(tmp_path, seed):
+    width = height = 128
+    makeMovieFolder(str(tmp_path), 'movie', n_pairs=8, n_noise=12, n_frames=40, height=height, width=width,
+                    seed=seed, movie=False)
+    folder = str(tmp_path / 'movie')
+    pairer = findPairs(folder + '/r_movie.xml', None, folder, dim=(0, width, 0, height))
+    batched = pd.read_csv(folder + '/features.csv', float_precision='round_trip')
+    expected = perPairFeatures(pairer)
+    assert len(expected) > 0
+    assert list(batched.columns) == FEATURES
+    pd.testing.assert_frame_equal(batched, expected, check_dtype=False, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,92 @@
+'''
+LoG detector and LAP linker of tracking.py on synthetic blob movies
+'''
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from tracking import logFilter, detectSpots, linkSpots
+
+
+CALIBRATION = (0.25, 0.25, 1.0) # dx, dy, dz in microns
+
+
+def blobMovie(centers, shape, sigma=0.5, seed=0):
+    '''
+    A uint16 (t, z, y, x) movie of gaussian blobs on a noisy background,
+        centers[t] the (x, y, z) blob positions (microns) of timepoint t
+    '''
+    rng = np.random.default_rng(seed)
+    z, y, x = np.meshgrid(*[np.arange(n) * c for n, c in zip(shape, CALIBRATION[::-1])], indexing='ij')
+    movie = np.full((len(centers),) + tuple(shape), 100.0)
+    for t, points in enumerate(centers):
+        for cx, cy, cz in points:
+            movie[t] += 1000 * np.exp(-((x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2) / (2 * sigma ** 2))
+    return (movie + rng.normal(0, 2, movie.shape)).astype(np.uint16)
+
+
+def test_logFilter_peaks_at_blob_center():
+    plane = np.zeros((9, 31, 31))
+    plane[4, 15, 15] = 1000
+    plane = ndimage.gaussian_filter(plane, (0.5, 2, 2))
+    quality = logFilter(plane, 0.8, CALIBRATION)
+    assert np.unravel_index(np.argmax(quality), quality.shape) == (4, 15, 15)
+    assert quality.max() > 0
+
+
+def test_detectSpots_subpixel_positions():
+    start = np.array([[3.3, 4.1, 4.0], [10.6, 7.7, 3.6], [12.2, 3.3, 5.2]])
+    centers = [start + [0.3 * t, 0, 0] for t in range(3)]
+    movie = blobMovie(centers, (9, 48, 64))
+    spots = detectSpots(movie, 0.8, 100, calibration=CALIBRATION, framerate=2.0, workers=2)
+    assert spots['FRAME'].tolist() == [0, 0, 0, 1, 1, 1, 2, 2, 2]
+    assert np.allclose(spots['POSITION_T'], spots['FRAME'] * 2.0)
+    assert spots['ID'].tolist() == list(range(9))
+    for t, points in enumerate(centers):
+        found = spots.loc[spots['FRAME'] == t, ['POSITION_X', 'POSITION_Y', 'POSITION_Z']].to_numpy()
+        _, nearest = cKDTree(found).query(points)
+        error = np.abs(found[nearest] - points) / CALIBRATION # in voxels
+        assert sorted(nearest) == [0, 1, 2]
+        assert (error < 0.25).all(), error
+
+
+def spotTable(points, framerate=2.0):
+    # spot dataframe of (frame, x, y, z) rows, as detectSpots returns
+    points = np.asarray(points, dtype=np.float64)
+    return pd.DataFrame({'ID': np.arange(len(points), dtype=np.int64) + 100,
+                         'FRAME': points[:, 0].astype(np.int64),
+                         'POSITION_T': points[:, 0] * framerate,
+                         'POSITION_X': points[:, 1],
+                         'POSITION_Y': points[:, 2],
+                         'POSITION_Z': points[:, 3]})
+
+
+def test_linkSpots_closes_one_frame_gap():
+    # track a misses frame 2, track b is complete
+    a = [(t, 2 + 0.2 * t, 2.0, 1.0) for t in (0, 1, 3, 4)]
+    b = [(t, 10.0, 5 + 0.1 * t, 2.0) for t in range(5)]
+    spots = spotTable(a + b)
+    tracks, edges = linkSpots(spots, max_distance=1.0, gap_distance=1.0, max_frame_gap=2)
+    assert len(tracks) == 2
+    gapped = tracks.loc[tracks['NUMBER_SPOTS'] == 4].iloc[0]
+    assert gapped['NUMBER_GAPS'] == 1
+    assert gapped['LONGEST_GAP'] == 1
+    assert gapped['TRACK_DURATION'] == 8.0
+    complete = tracks.loc[tracks['NUMBER_SPOTS'] == 5].iloc[0]
+    assert complete['NUMBER_GAPS'] == 0 and complete['LONGEST_GAP'] == 0
+    source = edges.loc[edges['TRACK_ID'] == gapped['TRACK_ID'], 'SPOT_SOURCE_ID'].tolist()
+    target = edges.loc[edges['TRACK_ID'] == gapped['TRACK_ID'], 'SPOT_TARGET_ID'].tolist()
+    assert list(zip(source, target)) == [(100, 101), (101, 102), (102, 103)]
+    # without gap closing the gap splits the track
+    tracks, _ = linkSpots(spots, max_distance=1.0, max_frame_gap=1)
+    assert sorted(tracks['NUMBER_SPOTS'].tolist()) == [2, 2, 5]
+
+
+def test_linkSpots_gap_closing_skips_consecutive_frames():
+    # too far for frame to frame linking, within gap_distance: gap closing
+    # only bridges missing frames, so these stay unlinked
+    spots = spotTable([(0, 0.0, 0.0, 0.0), (1, 1.5, 0.0, 0.0)])
+    tracks, edges = linkSpots(spots, max_distance=1.0, gap_distance=2.0, max_frame_gap=3)
+    assert len(tracks) == 0 and len(edges) == 0